@@ -1,17 +1,141 @@
 """
-This script downloads spatial feature data from OpenStreetMap and saves it to a csv file
+This script downloads spatial feature data from OpenStreetMap and saves it to a parquet file
 """
 
 from OSMPythonTools.overpass import overpassQueryBuilder
 from OSMPythonTools.nominatim import Nominatim
 import requests
 import pandas as pd
-import h3
 import shapely
-import pyproj
 import numpy as np
 import time
+import datetime
 import os
+import json
+import re
+import functools
+import argparse
+import threading
+import concurrent.futures
+from response_cache import ResponseCache
+from pbf_source import read_pbf
+from feature_selection import load_manifest
+from cities import load_cities, features_path
+from artifacts import write_table
+from sparse_features import pivot_sparse, outer_join, concat_rows, nonzero_rows
+from hexgrid import latlng_to_cells, H3_NULL
+from hexgrid import cells_covering, polygons_from_coords, apportion_to_cells, transformer
+
+OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+
+# raw Overpass and Nominatim responses are kept on disk between runs
+cache = ResponseCache()
+
+# minimal number of seconds between two requests to an endpoint
+RATE_LIMITS = {'overpass': 5.0, 'nominatim': 1.0}
+# failed requests are retried after BACKOFF_SECONDS, 2 * BACKOFF_SECONDS, 4 * BACKOFF_SECONDS...
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 30.0
+# Overpass answers with these when it is overloaded
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """Lets at most one request through every min_interval seconds, shared by all threads."""
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def wait(self) -> None:
+        """Block until the next request is allowed."""
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+rate_limiters = {endpoint: RateLimiter(interval) for endpoint, interval in RATE_LIMITS.items()}
+
+
+def post_with_retry(url: str, data: str, endpoint: str = 'overpass', timeout: int = 900) -> requests.Response:
+    """Rate limited POST request that is retried with exponential backoff on timeouts and overload errors.
+
+    Keyword arguments:
+
+    url -- url to post to
+    data -- body of the request
+    endpoint -- name of the endpoint in rate_limiters (default 'overpass')
+    timeout -- timeout of a single request in seconds (default 900)
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limiters[endpoint].wait()
+        try:
+            r = requests.post(url, data=data, timeout=timeout)
+            if r.status_code not in RETRY_STATUS_CODES:
+                r.raise_for_status()
+                return r
+            error = f"HTTP {r.status_code}"
+            if attempt == MAX_RETRIES:
+                r.raise_for_status()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            error = repr(e)
+        delay = BACKOFF_SECONDS * 2 ** attempt
+        print(f"Request to {endpoint} failed with {error}, retrying in {delay} s")
+        time.sleep(delay)
+
+
+@functools.lru_cache(maxsize=None)
+def get_area_id(area_name: str) -> int:
+    """Get the Overpass area id of an area, memoized in memory and in the response cache.
+
+    Keyword arguments:
+
+    area_name -- name of the area
+    """
+    key = cache.key('nominatim', area_name)
+    raw = cache.get(key)
+    if raw is not None:
+        return json.loads(raw)
+    nomatim = Nominatim()
+    rate_limiters['nominatim'].wait()
+    areaid = nomatim.query(area_name).areaId()
+    cache.put(key, json.dumps(areaid).encode('utf-8'))
+    return areaid
+
+
+def overpass_query(query: str, area_name: str, date: str = "") -> dict:
+    """Post a query to the Overpass API and return the decoded response, using the response cache.
+
+    Keyword arguments:
+
+    query -- Overpass QL query starting with its settings, like [out:json][timeout:900];
+    area_name -- name of the area the query is for
+    date -- date of the data as an ISO 8601 date or timestamp, "" for the current data (default "")
+    """
+    if date:
+        # Overpass returns the data of that date only with the date setting, it needs a full UTC timestamp
+        if 'T' not in date:
+            date = f'{date}T00:00:00Z'
+        settings, statements = query.split(';', 1)
+        query = f'{settings}[date:"{date}"];{statements}'
+    # the current data change every day, so undated queries are keyed by the day they are made
+    key = cache.key('overpass', query, area_name, date or datetime.date.today().isoformat())
+    raw = cache.get(key)
+    if raw is None:
+        print(f"Query: {query}")
+        # errors are raised, so they are never cached
+        r = post_with_retry(OVERPASS_URL, query, 'overpass')
+        raw = r.content
+        cache.put(key, raw)
+    else:
+        print(f"Cached: {query}")
+    return json.loads(raw)
 
 def get_point_data(node_name: str, area_name: str, date: str = "") -> list[dict]:
     """Get point data from Overpass API in the form of a list of dictionaries:
@@ -24,21 +148,10 @@ def get_point_data(node_name: str, area_name: str, date: str = "") -> list[dict]
     area_name -- name of the area to get data from
     date -- date of the data (default None)
     """
-    if date == "":
-        # set to current date
-        date = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    # ovapi = Overpass()
-    nomatim = Nominatim()
-    areaid = nomatim.query(area_name).areaId()
+    areaid = get_area_id(area_name)
     query = overpassQueryBuilder(area=areaid, elementType='node', selector=node_name, out='center', includeGeometry=True)
     query = '[out:json][timeout:900];' + query
-    print(f"Query: {query}")
-    # r = ovapi.query(query, date=date, timeout=900)
-    base_url = "https://overpass-api.de/api/interpreter"
-    # body is query
-    r = requests.post(base_url, data=query, timeout=900)
-    # print(r.text)
-    resp = r.json()
+    resp = overpass_query(query, area_name, date)
     nodes = []
     for node in resp['elements']:
         # print(node)
@@ -58,22 +171,10 @@ def get_line_data(node_name: str, area_name: str, date: str = "") -> list[dict]:
     area_name -- name of the area to get data from
     date -- date of the data (default None)
     """
-    if date == "":
-        # set to current date
-        date = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    # ovapi = Overpass()
-    nomatim = Nominatim()
-    areaid = nomatim.query(area_name).areaId()
+    areaid = get_area_id(area_name)
     query = overpassQueryBuilder(area=areaid, elementType='way', selector=node_name, out='body geom')
     query = '[out:json][timeout:900];' + query
-    print(f"Query: {query}")
-    # r = ovapi.query(query, date=date, timeout=900)
-    base_url = "https://overpass-api.de/api/interpreter"
-    # body is query
-    r = requests.post(base_url, data=query, timeout=900)
-    # save to file for debugging
-    resp = r.json()
-    # save to file for debugging
+    resp = overpass_query(query, area_name, date)
     ways = []
     for way in resp['elements']:
         el = {"geometry": way["geometry"], "type": way["tags"][node_name]}
@@ -81,34 +182,54 @@ def get_line_data(node_name: str, area_name: str, date: str = "") -> list[dict]:
     return ways
 
 
-def get_line_df(line_data: list[dict]) -> pd.DataFrame:
-    """Convert line data to a DataFrame with columns:
+def get_line_df(line_data: list[dict], hexagon_res: int = 9) -> pd.DataFrame:
+    """Convert line data to a sparse DataFrame with columns:
 
     name, sum of line lengths
 
     Indexed by hexagon id.
 
+    Lines are split into segments and every segment is clipped against every cell it crosses,
+    also the cells that do not contain any of its vertices.
+
     Keyword arguments:
 
     line_data -- list of dictionaries with line data
+    hexagon_res -- resolution of the hexagon grid (default 9)
     """
-    # create a dictionary
-    data_for_df = {'hex_id': [], 'name': [], 'length': []}
-    for line in line_data:
-        hexes = {h3.latlng_to_cell(point['lat'], point['lon'], 9) for point in line['geometry']}
-        for hexagon in hexes:
-            length = line_hexagon_length([(point['lat'], point['lon']) for point in line['geometry']], hexagon)
-            data_for_df['hex_id'].append(hexagon)
-            data_for_df['name'].append(line['type'])
-            data_for_df['length'].append(length)
-    # transpose the dictionary
-    retv = pd.DataFrame(data_for_df)
-    # set index to hex_id
-    # transpose the DataFrame
-    retv = retv.pivot_table(index='hex_id', columns='name', values='length', aggfunc='sum', fill_value=0)
+    line_idx, hex_ids, lengths = clip_lines(line_data, hexagon_res)
+    names = np.array([line['type'] for line in line_data], dtype=object)
+    # sparse table of the summed lengths
+    retv = pivot_sparse(hex_ids, names[line_idx], lengths)
     return retv
 
 
+def clip_lines(line_data: list[dict], hexagon_res: int = 9) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Clip lines against the hexagon grid, returns three arrays: index of the line, cell and length of the piece.
+
+    Keyword arguments:
+
+    line_data -- list of dictionaries with line data
+    hexagon_res -- resolution of the hexagon grid (default 9)
+    """
+    lats, lons, sizes = flatten_geometries(line['geometry'] for line in line_data)
+    if len(lats) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.uint64), np.array([], dtype=np.float64)
+    # project every line once
+    x, y = transformer.transform(lats, lons)
+    coords = np.column_stack((x, y))
+    # a segment starts at every point except the last point of each line
+    is_last = np.zeros(len(coords), dtype=bool)
+    is_last[np.cumsum(sizes)[sizes > 0] - 1] = True
+    starts = np.flatnonzero(~is_last)
+    segments = shapely.linestrings(np.stack((coords[starts], coords[starts + 1]), axis=1))
+    segment_line = np.repeat(np.arange(len(sizes)), np.maximum(sizes - 1, 0))
+    # clip against all cells around the lines, looked up in a spatial index
+    cells = cells_covering(lats.min(), lats.max(), lons.min(), lons.max(), hexagon_res)
+    segment_idx, hex_ids, lengths = apportion_to_cells(segments, cells, shapely.length)
+    return segment_line[segment_idx], hex_ids, lengths
+
+
 def get_area_data(area_name: str, selector: str = 'building', tags_to_look_for: list[str] = ['amenity', 'building'], date: str = "") -> pd.DataFrame:
     """Get area data from Overpass API in the form of a pandas DataFrame:
 
@@ -119,133 +240,189 @@ def get_area_data(area_name: str, selector: str = 'building', tags_to_look_for:
     area_name -- name of the area to get data from
     date -- date of the data (default None)
     """
-    if date == "":
-        # set to current date
-        date = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    nomatim = Nominatim()
-    areaid = nomatim.query(area_name).areaId()
+    areaid = get_area_id(area_name)
     query = overpassQueryBuilder(area=areaid, elementType=['way', 'relation'], selector=selector, out='body geom')
     query = '[out:json][timeout:900];' + query
-    print(f"Query: {query}")
-    # r = ovapi.query(query, date=date, timeout=900)
-    base_url = "https://overpass-api.de/api/interpreter"
-    # body is query
-    req = requests.post(base_url, data=query, timeout=900)
-    r = req.json()
+    r = overpass_query(query, area_name, date)
     areas = []
     for area in r['elements']:
         if 'geometry' in area.keys():
             geometry = area['geometry']
         else:
             continue
-        if 'tags' in area.keys():
-            for tag in tags_to_look_for:
-                if tag in area['tags'].keys():
-                    name = area['tags'][tag]
-                    break
-            else:
-                name = 'unknown'
-        else:
-            name = 'unknown'
-        areas.append({"name": name, "geometry": geometry})
+        areas.append({"name": area_feature_name(area, tags_to_look_for), "geometry": geometry})
     retv = pd.DataFrame(areas)
     return retv
 
-def get_feature_df(area_name: str, date: str = "", hexagon_res: int = 9) -> pd.DataFrame:
-    """Get feature data from Overpass API in the form of a DataFrame with one column 'name' and of which
-    values are the number of features of that type in the area. The index is the hexagon id.
+
+def area_feature_name(area: dict, tags_to_look_for: list[str]) -> str:
+    """Get the name of an area element - the value of the first tag from tags_to_look_for that it has.
+
+    Keyword arguments:
+
+    area -- Overpass way or relation element
+    tags_to_look_for -- tags to take the name from, in order of priority
+    """
+    tags = area.get('tags', {})
+    for tag in tags_to_look_for:
+        if tag in tags:
+            return tags[tag]
+    return 'unknown'
+
+
+# tags of the nodes that are counted in every hexagon
+NODE_NAMES = ['amenity', 'highway', 'public_transport', 'government', 'leisure',
+              'office', 'emergency', 'advertising', 'craft', 'sport', 'tourism']
+# tag of the ways that are summed as line lengths
+LINE_NAME = 'highway'
+# selectors of the areas that are summed as polygon areas and the tags their names are taken from
+AREA_SELECTORS = {
+    'building': ['amenity', 'building'],
+    'landuse': ['landuse'],
+    'leisure': ['leisure'],
+}
+
+
+def get_batched_data(area_name: str, date: str = "", meta: bool = False, manifest: dict | None = None) -> dict:
+    """Get point, line and area data of an area with a single Overpass query, returns a dictionary:
+
+    points: list like get_point_data for all NODE_NAMES, lines: list like get_line_data for LINE_NAME,
+    building, landuse, leisure: DataFrames like get_area_data for AREA_SELECTORS
+
+    With meta every point, line and area also has the id ("n123", "w456", ...) and the version of its element.
 
     Keyword arguments:
 
     area_name -- name of the area to get data from
     date -- date of the data (default None)
-    hexagon_res -- resolution of the hexagon grid (default 9)
+    meta -- add the element ids and versions (default False)
+    manifest -- feature manifest, only elements with the tag values it needs are downloaded (default all elements)
     """
-    if date == "":
-        # set to current date
-        date = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    
-    node_names = ['amenity', 'highway', 'public_transport', 'government', 'leisure', 
-                  'office', 'emergency', 'advertising', 'craft', 'sport', 'tourism']
+    areaid = get_area_id(area_name)
+    # one union of all selectors, the area is resolved once on the server
+    statements = []
+    tag_filter = '' if manifest is None else f'~"{overpass_regex(manifest["tag_values"])}"'
+    if manifest is None or manifest['tag_values']:
+        statements.extend(f'node[{node_name}{tag_filter}](area.searchArea);' for node_name in NODE_NAMES)
+        statements.append(f'way[{LINE_NAME}{tag_filter}](area.searchArea);')
+    if manifest is None or manifest['area_names']:
+        for selector, tags_to_look_for in AREA_SELECTORS.items():
+            # the name of an area comes from one of tags_to_look_for
+            name_filter = '' if manifest is None else \
+                f'[~"{overpass_regex(tags_to_look_for)}"~"{overpass_regex(manifest["area_names"])}"]'
+            statements.append(f'way[{selector}]{name_filter}(area.searchArea);')
+            statements.append(f'relation[{selector}]{name_filter}(area.searchArea);')
+    out = 'meta' if meta else 'body'
+    query = f'[out:json][timeout:900];area({areaid})->.searchArea;({"".join(statements)}); out {out} geom;'
+    resp = overpass_query(query, area_name, date)
+
+    # split the elements into buckets in a single pass
+    points = []
+    lines = []
+    areas = {selector: [] for selector in AREA_SELECTORS}
+    for element in resp['elements']:
+        tags = element.get('tags', {})
+        element_meta = {"id": f"{element['type'][0]}{element['id']}", "version": element.get('version', 0)} if meta else {}
+        if element['type'] == 'node':
+            # a node with several tags was returned by several per-tag queries before
+            for node_name in NODE_NAMES:
+                if node_name in tags:
+                    points.append({"geometry": (element["lat"], element["lon"]), "type": tags[node_name], **element_meta})
+            continue
+        if 'geometry' not in element:
+            continue
+        if element['type'] == 'way' and LINE_NAME in tags:
+            lines.append({"geometry": element["geometry"], "type": tags[LINE_NAME], **element_meta})
+        for selector, tags_to_look_for in AREA_SELECTORS.items():
+            if selector in tags:
+                areas[selector].append({"name": area_feature_name(element, tags_to_look_for), "geometry": element["geometry"], **element_meta})
+
+    retv = {'points': points, 'lines': lines}
+    columns = ['name', 'geometry'] + (['id', 'version'] if meta else [])
+    for selector, area_list in areas.items():
+        retv[selector] = pd.DataFrame(area_list, columns=columns)
+    return retv
+
+
+def overpass_regex(values: list[str]) -> str:
+    """Build an Overpass regular expression matching exactly the given values, escaped for a "..." string.
+
+    Keyword arguments:
 
-    pt_list = []
-    for node in node_names:
-        pt_list.extend(get_point_data(node, area_name, date=date))
+    values -- values to match
+    """
+    escaped = [re.sub(r'([\\^$.|?*+()\[\]{}])', r'\\\1', value) for value in values]
+    regex = f'^({"|".join(escaped)})$'
+    return regex.replace('\\', '\\\\').replace('"', '\\"')
 
-    # create a dictionary
-    data = {'hex_id': [], 'name': []}
-    for point in pt_list:
-        hex_id = h3.latlng_to_cell(point['geometry'][0], point['geometry'][1], hexagon_res)
-        data['hex_id'].append(hex_id)
-        data['name'].append(point['type'])
 
-    # convert the dictionary to a DataFrame
-    retv = pd.DataFrame(data)
+def filter_raw_data(raw: dict, manifest: dict) -> dict:
+    """Keep only the points, lines and areas that add to a feature of the manifest, so the others are never clipped.
 
-    retv = retv.groupby(['hex_id', 'name']).size().reset_index().pivot(index='hex_id', columns='name', values=0).fillna(0)
+    Keyword arguments:
 
+    raw -- dictionary returned by download_area_data
+    manifest -- feature manifest
+    """
+    tag_values = set(manifest['tag_values'])
+    area_names = set(manifest['area_names'])
+    retv = dict(raw)
+    retv['points'] = [point for point in raw['points'] if point['type'] in tag_values]
+    retv['lines'] = [line for line in raw['lines'] if line['type'] in tag_values]
+    for selector in AREA_SELECTORS:
+        if len(raw[selector]):
+            retv[selector] = raw[selector][raw[selector]['name'].isin(area_names)].reset_index(drop=True)
     return retv
 
-def cells_to_polygon(cells: set[str]) -> shapely.geometry.Polygon:
-    """Converts a set of cells to a polygon.
+
+def get_point_df(pt_list: list[dict], hexagon_res: int = 9) -> pd.DataFrame:
+    """Convert point data to a sparse DataFrame with one column per point type, values are the number of points
+    of that type in the hexagon. The index is the hexagon id.
 
     Keyword arguments:
 
-    cells -- set of cells
+    pt_list -- list of dictionaries with point data
     hexagon_res -- resolution of the hexagon grid (default 9)
     """
-    # convert to a list of tuples
-    h3_input = []
-    for cell in cells:
-        h3_input.extend(h3.cell_to_boundary(cell))
-    # get their convex hull
-    h3_input = shapely.geometry.MultiPoint(h3_input).convex_hull
-    # swap lat and lon in resulting geojsons
-    # convert to a shapely polygon
-    retv = shapely.geometry.Polygon(h3_input)
+    lats = np.array([point['geometry'][0] for point in pt_list], dtype=np.float64)
+    lons = np.array([point['geometry'][1] for point in pt_list], dtype=np.float64)
+    cells = latlng_to_cells(lats, lons, hexagon_res)
+    valid = cells != H3_NULL
+    names = np.array([point['type'] for point, ok in zip(pt_list, valid) if ok], dtype=object)
+    # sparse table of the counts
+    retv = pivot_sparse(cells[valid], names)
     return retv
 
-inproj = pyproj.Proj('EPSG:4326')
-outproj = pyproj.Proj('EPSG:3857')
-transformer = pyproj.Transformer.from_proj(inproj, outproj)
-def line_hexagon_length(line: list[tuple[float, float]], hexagon: str) -> float:
-    """Calculate the length of a line that is inside a hexagon.
+
+def flatten_geometries(geometries) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Flatten Overpass geometries into coordinate arrays, returns latitudes, longitudes and
+    the number of points of every geometry.
 
     Keyword arguments:
 
-    line -- list of tuples (lat, lon)
-    hexagon -- hexagon id
+    geometries -- iterable of lists of {'lat': lat, 'lon': lon} dictionaries
     """
-    # get the intersection of the line and the hexagon
-    # convert to a list of tuples
-    hex_bpoly_4326 = cells_to_polygon({hexagon})
-    # get polygon coords
-    x, y = hex_bpoly_4326.exterior.coords.xy
-    # transform
-    x, y = transformer.transform(x, y)
-    # transform line to EPSG:3857
-    lats = [point[0] for point in line]
-    lons = [point[1] for point in line]
-    line_x, line_y = transformer.transform(lats, lons)
-    # create a polygon
-    hex_bpoly = shapely.geometry.Polygon(zip(x, y))
-    # create a line
-    line = shapely.geometry.LineString(zip(line_x, line_y))
-    # get intersection
-    intersection = hex_bpoly.intersection(line)
-    # get length
-    length = intersection.length
-    return length
+    sizes = []
+    lats = []
+    lons = []
+    for geom in geometries:
+        sizes.append(len(geom))
+        lats.extend(point['lat'] for point in geom)
+        lons.extend(point['lon'] for point in geom)
+    return np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64), np.array(sizes, dtype=np.int64)
 
 
 def get_area_df(building_df: pd.DataFrame, hexagon_res: int = 9) -> pd.DataFrame:
-    """Calculate area of buildings for hexagon grid, return a GeoDataFrame:
+    """Calculate area of buildings for hexagon grid, return a sparse DataFrame:
 
     Feature 1 name, Feature 2 name,
     Feature 1 area in m^2, Feature 2 area in m^2,
 
     Indexed by hexagon id.
 
+    Every polygon is clipped against the boundary of every cell it overlaps,
+    so each cell gets only the part of the area that lies inside of it.
+
     Keyword arguments:
 
     building_df -- DataFrame with building data
@@ -257,133 +434,188 @@ def get_area_df(building_df: pd.DataFrame, hexagon_res: int = 9) -> pd.DataFrame
     # 1            library  [{'lat': 51.9163144, 'lon': 18.1129191}, {'lat...
     # 2                yes  [{'lat': 51.91845, 'lon': 18.1099972}, {'lat':...
     # 3    public_building  [{'lat': 51.9185897, 'lon': 18.1121521}, {'lat...
-    inproj = pyproj.Proj('EPSG:4326')
-    outproj = pyproj.Proj('EPSG:3857')
-    transformer = pyproj.Transformer.from_proj(inproj, outproj)
-    # add a column with converted geometry
-    transformed_geometry = []
-    for geom in building_df['geometry']:
-        lats = [point['lat'] for point in geom]
-        lons = [point['lon'] for point in geom]
-        x, y = transformer.transform(lats, lons)
-        try:
-            transformed_geometry.append(shapely.geometry.Polygon(zip(x, y)))
-        except Exception as e: # life is life
-            transformed_geometry.append(shapely.geometry.Polygon())
-    building_df['geometry2'] = transformed_geometry
-    rows_to_add = []
-    for _, row in building_df.iterrows():
-        try:
-            # get hexagons
-            # convert to a list of tuples
-            h3_input = [(point['lat'], point['lon']) for point in row['geometry']]
-            # get all cells that are in the polygon
-            h3_cells = {h3.latlng_to_cell(*point, hexagon_res) for point in h3_input}
-            h3_poly = h3.Polygon(h3_input)
-            # add cells fully inside
-            h3_cells.update(h3.polygon_to_cells(h3_poly, hexagon_res))
-            # convert to a bounding polygon
-            hex_bpoly_4326 = cells_to_polygon(h3_cells)
-            # transform to EPSG:3857
-            # get polygon coords
-            x, y = hex_bpoly_4326.exterior.coords.xy
-            # transform
-            x, y = transformer.transform(x, y)
-            # create a polygon
-            hex_bpoly = shapely.geometry.Polygon(zip(x, y))
-            # get area of the intersection
-            intersection = hex_bpoly.intersection(row['geometry2'])
-            area = intersection.area
-            # add to rows_to_add
-            for hex_id in h3_cells:
-                rows_to_add.append({'hex_id': hex_id, 'name': row['name'], 'area': area})
-        except Exception as e:
-            print(e)
-            continue # yuck i know
-
-    retv = pd.DataFrame(rows_to_add, columns=['hex_id', 'name', 'area'])
-    retv = retv.groupby(['hex_id', 'name']).sum()
-    retv = retv.reset_index()
-    # pivot the table
-    retv = retv.pivot(index='hex_id', columns='name', values='area')
-    retv = retv.reset_index()
-    # fill NaNs with 0
-    retv = retv.fillna(0)
+    if len(building_df) == 0:
+        return pivot_sparse(np.array([], dtype=np.uint64), np.array([], dtype=object))
+    geom_idx, hex_ids, areas = clip_areas(building_df['geometry'], hexagon_res)
+    names = building_df['name'].to_numpy()
+    # sparse table of the summed areas
+    retv = pivot_sparse(hex_ids, names[geom_idx], areas)
     return retv
 
-def add_neighbours(df: pd.DataFrame) -> pd.DataFrame:
-    retv = df
-    basic_cols = retv.columns
-    # add columns for neighbours
-    for col in basic_cols:
-        retv[f'{col}_neighbour_count'] = np.float32(0)
-    # add columns to retv
-    
-    # iterate over all neighbours for each hexagon and add its values to neighbours neighbour_count columns
-    for hexagon in retv.index:
-        neighbours = h3.grid_disk(hexagon, 1)
-        for neighbour in neighbours:
-            if neighbour in retv.index and neighbour != hexagon:
-                for col in basic_cols:
-                    retv.loc[neighbour, f'{col}_neighbour_count'] += retv.loc[hexagon, col]
+def clip_areas(geometries, hexagon_res: int = 9) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Clip area geometries against the hexagon grid, returns three arrays: index of the geometry, cell and area of the piece.
+
+    Keyword arguments:
+
+    geometries -- iterable of Overpass geometries
+    hexagon_res -- resolution of the hexagon grid (default 9)
+    """
+    lats, lons, sizes = flatten_geometries(geometries)
+    if len(lats) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.uint64), np.array([], dtype=np.float64)
+    # project all polygons at once
+    x, y = transformer.transform(lats, lons)
+    polygons = polygons_from_coords(np.asarray(x), np.asarray(y), sizes)
+    # clip against all cells around the polygons, looked up in a spatial index
+    cells = cells_covering(lats.min(), lats.max(), lons.min(), lons.max(), hexagon_res)
+    return apportion_to_cells(polygons, cells, shapely.area)
+
+
+def download_area_data(area_name: str, date: str = "", batched: bool = False, pbf_path: str | None = None,
+                       manifest: dict | None = None, meta: bool = False) -> dict:
+    """Download all raw data needed to build the features of an area, returns a dictionary like get_batched_data.
+
+    Keyword arguments:
+
+    area_name -- name of the area to get data from
+    date -- date of the data (default None)
+    batched -- download everything with one Overpass query instead of one query per selector (default False)
+    pbf_path -- read the data from this local .osm.pbf extract instead of Overpass, date is then the date of the extract (default None)
+    manifest -- feature manifest, the batched query downloads only the elements it needs (default all elements)
+    meta -- add the element ids and versions, only with batched or pbf_path (default False)
+    """
+    if pbf_path is not None:
+        return read_pbf(pbf_path, area_name, meta=meta)
+    if batched:
+        return get_batched_data(area_name, date=date, meta=meta, manifest=manifest)
+    if meta:
+        raise ValueError("Element ids and versions need the batched query or a .osm.pbf extract")
+    points = []
+    for node in NODE_NAMES:
+        points.extend(get_point_data(node, area_name, date=date))
+    retv = {'points': points, 'lines': get_line_data(LINE_NAME, area_name, date=date)}
+    for selector, tags_to_look_for in AREA_SELECTORS.items():
+        retv[selector] = get_area_data(area_name, selector=selector, tags_to_look_for=tags_to_look_for, date=date)
     return retv
 
 
-def get_all_data(area_name: str, hexagon_res: int = 9, date: str = "") -> pd.DataFrame:
-    # combine data from get_feature_df and get_area_df
-    feature_df = get_feature_df(area_name, date=date, hexagon_res=hexagon_res)
-    building_df = get_area_data(area_name, selector='building', tags_to_look_for=['amenity', 'building'], date=date)
-    landuse_df = get_area_data(area_name, selector='landuse', tags_to_look_for=['landuse'], date=date)
-    leisure_df = get_area_data(area_name, selector='leisure', tags_to_look_for=['leisure'], date=date)
+def feature_columns(raw: dict) -> list[list[str]]:
+    """Get the columns the point, area and line tables of the data of an area can have, in the order
+    process_area_data joins them.
+
+    Keyword arguments:
+
+    raw -- dictionary returned by download_area_data
+    """
+    columns = [sorted({str(point['type']) for point in raw['points']})]
+    for selector in AREA_SELECTORS:
+        names = raw[selector]['name'] if len(raw[selector]) else []
+        columns.append(sorted({f'area_{name}' for name in names}))
+    columns.append(sorted({str(line['type']) for line in raw['lines']}))
+    return columns
+
 
-    line_data = get_line_data('highway', area_name, date=date)
-    line_df = get_line_df(line_data)
+def process_area_data(raw: dict, hexagon_res: int = 9, manifest: dict | None = None,
+                      full_raw: dict | None = None) -> pd.DataFrame:
+    """Build the sparse float32 feature DataFrame of an area from the data returned by download_area_data.
+
+    Keyword arguments:
+
+    raw -- dictionary returned by download_area_data
+    hexagon_res -- resolution of the hexagon grid (default 9)
+    manifest -- feature manifest, only the features it needs are computed (default all features)
+    full_raw -- all data of the area when raw holds only some of its elements, the columns are named
+    like in the table of the whole area (default raw)
+    """
+    full_raw = raw if full_raw is None else full_raw
+    if manifest is not None:
+        raw = filter_raw_data(raw, manifest)
+        full_raw = filter_raw_data(full_raw, manifest)
+    feature_df = get_point_df(raw['points'], hexagon_res)
+    line_df = get_line_df(raw['lines'], hexagon_res)
 
     s = time.time()
-    building_area_df = get_area_df(building_df, hexagon_res)
-    landuse_area_df = get_area_df(landuse_df, hexagon_res)
-    leisure_area_df = get_area_df(leisure_df, hexagon_res)
+    building_area_df = get_area_df(raw['building'], hexagon_res)
+    landuse_area_df = get_area_df(raw['landuse'], hexagon_res)
+    leisure_area_df = get_area_df(raw['leisure'], hexagon_res)
     e = time.time()
-    # add prefix area_ to area_df columns, dont change hex_id
-    building_area_df.columns = [f"area_{col}" if col != 'hex_id' else col for col in building_area_df.columns]
-    landuse_area_df.columns = [f"area_{col}" if col != 'hex_id' else col for col in landuse_area_df.columns]
-    leisure_area_df.columns = [f"area_{col}" if col != 'hex_id' else col for col in leisure_area_df.columns]
+    # add prefix area_ to area_df columns
+    building_area_df = building_area_df.add_prefix('area_')
+    landuse_area_df = landuse_area_df.add_prefix('area_')
+    leisure_area_df = leisure_area_df.add_prefix('area_')
     print(f"Time to get area data: {e-s}")
-    # merge the dfs
-    retv = pd.merge(feature_df, building_area_df, on='hex_id', how='outer')
-    retv = pd.merge(retv, landuse_area_df, on='hex_id', how='outer')
-    retv = pd.merge(retv, leisure_area_df, on='hex_id', how='outer')
-    retv = pd.merge(retv, line_df, on='hex_id', how='outer')
-    # set index to hex_id
-    retv = retv.set_index('hex_id')
-    # fill NaNs with 0
-    retv = retv.fillna(0)
-    # convert all data to float32
-    retv = retv.astype(np.float32)
-    # sum data from neighbours and add to dataframe as {feature}_neighbour_count
-    # if get_neighbours:
-    #     s = time.time()
-    #     retv = add_neighbours(retv)
-    #     e = time.time()
-    #     print(f"Time to add neighbours: {e-s}")
+    # outer join the sparse dfs on hex_id, missing values are 0, the _x and _y suffixes are decided
+    # on all elements of the area, so they do not depend on which hexagons are computed
+    retv = outer_join([feature_df, building_area_df, landuse_area_df, leisure_area_df, line_df],
+                      feature_columns(full_raw))
+    return retv
+
+
+def get_all_data_parallel(areas: dict[str, str], hexagon_res: int = 9, batched: bool = True,
+                          download_workers: int = 4, process_workers: int | None = None,
+                          rate_limits: dict[str, float] | None = None,
+                          pbf_paths: dict[str, str] | None = None,
+                          manifest: dict | None = None,
+                          hexagon_resolutions: dict[str, int] | None = None) -> dict[str, pd.DataFrame]:
+    """Get the features of many areas at once. Downloads run in threads and overlap each other,
+    the geometry processing of an area starts in a process pool as soon as its data arrives.
+
+    Returns a dictionary area name -> sparse float32 feature DataFrame indexed by hexagon id, like process_area_data.
+
+    Keyword arguments:
+
+    areas -- dictionary area name -> date of the data ("" for current data)
+    hexagon_res -- resolution of the hexagon grid (default 9)
+    batched -- download everything with one Overpass query per area (default True)
+    download_workers -- number of concurrent downloads (default 4)
+    process_workers -- number of processes for geometry processing (default number of CPUs)
+    rate_limits -- minimal seconds between requests per endpoint, overrides RATE_LIMITS (default None)
+    pbf_paths -- dictionary area name -> local .osm.pbf extract, read instead of Overpass for these areas (default None)
+    manifest -- feature manifest, only the features it needs are downloaded and computed (default all features)
+    hexagon_resolutions -- dictionary area name -> resolution of the hexagon grid, overrides hexagon_res for these areas (default None)
+    """
+    pbf_paths = pbf_paths or {}
+    hexagon_resolutions = hexagon_resolutions or {}
+    for endpoint, interval in (rate_limits or {}).items():
+        rate_limiters[endpoint].min_interval = interval
+    retv = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as downloads, \
+         concurrent.futures.ProcessPoolExecutor(max_workers=process_workers) as processing:
+        download_futures = {downloads.submit(download_area_data, area_name, date, batched, pbf_paths.get(area_name), manifest): area_name
+                            for area_name, date in areas.items()}
+        process_futures = {}
+        for future in concurrent.futures.as_completed(download_futures):
+            area_name = download_futures[future]
+            print(f"Downloaded data for {area_name}")
+            area_res = hexagon_resolutions.get(area_name, hexagon_res)
+            process_futures[processing.submit(process_area_data, future.result(), area_res, manifest)] = area_name
+        for future in concurrent.futures.as_completed(process_futures):
+            area_name = process_futures[future]
+            print(f"Processed data for {area_name}")
+            retv[area_name] = future.result()
     return retv
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the OSM features of the training and target areas")
+    parser.add_argument('--areas', choices=['train', 'target'], nargs='+', default=['train', 'target'],
+                        help="which areas to download (default both)")
+    args = parser.parse_args()
     # check if the /data directory exists
     if 'data' not in os.listdir():
         os.mkdir('data')
-    a = get_all_data("Montgomery County, PA", date="2018-06-01T00:00:00Z")
-    c = get_all_data("Cincinnati, Ohio", date="2018-06-01T00:00:00Z")
-    d = get_all_data("Virginia Beach", date="2018-06-01T00:00:00Z")
-    final = pd.concat([a, c, d], axis=0, ignore_index=False)
-    # fill NaNs with 0s
-    final = final.fillna(0)
-    # drop row with all 0s
-    final = final[(final.T != 0).any()]
-    final.to_csv('./data/osm_data.csv')
-    target = get_all_data("Warszawa")
-    target = target.fillna(0)
-    target = target[(target.T != 0).any()]
-    target.to_csv('./data/warszawa_osm.csv')
+    training_areas = ["Montgomery County, PA", "Cincinnati, Ohio", "Virginia Beach"]
+    # the target cities come from the registry, see cities.py
+    cities = load_cities()
+    areas = {}
+    if 'train' in args.areas:
+        areas.update({area_name: "2018-06-01T00:00:00Z" for area_name in training_areas})
+    if 'target' in args.areas:
+        areas.update({city.area_name: "" for city in cities})
+    # all cities are downloaded and processed concurrently, only with the features of the manifest if there is one
+    area_dfs = get_all_data_parallel(areas, batched=True, manifest=load_manifest(),
+                                     pbf_paths={city.area_name: city.pbf_path for city in cities if city.pbf_path},
+                                     hexagon_resolutions={city.area_name: city.res for city in cities})
+    if 'train' in args.areas:
+        # missing columns are 0s
+        final = concat_rows([area_dfs[area_name] for area_name in training_areas])
+        # drop row with all 0s
+        final = final[nonzero_rows(final)]
+        write_table(final, './data/osm_data.parquet')
+    if 'target' in args.areas:
+        for city in cities:
+            target = area_dfs[city.area_name]
+            target = target[nonzero_rows(target)]
+            os.makedirs(os.path.dirname(features_path(city)), exist_ok=True)
+            write_table(target, features_path(city))
 
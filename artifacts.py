@@ -0,0 +1,125 @@
+"""
+This module reads and writes the tables exchanged between the pipeline stages:
+float32 feature columns and a uint64 hex_id column, stored as Parquet or Feather with their column schema
+
+Tables with sparse columns are stored in a sparse layout - one (hex_id, row, feature, value) record per
+non-zero value plus one record with feature -1 per row - and are read back as sparse DataFrames.
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import scipy.sparse
+from hexgrid import index_to_cells, cells_to_str
+from sparse_features import to_csr, from_csr
+
+INDEX_NAME = 'hex_id'
+# key of the column schema in the file metadata
+SCHEMA_KEY = b'my_aed.schema'
+
+
+def _dense_table(df: pd.DataFrame, columns: list[str]) -> pa.Table:
+    arrays = [pa.array(index_to_cells(df.index), type=pa.uint64())]
+    arrays.extend(pa.array(df[col].to_numpy(dtype=np.float32), type=pa.float32()) for col in df.columns)
+    return pa.Table.from_arrays(arrays, names=[INDEX_NAME] + columns)
+
+
+def _sparse_table(df: pd.DataFrame) -> pa.Table:
+    cells = index_to_cells(df.index)
+    coo = to_csr(df).tocoo()
+    rows = np.arange(len(df), dtype=np.int64)
+    # every row gets a record with feature -1, so that rows without non-zero values are kept
+    return pa.Table.from_arrays([
+        pa.array(np.concatenate([cells, cells[coo.row]]), type=pa.uint64()),
+        pa.array(np.concatenate([rows, coo.row.astype(np.int64)]), type=pa.int64()),
+        pa.array(np.concatenate([np.full(len(df), -1, dtype=np.int32), coo.col.astype(np.int32)]), type=pa.int32()),
+        pa.array(np.concatenate([np.zeros(len(df), dtype=np.float32), coo.data.astype(np.float32)]), type=pa.float32()),
+    ], names=[INDEX_NAME, 'row', 'feature', 'value'])
+
+
+def write_table(df: pd.DataFrame, path: str) -> None:
+    """Write a DataFrame indexed by hexagon id to a .parquet or .feather file.
+    The file is replaced atomically, so readers never see a partially written table.
+
+    Keyword arguments:
+
+    df -- DataFrame with numeric (dense or sparse) columns indexed by hexagon id
+    path -- path of the file, the format is taken from the extension
+    """
+    columns = [str(col) for col in df.columns]
+    layout = 'sparse' if any(isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes) else 'dense'
+    table = _sparse_table(df) if layout == 'sparse' else _dense_table(df, columns)
+    schema = {'index': INDEX_NAME, 'columns': columns, 'dtype': 'float32', 'layout': layout}
+    table = table.replace_schema_metadata({SCHEMA_KEY: json.dumps(schema).encode('utf-8')})
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if path.endswith('.feather'):
+        # uncompressed, so that it can be memory-mapped
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+    else:
+        pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _read_metadata(path: str) -> dict:
+    if path.endswith('.feather'):
+        with pa.memory_map(path) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata
+    else:
+        metadata = pq.read_schema(path).metadata
+    return json.loads(metadata[SCHEMA_KEY])
+
+
+def read_schema(path: str) -> list[str]:
+    """Read the names of the feature columns of a table without reading the data.
+
+    Keyword arguments:
+
+    path -- path of a file written by write_table
+    """
+    return _read_metadata(path)['columns']
+
+
+def _read_arrow(path: str, columns: list[str] | None) -> pa.Table:
+    if path.endswith('.feather'):
+        return feather.read_table(path, columns=columns, memory_map=True)
+    return pq.read_table(path, columns=columns, memory_map=True)
+
+
+def read_table(path: str, columns: list[str] | None = None, hex_as_str: bool = False) -> pd.DataFrame:
+    """Read a table written by write_table as a DataFrame indexed by hex_id, the file is memory-mapped.
+    Tables written from sparse DataFrames are returned as sparse DataFrames.
+
+    Keyword arguments:
+
+    path -- path of the file
+    columns -- feature columns to read, all if None (default None)
+    hex_as_str -- return hexadecimal string hex ids instead of uint64, for output only (default False)
+    """
+    schema = _read_metadata(path)
+    if schema.get('layout') == 'sparse':
+        table = _read_arrow(path, None)
+        features = table.column('feature').to_numpy()
+        rows = table.column('row').to_numpy()
+        is_row = features == -1
+        cells = np.empty(is_row.sum(), dtype=np.uint64)
+        cells[rows[is_row]] = table.column(INDEX_NAME).to_numpy()[is_row]
+        feature_names = schema['columns'] if columns is None else list(columns)
+        # map the stored feature codes to the requested columns, -1 for the skipped ones
+        code_map = np.full(len(schema['columns']), -1, dtype=np.int64)
+        code_map[[schema['columns'].index(name) for name in feature_names]] = np.arange(len(feature_names))
+        new_codes = np.where(is_row, -1, code_map[np.maximum(features, 0)])
+        keep = new_codes >= 0
+        matrix = (table.column('value').to_numpy()[keep], (rows[keep], new_codes[keep]))
+        index = pd.Index(cells_to_str(cells) if hex_as_str else cells, name=INDEX_NAME)
+        return from_csr(scipy.sparse.coo_matrix(matrix, shape=(len(cells), len(feature_names))), index, feature_names)
+
+    table = _read_arrow(path, None if columns is None else [INDEX_NAME] + list(columns))
+    cells = table.column(INDEX_NAME).to_numpy()
+    feature_names = [name for name in table.column_names if name != INDEX_NAME]
+    data = {name: table.column(name).to_numpy() for name in feature_names}
+    index = pd.Index(cells_to_str(cells) if hex_as_str else cells, name=INDEX_NAME)
+    return pd.DataFrame(data, index=index, columns=feature_names)
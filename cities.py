@@ -0,0 +1,75 @@
+"""
+This module reads the registry of target cities from cities.json. Every city has a slug used in file names,
+the name its boundary is looked up by, the centre and zoom of its map and the resolution of its hexagons.
+
+The stages after acquisition handle all registered cities in one run and keep the files of every city
+in data/cities/<slug> and results/<slug>.
+"""
+
+import dataclasses
+import json
+import os
+
+CITIES_PATH = './cities.json'
+CITIES_DIR = './data/cities'
+RESULTS_DIR = './results'
+
+
+@dataclasses.dataclass
+class City:
+    slug: str
+    area_name: str
+    centre: tuple[float, float]
+    # the model is trained on resolution 9 hexagons, other resolutions need a model trained on them
+    res: int = 9
+    zoom: int = 11
+    # local .osm.pbf extract read instead of Overpass, see pbf_source.py
+    pbf_path: str | None = None
+
+
+def load_cities(path: str = CITIES_PATH) -> list[City]:
+    """Load the registered cities, in the order of the registry. The first city is the default one.
+
+    Keyword arguments:
+
+    path -- path of the registry (default CITIES_PATH)
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    retv = [City(**{**entry, 'centre': tuple(entry['centre'])}) for entry in entries]
+    slugs = [city.slug for city in retv]
+    if len(set(slugs)) != len(slugs):
+        raise ValueError(f"Duplicate city slugs in {path}")
+    return retv
+
+
+def features_path(city: City) -> str:
+    return os.path.join(CITIES_DIR, city.slug, 'osm.parquet')
+
+
+def target_path(city: City) -> str:
+    return os.path.join(CITIES_DIR, city.slug, 'target.parquet')
+
+
+def predictions_path(city: City) -> str:
+    return os.path.join(CITIES_DIR, city.slug, 'predictions.parquet')
+
+
+def results_path(city: City) -> str:
+    return os.path.join(RESULTS_DIR, city.slug, 'results.json')
+
+
+def save_results(results: dict[str, float], path: str) -> None:
+    """Save the predictions of a city as json. The file is written next to the results and renamed over them,
+    so serve_results.py never reads a half-written file.
+
+    Keyword arguments:
+
+    results -- dictionary hex id -> predicted OHCA count
+    path -- path of the results file
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(results, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,186 @@
+"""
+This script joins the AEDs of aed_poland.geojson onto the predicted hexagons and proposes new AED sites.
+A hexagon is covered when an AED stands within COVERAGE_K steps of it. The sites are chosen greedily,
+every next site covers the most predicted OHCA not covered yet, with a priority queue of the gains of all
+candidate sites that is updated only where a chosen site changed them.
+"""
+
+import argparse
+import heapq
+import json
+import os
+import numpy as np
+import pandas as pd
+import requests
+import scipy.sparse
+from artifacts import read_schema, read_table
+from cities import load_cities, predictions_path, RESULTS_DIR
+from h3.api import basic_int as h3_int
+from hexgrid import latlng_to_cells, count_cells, cells_to_str, index_to_cells, H3_NULL
+from neighbours import ring_adjacency
+from sparse_features import to_dense
+
+AED_URL = 'https://aed.openstreetmap.org.pl/aed_poland.geojson'
+AED_PATH = './data/aed_poland.geojson'
+# hexagons within this many steps of an AED are covered, at resolution 9 a step is about 300 m of walking
+COVERAGE_K = 1
+# number of proposed AED sites
+N_SITES = 10
+# gains left over from rounding when risk is subtracted are not worth a site
+GAIN_EPS = 1e-9
+
+
+def load_aeds(path: str = AED_PATH, url: str = AED_URL, refresh: bool = False) -> tuple[np.ndarray, np.ndarray]:
+    """Get the latitudes and longitudes of the AEDs as two float64 arrays, the file is downloaded if it is missing.
+
+    Keyword arguments:
+
+    path -- path of the geojson file (default AED_PATH)
+    url -- url the file is downloaded from (default AED_URL)
+    refresh -- download the file even if it exists (default False)
+    """
+    if refresh or not os.path.exists(path):
+        response = requests.get(url, timeout=300)
+        response.raise_for_status()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(response.content)
+        os.replace(tmp_path, path)
+    with open(path, 'r') as f:
+        features = json.load(f)['features']
+    coords = np.array([feature['geometry']['coordinates'][:2] for feature in features
+                       if feature.get('geometry') and feature['geometry']['type'] == 'Point'], dtype=np.float64).reshape(-1, 2)
+    # geojson coordinates are (lon, lat)
+    return coords[:, 1], coords[:, 0]
+
+
+def aed_counts(cells: np.ndarray, lats: np.ndarray, lons: np.ndarray, res: int = 9) -> np.ndarray:
+    """Count the AEDs inside every cell, all AEDs are indexed at once.
+
+    Keyword arguments:
+
+    cells -- uint64 array of cells
+    lats, lons -- coordinates of the AEDs
+    res -- resolution of the cells (default 9)
+    """
+    aed_cells, counts = count_cells(latlng_to_cells(lats, lons, res))
+    cells = np.asarray(cells, dtype=np.uint64)
+    if len(aed_cells) == 0:
+        return np.zeros(len(cells), dtype=np.int64)
+    pos = np.minimum(np.searchsorted(aed_cells, cells), len(aed_cells) - 1)
+    return np.where(aed_cells[pos] == cells, counts[pos], 0)
+
+
+def coverage_matrix(cells: np.ndarray, k: int = COVERAGE_K) -> scipy.sparse.csr_matrix:
+    """Build the symmetric sparse matrix with a 1 in row i, column j when cell j lies within k steps of cell i.
+
+    Keyword arguments:
+
+    cells -- uint64 array of cells
+    k -- largest distance (default COVERAGE_K)
+    """
+    retv = scipy.sparse.identity(len(cells), dtype=np.float32, format='csr')
+    for ring in ring_adjacency(cells, k):
+        retv = retv + ring
+    return retv.tocsr()
+
+
+def aed_reach(cells: np.ndarray, lats: np.ndarray, lons: np.ndarray, res: int = 9, k: int = COVERAGE_K) -> np.ndarray:
+    """Get a boolean array, True for the cells within k steps of any AED. The disks are built around the cells
+    of the AEDs, so an AED in a hexagon missing from cells still covers the cells around it.
+
+    Keyword arguments:
+
+    cells -- uint64 array of cells
+    lats, lons -- coordinates of the AEDs
+    res -- resolution of the cells (default 9)
+    k -- largest distance (default COVERAGE_K)
+    """
+    aed_cells = np.unique(latlng_to_cells(lats, lons, res))
+    aed_cells = aed_cells[aed_cells != H3_NULL]
+    reach = np.array([cell for aed in aed_cells.tolist() for cell in h3_int.grid_disk(aed, k)], dtype=np.uint64)
+    return np.isin(np.asarray(cells, dtype=np.uint64), reach)
+
+
+def greedy_sites(matrix: scipy.sparse.csr_matrix, risk: np.ndarray, covered: np.ndarray,
+                 n: int = N_SITES) -> tuple[np.ndarray, np.ndarray]:
+    """Choose up to n new sites that cover the most risk not covered yet, one site at a time.
+    Returns the positions of the chosen cells and the risk newly covered by each of them.
+
+    The gains of all candidates sit in a heap. A chosen site lowers only the gains of the candidates that reach
+    the cells it covered, those are updated in the gain array and their heap entries are refreshed when popped.
+
+    Keyword arguments:
+
+    matrix -- coverage matrix of the cells, from coverage_matrix
+    risk -- predicted OHCA count of every cell
+    covered -- boolean array, True for the cells that are already covered
+    n -- number of sites (default N_SITES)
+    """
+    remaining = np.where(covered, 0.0, np.asarray(risk, dtype=np.float64))
+    gain = matrix @ remaining
+    heap = [(-g, i) for i, g in enumerate(gain.tolist()) if g > GAIN_EPS]
+    heapq.heapify(heap)
+    sites, gains = [], []
+    while heap and len(sites) < n:
+        neg_gain, i = heapq.heappop(heap)
+        if -neg_gain != gain[i]:
+            # the gain dropped since the entry was pushed, put it back with the current gain
+            if gain[i] > GAIN_EPS:
+                heapq.heappush(heap, (-gain[i], i))
+            continue
+        newly = matrix.indices[matrix.indptr[i]:matrix.indptr[i + 1]]
+        newly = newly[remaining[newly] > 0]
+        sites.append(i)
+        gains.append(gain[i])
+        # every candidate reaching a newly covered cell loses its risk, the matrix is symmetric
+        gain -= matrix[newly].T @ remaining[newly]
+        remaining[newly] = 0.0
+    return np.array(sites, dtype=np.int64), np.array(gains, dtype=np.float64)
+
+
+def covered_cells(df: pd.DataFrame, lats: np.ndarray, lons: np.ndarray, res: int = 9,
+                  k: int = COVERAGE_K) -> tuple[scipy.sparse.csr_matrix, np.ndarray, np.ndarray]:
+    """Get the coverage matrix of the predicted hexagons, the AED count of every hexagon and a boolean array,
+    True for the hexagons within k steps of an AED or with a hospital. AEDs in hexagons without predictions
+    cover the predicted hexagons around them too.
+
+    Keyword arguments:
+
+    df -- predictions indexed by hex_id
+    lats, lons -- coordinates of the AEDs
+    res -- resolution of the hexagons (default 9)
+    k -- coverage distance (default COVERAGE_K)
+    """
+    cells = index_to_cells(df.index)
+    counts = aed_counts(cells, lats, lons, res)
+    matrix = coverage_matrix(cells, k)
+    hospital = to_dense(df[['hospital']])['hospital'].to_numpy() > 0 if 'hospital' in df.columns else np.zeros(len(df), dtype=bool)
+    return matrix, counts, aed_reach(cells, lats, lons, res, k) | hospital
+
+
+def sites_path(slug: str) -> str:
+    return os.path.join(RESULTS_DIR, slug, 'aed_sites.json')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Propose new AED sites covering the most predicted OHCA")
+    parser.add_argument('--sites', type=int, default=N_SITES, help="number of proposed sites per city")
+    parser.add_argument('--k', type=int, default=COVERAGE_K, help="coverage distance in hexagons")
+    parser.add_argument('--refresh', action='store_true', help="download the AEDs again")
+    args = parser.parse_args()
+    lats, lons = load_aeds(refresh=args.refresh)
+    for city in load_cities():
+        path = predictions_path(city)
+        columns = ['OHCA'] + (['hospital'] if 'hospital' in read_schema(path) else [])
+        df = to_dense(read_table(path, columns))
+        matrix, counts, covered = covered_cells(df, lats, lons, city.res, args.k)
+        risk = df['OHCA'].to_numpy(dtype=np.float64)
+        sites, gains = greedy_sites(matrix, risk, covered, args.sites)
+        hex_ids = cells_to_str(index_to_cells(df.index))
+        os.makedirs(os.path.dirname(sites_path(city.slug)), exist_ok=True)
+        with open(sites_path(city.slug), 'w') as f:
+            json.dump([{'hex_id': hex_ids[i], 'OHCA_covered': gain} for i, gain in zip(sites.tolist(), gains.tolist())], f)
+        print(f"{city.area_name}: {risk[covered].sum() / max(risk.sum(), 1e-9):.1%} of the predicted OHCA covered, "
+              f"{len(sites)} new sites cover {gains.sum() / max(risk.sum(), 1e-9):.1%} more")
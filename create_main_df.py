@@ -1,16 +1,27 @@
 """
 This script downloads OHCA data from sources and adds them to the main dataframe
-It also adds the neighbors to the data
+It also adds the neighbors to the data (see neighbours.py)
 """
 
 import io
 import pandas as pd
 import requests
 import numpy as np
-import h3
 import os
+import json
+import concurrent.futures
+from hexgrid import latlng_to_cells, count_cells
+from neighbours import add_neighbour_features, add_neighbour_features_binary, NEIGHBOURER_BIN
+from artifacts import read_table, write_table
+from sparse_features import nonzero_rows, reindex_columns
+from cities import load_cities, features_path, target_path
+from feature_selection import load_manifest
+from pyramid import add_context_features, CONTEXT_RES
+from incidents import SOURCES, download, ingest_csv, incident_counts, source_dir
 
 target = 'predictions'
+# feature columns shared by the training and target tables, in the order used by both
+FEATURE_SCHEMA_PATH = './data/feature_schema.json'
 
 # check for the vbohcar.xlsx file in the /data directory
 if 'VBOHCAR.xlsx' in os.listdir('data'):
@@ -27,38 +38,85 @@ else:
     # read the third sheet of the excel file
     vb_ohca_in = pd.read_excel(file_bytes, sheet_name=3)
 
-def hexid_ohca(df: pd.DataFrame, lat_col: str, lon_col: str, res: int = 9) -> dict:
+def neighbour_features(df: pd.DataFrame, manifest: dict | None = None) -> pd.DataFrame:
     """
-    This function takes a dataframe of OHCA incidents and returns a dictionary
-    with the hex_id as the key and the count
-    of OHCA incidents as the value.
+    This function adds the sums of the features of neighbouring hexagons to a dataframe,
+    with the compiled neighbourer in its binary mode if it was built, in Python otherwise.
+    Both keep sparse dataframes sparse.
+    It also adds the sums of the features over the coarse parent cells of every hexagon (see pyramid.py).
+    With a feature manifest only the needed sums are computed and only the kept columns are returned.
+    :param df: a dataframe of features indexed by hex_id
+    :param manifest: the feature manifest (see feature_selection.py), None for all features
+    :return: the dataframe with the _neighbour_count and _res{res} columns
+    """
+    columns = None if manifest is None else manifest['neighbours']
+    if os.path.exists(NEIGHBOURER_BIN):
+        retv = add_neighbour_features_binary(df, NEIGHBOURER_BIN, columns=columns)
+    else:
+        retv = add_neighbour_features(df, columns=columns)
+    # manifests saved before the context features existed do not use them
+    context = list(df.columns) if manifest is None else manifest.get('context', [])
+    retv = add_context_features(retv, CONTEXT_RES, columns=context)
+    if manifest is None:
+        return retv
+    return retv[[col for col in manifest['columns'] if col in retv.columns]]
+
+def attach_labels(features: pd.DataFrame, labels: pd.DataFrame, label_col: str = 'OHCA') -> pd.DataFrame:
+    """
+    This function sums the labels of every hex_id, so duplicate hex ids from different sources add up,
+    and joins them onto the features in one operation. Hexagons without labels get 0,
+    labels of hexagons without features are dropped.
+    :param features: a dataframe of features indexed by hex_id
+    :param labels: a dataframe with the label_col column indexed by hex_id, hex ids can repeat
+    :param label_col: the name of the label column
+    :return: the features with the label_col column
+    """
+    summed = labels[label_col].groupby(level=0).sum()
+    values = summed.reindex(features.index, fill_value=0).to_numpy(dtype=np.float32)
+    return features.assign(**{label_col: values})
+
+def align_columns(train_df: pd.DataFrame, target_dfs: dict[str, pd.DataFrame], label_col: str = 'OHCA',
+                  schema_path: str = FEATURE_SCHEMA_PATH) -> tuple[pd.DataFrame, dict[str, pd.DataFrame]]:
+    """
+    This function keeps only the feature columns of the training dataframe present in at least one target
+    dataframe, in the order of the training dataframe, and saves them as the feature schema.
+    Target dataframes get the same columns, the ones they do not have are 0.
+    :param train_df: the training dataframe with the label_col column
+    :param target_dfs: a dictionary city slug -> target dataframe
+    :param label_col: the name of the label column, kept as the last column of the training dataframe
+    :param schema_path: the path of the json file with the feature schema
+    :return: the aligned training dataframe and the dictionary of aligned target dataframes
+    """
+    target_cols = set().union(*(target_df.columns for target_df in target_dfs.values()))
+    columns = [col for col in train_df.columns if col in target_cols and col != label_col]
+    with open(schema_path, 'w') as f:
+        json.dump({'features': columns, 'label': label_col}, f)
+    return train_df[columns + [label_col]], {slug: reindex_columns(target_df, columns) for slug, target_df in target_dfs.items()}
+
+def hexid_ohca(df: pd.DataFrame, lat_col: str, lon_col: str, res: int = 9) -> pd.DataFrame:
+    """
+    This function takes a dataframe of OHCA incidents and returns a dataframe
+    with the uint64 hex_id as the index and the count
+    of OHCA incidents in the OHCA column.
     :param df: a dataframe of OHCA incidents
     :param lat_col: the name of the column with the latitude values
     :param lon_col: the name of the column with the longitude values
     :param res: the resolution of the hex_id
-    :return: a dictionary with the hex_id as the key and the count of OHCA incidents as the value
+    :return: a dataframe with the hex_id as the index and the count of OHCA incidents as the OHCA column
     """
-    # create a dictionary to hold the hex_id and the count of OHCA incidents
-    hexid_ohca_cnt = {}
-    for _, row in df.iterrows():
-        # get the hex_id for each row
-        hex_id = h3.latlng_to_cell(np.float64(row[lat_col]), np.float64(row[lon_col]), res)
-        # if the hex_id is not in the dictionary, add it
-        if hex_id not in hexid_ohca_cnt:
-            hexid_ohca_cnt[hex_id] = 0
-        # increment the count of OHCA in the hex_id
-        hexid_ohca_cnt[hex_id] += 1
-    
-    return hexid_ohca_cnt
-
-
-hexid_ohca_cnt = hexid_ohca(vb_ohca_in, 'Latitude', 'Longitude', 9)
-# create a dataframe from the dictionary with the hex_id as the index
-main_ohca_df = pd.DataFrame.from_dict(hexid_ohca_cnt, orient='index', columns=['OHCA'])
+    # index all incidents at once, unparsable coordinates become NaN and are skipped
+    lats = pd.to_numeric(df[lat_col], errors='coerce').to_numpy(dtype=np.float64)
+    lons = pd.to_numeric(df[lon_col], errors='coerce').to_numpy(dtype=np.float64)
+    cells, counts = count_cells(latlng_to_cells(lats, lons, res))
+    return pd.DataFrame({'OHCA': counts.astype(np.float32)}, index=pd.Index(cells, name='hex_id'))
+
+
+# create a dataframe with the hex_id as the index
+main_ohca_df = hexid_ohca(vb_ohca_in, 'Latitude', 'Longitude', 9)
 
 file_path = './data/mtgmry_unfiltered.csv'
 # check if montgomery data is in the data directory
-if 'mtgmry_unfiltered.csv' not in os.listdir('data'):
+if not os.path.exists(source_dir('montgomery')) and 'mtgmry_unfiltered.csv' not in os.listdir('data'):
     # download the montgomery data and save it to the data directory
     # set KAGGLE_USERNAME and KAGGLE_KEY environment variables {"username":"ardfessdx","key":"f2c9378c38080c30a3649d2abe658a0d"}
     # create a file in ~/.kaggle/kaggle.json with the username and key
@@ -72,101 +130,61 @@ if 'mtgmry_unfiltered.csv' not in os.listdir('data'):
     os.system('cd data && kaggle datasets download -d mchirico/montcoalert --unzip')
     # rename the file to mtgmry_unfiltered.csv
     os.system(f'mv ./data/911.csv {file_path}')
-mtgmry_ohca_df = pd.read_csv(file_path)
-
-# filter by 'title' containing 'CARDIAC ARREST'
-mtgmry_ohca_df = mtgmry_ohca_df[mtgmry_ohca_df['title'].str.contains('CARDIAC ARREST')]
-# timeStamp contatins 2017 2018 2019
-mtgmry_ohca_df = mtgmry_ohca_df[mtgmry_ohca_df['timeStamp'].str.contains('2016|2017|2018|2019')]
-# create a dictionary to hold the counts of OHCA in each hex_id
-hexid_ohca_cnt = hexid_ohca(mtgmry_ohca_df, 'lat', 'lng', 9)
-# multiply all of the values by 3/4
-for hex_id in hexid_ohca_cnt:
-    hexid_ohca_cnt[hex_id] = hexid_ohca_cnt[hex_id] * 3 / 4
-mtgmry_ohca_df = pd.DataFrame.from_dict(hexid_ohca_cnt, orient='index', columns=['OHCA'])
+# read the export in chunks into the incident store, only the first time (see incidents.py)
+ingest_csv('montgomery', file_path)
+# count OHCA from 2016 to 2019 in each hex_id and multiply all of the values by 3/4
+mtgmry_ohca_df = incident_counts('montgomery', [2016, 2017, 2018, 2019]) * 3 / 4
 # add the OHCA count to the main dataframe
 main_ohca_df = pd.concat([main_ohca_df, mtgmry_ohca_df], ignore_index=False, axis=0)
 
 
-# download and read cinncinati data
-url = "https://data.cincinnati-oh.gov/api/views/vnsz-a3wp/rows.csv?accessType=DOWNLOAD"
-response = requests.get(url)
-
-if response.status_code == 200:
-    cinncinati_ohca_df = pd.read_csv(io.StringIO(response.text))
-else:
-    print("Cincinnati data automatic download failed")
-    if 'Cincinnati_Fire_Incidents__CAD___including_EMS__ALS_BLS_.csv' in os.listdir('data'):
-        cinncinati_ohca_df = pd.read_csv('./data/Cincinnati_Fire_Incidents__CAD___including_EMS__ALS_BLS_.csv')
-    else:
-        raise FileNotFoundError("Could not automatically fetch the Cincinnati data. Please\
+# download the cinncinati data to disk and read it into the incident store, only the first time
+cincinnati_path = SOURCES['cincinnati']['path']
+if not os.path.exists(source_dir('cincinnati')):
+    try:
+        download(SOURCES['cincinnati']['url'], cincinnati_path)
+    except requests.RequestException:
+        print("Cincinnati data automatic download failed")
+        if not os.path.exists(cincinnati_path):
+            raise FileNotFoundError("Could not automatically fetch the Cincinnati data. Please\
                               download the data manually and place it in the data directory from:\
                               https://data.cincinnati-oh.gov/Safety/Cincinnati-Fire-Incidents-CAD-including-EMS-ALS-BL/vnsz-a3wp/data\
                               and put it in the data directory as Cincinnati_Fire_Incidents__CAD___including_EMS__ALS_BLS_.csv")
-
-# remove rows with NaN values in 'LATITUDE_X' or 'LONGITUDE_X'
-cinncinati_ohca_df.dropna(subset=['LATITUDE_X', 'LONGITUDE_X'], inplace=True)
-# filter by 'INCIDENT_TYPE_DESC' containing 'CARDIAC' and STROKE (CVA) / CFD_INCIDENT_TYPE_GROUP containing 'CARDIAC'
-# first fill the NaN values with empty strings
-cinncinati_ohca_df['INCIDENT_TYPE_DESC'].fillna('', inplace=True)
-cinncinati_ohca_df['CFD_INCIDENT_TYPE_GROUP'].fillna('', inplace=True)
-cinncinati_ohca_df = cinncinati_ohca_df[cinncinati_ohca_df['CFD_INCIDENT_TYPE_GROUP'].str.contains('CARDIAC')]
-# filter CREATE_TIME_INCIDENT containing 2017 2018 2019
-cinncinati_ohca_df = cinncinati_ohca_df[cinncinati_ohca_df['CREATE_TIME_INCIDENT'].str.contains('2017|2018|2019')]
-# create a dictionary to hold the counts of OHCA in each hex_id
-cincin_hex_ohca = hexid_ohca(cinncinati_ohca_df, 'LATITUDE_X', 'LONGITUDE_X', 9)
-# create a dataframe from the dictionary with the hex_id as the index
-cinncinati_ohca_df = pd.DataFrame.from_dict(cincin_hex_ohca, orient='index', columns=['OHCA'])
+    ingest_csv('cincinnati', cincinnati_path)
+# count OHCA from 2017 to 2019 in each hex_id, incidents of the 'CARDIAC' type group without coordinates are skipped
+cinncinati_ohca_df = incident_counts('cincinnati', [2017, 2018, 2019])
 # add the OHCA count to the main dataframe
 main_ohca_df = pd.concat([main_ohca_df, cinncinati_ohca_df], ignore_index=False, axis=0) # <- check this
 
-# Neighbourer
-os.system('./neighbourer/bin/main < ./data/osm_data.csv > ./data/osm_data_osm_neighbours.csv')
-os.system('./neighbourer/bin/main < ./data/warszawa_osm.csv > ./data/warszawa_osm_osm_neighbours.csv')
-
-# now read virginia_beach data
-main_hexagon_df = pd.read_csv('./data/osm_data_osm_neighbours.csv')
-# drop the unnamed columns
-main_hexagon_df.drop(columns=['Unnamed: 0'], inplace=True)
-# rename the columns by shifting them to the left
+# now read the training OSM data and add the sums of neighbouring hexagons
+# with a feature manifest only the columns the model uses are built
+manifest = load_manifest()
+main_hexagon_df = neighbour_features(read_table('./data/osm_data.parquet'), manifest)
 # print columns that sum to 0
 print(list(main_hexagon_df.columns))
 print(main_hexagon_df.head())
 # print the sums of the first 10 columns
 print(main_hexagon_df.iloc[:, 0:10].sum())
-# pivot the dataframe to have the hex_id as the index
-main_hexagon_df['OHCA'] = np.float32(0)
-
-# add the OHCA counts to the main DataFrame
-for hex_id, ohca in main_ohca_df.iterrows():
-    if hex_id in main_hexagon_df.index:
-        main_hexagon_df.loc[hex_id, 'OHCA'] = ohca['OHCA']
-
+# add the OHCA counts to the main DataFrame, counts of the same hex_id from different sources are summed
+main_hexagon_df = attach_labels(main_hexagon_df, main_ohca_df, 'OHCA')
 
-# Now for the target OSM data
 
-# read the csv file
-poland_df = pd.read_csv('./data/warszawa_osm_osm_neighbours.csv')
-# drop the unnamed columns
-poland_df.drop(columns=['Unnamed: 0'], inplace=True)
+# Now for the target OSM data of every registered city (see cities.py)
 
-# delete columns not in training data
-poland_cols = list(poland_df.columns)
-main_cols = list(main_hexagon_df.columns)
-for col in poland_cols:
-    if col not in main_cols:
-        del poland_df[col]
-# drop columns in main_hexagon_df that are not in poland_df
-for col in main_cols:
-    if col not in poland_cols and col != 'OHCA':
-        del main_hexagon_df[col]
+# read the parquet files and add the sums of neighbouring hexagons, the cities are built concurrently
+cities = load_cities()
+with concurrent.futures.ThreadPoolExecutor() as pool:
+    futures = {city.slug: pool.submit(lambda city: neighbour_features(read_table(features_path(city)), manifest), city)
+               for city in cities}
+    target_dfs = {slug: future.result() for slug, future in futures.items()}
 
-# fill NaN values with 0
-main_hexagon_df.fillna(0, inplace=True)
+# keep only the training columns present in the target tables, in the same order, and save them as the feature schema
+main_hexagon_df, target_dfs = align_columns(main_hexagon_df, target_dfs, 'OHCA')
 
 # delete rows with all columns equal to 0
-main_hexagon_df = main_hexagon_df[(main_hexagon_df.T != 0).any()]
-# save as main_hexagon_df.csv
-poland_df.to_csv('./data/target.csv')
-main_hexagon_df.to_csv('./data/main_hexagon_df.csv')
+main_hexagon_df = main_hexagon_df[nonzero_rows(main_hexagon_df)]
+# save as main_hexagon_df.parquet
+for city in cities:
+    write_table(target_dfs[city.slug], target_path(city))
+write_table(main_hexagon_df, './data/main_hexagon_df.parquet')
 
@@ -0,0 +1,101 @@
+"""
+This module summarizes the columns of a training table and measures how far a new table drifted from the
+table the current model was trained on. The summaries are saved next to the model.
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# largest drift of any column at which the current model is kept or warm-started
+DRIFT_THRESHOLD = 0.1
+# drift below which the current model is reused as it is
+REUSE_THRESHOLD = 0.01
+# a full AutoML search runs at least this often, whatever the drift
+FULL_RETRAIN_DAYS = 30
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def column_stats(df: pd.DataFrame) -> dict[str, dict[str, float]]:
+    """Summarize every column of a dense DataFrame: mean, standard deviation, fraction of non-zero values and quantiles.
+
+    Keyword arguments:
+
+    df -- dense DataFrame with numeric columns
+    """
+    values = df.to_numpy(dtype=np.float64)
+    means = values.mean(axis=0) if len(df) else np.zeros(len(df.columns))
+    stds = values.std(axis=0) if len(df) else np.zeros(len(df.columns))
+    nonzero = (values != 0).mean(axis=0) if len(df) else np.zeros(len(df.columns))
+    quantiles = np.quantile(values, QUANTILES, axis=0) if len(df) else np.zeros((len(QUANTILES), len(df.columns)))
+    retv = {}
+    for i, col in enumerate(df.columns):
+        retv[str(col)] = {'mean': float(means[i]), 'std': float(stds[i]), 'nonzero': float(nonzero[i])}
+        retv[str(col)].update({f'q{q:g}': float(quantiles[j, i]) for j, q in enumerate(QUANTILES)})
+    return retv
+
+
+def column_drift(old: dict[str, float], new: dict[str, float]) -> float:
+    """Measure the drift of one column: the largest of the mean shift in old standard deviations
+    and the changes of the fraction of non-zero values and of the quantiles relative to the old spread.
+
+    Keyword arguments:
+
+    old -- statistics of the column in the old table, from column_stats
+    new -- statistics of the column in the new table, from column_stats
+    """
+    scale = max(old['std'], 1e-9)
+    shifts = [abs(new['mean'] - old['mean']) / scale, abs(new['nonzero'] - old['nonzero'])]
+    shifts.extend(abs(new[key] - old[key]) / scale for key in old if key.startswith('q') and key in new)
+    return max(shifts)
+
+
+def table_drift(old_stats: dict[str, dict[str, float]], new_stats: dict[str, dict[str, float]]) -> dict[str, float]:
+    """Measure the drift of every column, columns present in only one of the tables have an infinite drift.
+
+    Keyword arguments:
+
+    old_stats -- statistics of the old table, from column_stats
+    new_stats -- statistics of the new table, from column_stats
+    """
+    retv = {}
+    for col in set(old_stats) | set(new_stats):
+        if col in old_stats and col in new_stats:
+            retv[col] = column_drift(old_stats[col], new_stats[col])
+        else:
+            retv[col] = float('inf')
+    return retv
+
+
+def stats_path(model_path: str) -> str:
+    return f"{model_path.rstrip('/')}.stats.json"
+
+
+def save_stats(model_path: str, stats: dict[str, dict[str, float]], rows: int, automl_at: str, trained_at: str) -> None:
+    """Save the statistics of the training table next to a model.
+
+    Keyword arguments:
+
+    model_path -- path of the saved model
+    stats -- statistics of the training table, from column_stats
+    rows -- number of rows of the training table
+    automl_at -- date of the AutoML search the model comes from
+    trained_at -- date the model was trained
+    """
+    with open(stats_path(model_path), 'w') as f:
+        json.dump({'rows': rows, 'automl_at': automl_at, 'trained_at': trained_at, 'columns': stats}, f)
+
+
+def load_stats(model_path: str) -> dict | None:
+    """Load the statistics saved next to a model, None if there are none.
+
+    Keyword arguments:
+
+    model_path -- path of the saved model
+    """
+    path = stats_path(model_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
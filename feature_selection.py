@@ -0,0 +1,140 @@
+"""
+This script ranks the model columns by permutation importance on a holdout of the training table and saves
+a manifest of the columns worth keeping. aquire_data.py, the neighbour sums and create_main_df.py read the
+manifest and skip the Overpass tags, geometries and columns no kept feature needs.
+
+Delete data/feature_manifest.json to go back to all features.
+"""
+
+import argparse
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+
+MANIFEST_PATH = './data/feature_manifest.json'
+IMPORTANCES_PATH = './data/feature_importances.csv'
+# the kept columns cover this fraction of the total importance
+CUMULATIVE_IMPORTANCE = 0.99
+MIN_FEATURES = 20
+# columns kept whatever their importance, hexagons with a hospital are covered in coverage.py and serve_results.py
+KEPT_COLUMNS = ['hospital']
+# suffixes added by the neighbour sums and by the outer join of the point, line and area tables
+NEIGHBOUR_SUFFIX = re.compile(r'(_neighbour_count|_ring\d+_count|_neighbour_weighted)$')
+# suffix of the sums over coarse parent cells, see pyramid.py
+CONTEXT_SUFFIX = re.compile(r'_res\d+$')
+JOIN_SUFFIX = re.compile(r'_[xy]$')
+
+
+def permutation_importance(predict, df: pd.DataFrame, target: str, columns: list[str] | None = None,
+                           seed: int = 1) -> pd.Series:
+    """Measure how much the root mean squared error grows when the values of a column are shuffled.
+
+    Keyword arguments:
+
+    predict -- function returning the predictions of a DataFrame
+    df -- dense holdout DataFrame with the target column
+    target -- name of the target column
+    columns -- columns to measure, the others get 0 (default all columns except the target)
+    seed -- seed of the shuffles (default 1)
+    """
+    rng = np.random.default_rng(seed)
+    y = df[target].to_numpy(dtype=np.float64)
+    features = df.drop(columns=[target])
+    baseline = np.sqrt(np.mean((predict(features) - y) ** 2))
+    retv = pd.Series(0.0, index=features.columns, name='importance')
+    for col in (features.columns if columns is None else columns):
+        shuffled = features.copy()
+        shuffled[col] = rng.permutation(shuffled[col].to_numpy())
+        retv[col] = np.sqrt(np.mean((predict(shuffled) - y) ** 2)) - baseline
+    return retv.sort_values(ascending=False)
+
+
+def select_features(importances: pd.Series, cumulative: float = CUMULATIVE_IMPORTANCE,
+                    min_features: int = MIN_FEATURES) -> list[str]:
+    """Select the most important columns that together cover a fraction of the total positive importance.
+
+    Keyword arguments:
+
+    importances -- importance of every column
+    cumulative -- fraction of the total importance to cover (default CUMULATIVE_IMPORTANCE)
+    min_features -- smallest number of selected columns (default MIN_FEATURES)
+    """
+    positive = importances.clip(lower=0).sort_values(ascending=False)
+    if positive.sum() == 0:
+        return list(positive.index[:min_features])
+    covered = positive.cumsum() / positive.sum()
+    # the column that crosses the threshold is kept too
+    n = int(np.searchsorted(covered.to_numpy(), cumulative) + 1)
+    return list(positive.index[:max(n, min_features)])
+
+
+def build_manifest(columns: list[str]) -> dict:
+    """Build the feature manifest of the kept model columns:
+
+    columns: the kept columns, neighbours: the base columns that need neighbour sums,
+    context: the base columns that need sums over parent cells,
+    tag_values: values of point and line tags that are needed, area_names: names of areas that are needed
+
+    Keyword arguments:
+
+    columns -- the kept model columns, KEPT_COLUMNS are added to them
+    """
+    columns = list(columns) + [col for col in KEPT_COLUMNS if col not in columns]
+    base = {NEIGHBOUR_SUFFIX.sub('', CONTEXT_SUFFIX.sub('', col)) for col in columns}
+    neighbours = {NEIGHBOUR_SUFFIX.sub('', col) for col in columns if NEIGHBOUR_SUFFIX.search(col)}
+    context = {CONTEXT_SUFFIX.sub('', col) for col in columns if CONTEXT_SUFFIX.search(col)}
+    names = {JOIN_SUFFIX.sub('', col) for col in base}
+    area_names = {name[len('area_'):] for name in names if name.startswith('area_')}
+    tag_values = {name for name in names if not name.startswith('area_')}
+    return {'columns': list(columns), 'neighbours': sorted(neighbours), 'context': sorted(context),
+            'tag_values': sorted(tag_values), 'area_names': sorted(area_names)}
+
+
+def save_manifest(manifest: dict, path: str = MANIFEST_PATH) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(path: str = MANIFEST_PATH) -> dict | None:
+    """Load the feature manifest, None if there is none and all features are used.
+
+    Keyword arguments:
+
+    path -- path of the manifest (default MANIFEST_PATH)
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    from artifacts import read_table
+    from sparse_features import to_dense
+    from tree_scorer import TreeScorer, trees_path
+
+    parser = argparse.ArgumentParser(description="Select the features worth keeping by permutation importance")
+    parser.add_argument('--cumulative', type=float, default=CUMULATIVE_IMPORTANCE, help="fraction of the total importance to keep")
+    parser.add_argument('--min-features', type=int, default=MIN_FEATURES, help="smallest number of kept columns")
+    parser.add_argument('--holdout', type=float, default=0.2, help="fraction of the training rows used for the importances")
+    args = parser.parse_args()
+
+    with open('model_path.txt', 'r') as f:
+        model_path = f.read().strip()
+    # scoring the exported trees needs no h2o, see tree_scorer.py
+    if not os.path.exists(trees_path(model_path)):
+        raise SystemExit(f"{model_path} has no exported trees, the importances need a GBM or DRF model whose trees match H2O")
+    scorer = TreeScorer(trees_path(model_path))
+    main_df = to_dense(read_table('./data/main_hexagon_df.parquet'))
+    holdout = main_df.sample(frac=args.holdout, random_state=1)
+    # columns that no tree splits on cannot change the predictions
+    used = sorted({scorer.columns[i] for i in np.unique(scorer.feature[scorer.feature >= 0])})
+    importances = permutation_importance(scorer.predict, holdout, 'OHCA', used)
+    importances.to_csv(IMPORTANCES_PATH)
+    kept = select_features(importances, args.cumulative, args.min_features)
+    save_manifest(build_manifest(kept))
+    print(f"Kept {len(kept)} of {len(importances)} columns")
@@ -0,0 +1,228 @@
+"""
+This module contains vectorized helpers for putting coordinates on the H3 hexagon grid
+"""
+
+import collections
+import threading
+import numpy as np
+import pandas as pd
+import h3
+import pyproj
+import shapely
+from h3.api import basic_int as h3_int
+
+# cell id used for coordinates that cannot be indexed
+H3_NULL = np.uint64(0)
+# lengths and areas are measured in web mercator, like in the rest of the pipeline
+transformer = pyproj.Transformer.from_proj(pyproj.Proj('EPSG:4326'), pyproj.Proj('EPSG:3857'))
+# number of geometries clipped at once, bounds the memory of the clipped pieces
+CLIP_CHUNK_SIZE = 100_000
+# number of projected cell polygons kept in memory, a res 9 cell takes about 1 kB
+CELL_POLYGON_CACHE_SIZE = 2 ** 18
+
+# least recently used cache of cell -> projected polygon
+_cell_polygon_cache = collections.OrderedDict()
+_cell_polygon_lock = threading.Lock()
+
+
+def latlng_to_cells(lats: np.ndarray, lons: np.ndarray, res: int = 9) -> np.ndarray:
+    """Get the H3 cells of arrays of coordinates as a uint64 array.
+    NaNs and coordinates out of range get the H3_NULL cell.
+
+    Keyword arguments:
+
+    lats -- array of latitudes
+    lons -- array of longitudes
+    res -- resolution of the hexagon grid (default 9)
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    cells = np.full(lats.shape, H3_NULL, dtype=np.uint64)
+    valid = np.isfinite(lats) & np.isfinite(lons) & (np.abs(lats) <= 90) & (np.abs(lons) <= 180)
+    if not valid.any():
+        return cells
+    # incidents and features repeat the same coordinates a lot, index every distinct point once
+    coords = np.column_stack((lats[valid], lons[valid]))
+    unique_coords, inverse = np.unique(coords, axis=0, return_inverse=True)
+    unique_cells = np.array([h3_int.latlng_to_cell(lat, lon, res) for lat, lon in unique_coords.tolist()],
+                            dtype=np.uint64)
+    cells[valid] = unique_cells[inverse.ravel()]
+    return cells
+
+
+def count_cells(cells: np.ndarray, weights: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """Count the occurrences of every cell, returns the unique cells and their counts.
+    H3_NULL cells are skipped.
+
+    Keyword arguments:
+
+    cells -- uint64 array of cells
+    weights -- weight of every occurrence, the counts are sums of weights if given (default None)
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    valid = cells != H3_NULL
+    unique_cells, inverse = np.unique(cells[valid], return_inverse=True)
+    if weights is None:
+        counts = np.bincount(inverse, minlength=len(unique_cells))
+    else:
+        counts = np.bincount(inverse, weights=np.asarray(weights)[valid], minlength=len(unique_cells))
+    return unique_cells, counts
+
+
+def cells_to_parent(cells: np.ndarray, res: int) -> np.ndarray:
+    """Get the parents of a uint64 array of cells at a coarser resolution with bit operations on the H3 index:
+    the resolution field is set to res and the digits of the finer resolutions to 7. H3_NULL stays H3_NULL.
+
+    Keyword arguments:
+
+    cells -- uint64 array of cells at resolution res or finer
+    res -- resolution of the parents
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    # bits 52-55 hold the resolution, then 15 digits of 3 bits follow with digit 1 at bits 42-44
+    retv = (cells & ~np.uint64(0xF << 52)) | np.uint64(res << 52)
+    retv |= np.uint64((1 << (3 * (15 - res))) - 1)
+    return np.where(cells == H3_NULL, H3_NULL, retv)
+
+
+def cells_to_str(cells: np.ndarray) -> np.ndarray:
+    """Convert a uint64 array of cells to an object array of hexadecimal cell strings.
+
+    Keyword arguments:
+
+    cells -- uint64 array of cells
+    """
+    unique_cells, inverse = np.unique(np.asarray(cells, dtype=np.uint64), return_inverse=True)
+    unique_str = np.array([h3.int_to_str(cell) for cell in unique_cells.tolist()], dtype=object)
+    return unique_str[inverse.ravel()]
+
+
+def index_to_cells(index: pd.Index) -> np.ndarray:
+    """Convert an index of hexagon ids (strings or integers) to a uint64 array of cells.
+
+    Keyword arguments:
+
+    index -- index of hexagon ids
+    """
+    if index.dtype == object:
+        return np.array([h3.str_to_int(hex_id) for hex_id in index], dtype=np.uint64)
+    return index.to_numpy(dtype=np.uint64)
+
+
+def cells_covering(lat_min: float, lat_max: float, lon_min: float, lon_max: float, res: int = 9) -> np.ndarray:
+    """Get all cells that overlap a bounding box as a sorted uint64 array.
+
+    Keyword arguments:
+
+    lat_min, lat_max, lon_min, lon_max -- bounding box
+    res -- resolution of the hexagon grid (default 9)
+    """
+    # a cell can overlap the box with its centre outside of it, so the box is grown by two edge lengths
+    margin_km = 2 * h3.average_hexagon_edge_length(res, unit='km')
+    lat_margin = margin_km / 111.0
+    max_abs_lat = min(max(abs(lat_min), abs(lat_max)) + lat_margin, 89.0)
+    lon_margin = margin_km / (111.0 * np.cos(np.radians(max_abs_lat)))
+    outer = [(lat_min - lat_margin, lon_min - lon_margin), (lat_min - lat_margin, lon_max + lon_margin),
+             (lat_max + lat_margin, lon_max + lon_margin), (lat_max + lat_margin, lon_min - lon_margin)]
+    cells = h3_int.polygon_to_cells(h3.Polygon(outer), res)
+    return np.sort(np.array(list(cells), dtype=np.uint64))
+
+
+def cell_polygons(cells: np.ndarray) -> np.ndarray:
+    """Get the boundaries of cells as an array of shapely polygons in EPSG:3857.
+    Polygons are kept in a least recently used cache of CELL_POLYGON_CACHE_SIZE cells.
+
+    Keyword arguments:
+
+    cells -- uint64 array of cells
+    """
+    cells = np.asarray(cells, dtype=np.uint64).tolist()
+    retv = np.empty(len(cells), dtype=object)
+    missing = []
+    with _cell_polygon_lock:
+        for i, cell in enumerate(cells):
+            polygon = _cell_polygon_cache.get(cell)
+            if polygon is None:
+                missing.append(i)
+            else:
+                _cell_polygon_cache.move_to_end(cell)
+                retv[i] = polygon
+    if not missing:
+        return retv
+    # project all missing cells at once
+    missing_cells = [cells[i] for i in missing]
+    polygons = _project_cells(missing_cells)
+    retv[missing] = polygons
+    with _cell_polygon_lock:
+        _cell_polygon_cache.update(zip(missing_cells, polygons))
+        while len(_cell_polygon_cache) > CELL_POLYGON_CACHE_SIZE:
+            _cell_polygon_cache.popitem(last=False)
+    return retv
+
+
+def _project_cells(cells: list[int]) -> np.ndarray:
+    boundaries = [h3_int.cell_to_boundary(cell) for cell in cells]
+    sizes = np.array([len(boundary) for boundary in boundaries], dtype=np.int64)
+    coords = np.array([point for boundary in boundaries for point in boundary], dtype=np.float64).reshape(-1, 2)
+    x, y = transformer.transform(coords[:, 0], coords[:, 1])
+    rings = shapely.linearrings(np.column_stack((x, y)), indices=np.repeat(np.arange(len(sizes)), sizes))
+    return shapely.polygons(rings)
+
+
+def polygons_from_coords(x: np.ndarray, y: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """Build polygons from flat coordinate arrays, returns an object array with None for degenerate rings.
+
+    Keyword arguments:
+
+    x, y -- coordinates of all rings one after another
+    sizes -- number of coordinates of every ring
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    retv = np.full(len(sizes), None, dtype=object)
+    if len(x) == 0:
+        return retv
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+    nonempty = sizes > 0
+    closed = np.zeros(len(sizes), dtype=bool)
+    closed[nonempty] = (x[starts[nonempty]] == x[ends[nonempty] - 1]) & (y[starts[nonempty]] == y[ends[nonempty] - 1])
+    # a ring needs at least 3 distinct points
+    ok = sizes - closed >= 3
+    if not ok.any():
+        return retv
+    coord_ok = np.repeat(ok, sizes)
+    rings = shapely.linearrings(np.column_stack((x[coord_ok], y[coord_ok])),
+                                indices=np.repeat(np.arange(ok.sum()), sizes[ok]))
+    # self-intersecting OSM polygons would make the intersections fail
+    retv[ok] = shapely.make_valid(shapely.polygons(rings))
+    return retv
+
+
+def apportion_to_cells(geometries: np.ndarray, cells: np.ndarray, measure=shapely.area) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Clip every geometry against every cell it overlaps and measure the pieces.
+
+    Returns three arrays: index of the geometry, cell and measure of the piece, only for pieces with a positive measure.
+
+    Keyword arguments:
+
+    geometries -- array of shapely geometries in EPSG:3857, None is skipped
+    cells -- uint64 array of candidate cells, for example from cells_covering
+    measure -- vectorized shapely function applied to the pieces (default shapely.area)
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    polygons = cell_polygons(cells)
+    tree = shapely.STRtree(polygons)
+    geom_idx, cell_idx, values = [], [], []
+    for start in range(0, len(geometries), CLIP_CHUNK_SIZE):
+        chunk = geometries[start:start + CLIP_CHUNK_SIZE]
+        chunk_idx, chunk_cell_idx = tree.query(chunk, predicate='intersects')
+        pieces = shapely.intersection(chunk[chunk_idx], polygons[chunk_cell_idx])
+        chunk_values = measure(pieces)
+        keep = chunk_values > 0
+        geom_idx.append(chunk_idx[keep] + start)
+        cell_idx.append(chunk_cell_idx[keep])
+        values.append(chunk_values[keep])
+    if not geom_idx:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.uint64), np.array([], dtype=np.float64)
+    cell_idx = np.concatenate(cell_idx)
+    return np.concatenate(geom_idx), cells[cell_idx], np.concatenate(values)
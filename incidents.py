@@ -0,0 +1,167 @@
+"""
+This module ingests large incident CSV exports into a Parquet incident store partitioned by source and year:
+
+data/incidents/source=<name>/year=<year>/part-<n>.parquet
+
+Exports are downloaded to disk with resume support and read in chunks of the needed columns only,
+every chunk is filtered and put on the hexagon grid as it arrives, so memory stays bounded whatever the
+size of the export. Sources already in the store are never downloaded or parsed again.
+"""
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import requests
+from hexgrid import latlng_to_cells, count_cells, H3_NULL
+
+STORE_DIR = './data/incidents'
+# rows of a raw export parsed at once
+CHUNK_SIZE = 500_000
+# bytes of a download written at once
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# column names and filters of the raw exports
+SOURCES = {
+    'montgomery': {
+        'path': './data/mtgmry_unfiltered.csv',
+        'lat': 'lat',
+        'lon': 'lng',
+        'time': 'timeStamp',
+        'filters': {'title': 'CARDIAC ARREST'},
+    },
+    'cincinnati': {
+        'url': 'https://data.cincinnati-oh.gov/api/views/vnsz-a3wp/rows.csv?accessType=DOWNLOAD',
+        'path': './data/Cincinnati_Fire_Incidents__CAD___including_EMS__ALS_BLS_.csv',
+        'lat': 'LATITUDE_X',
+        'lon': 'LONGITUDE_X',
+        'time': 'CREATE_TIME_INCIDENT',
+        'filters': {'CFD_INCIDENT_TYPE_GROUP': 'CARDIAC'},
+    },
+}
+
+
+def download(url: str, path: str, timeout: int = 60) -> str:
+    """Stream a file to disk. The data goes to path.part first, an interrupted download is resumed
+    with a Range request and the file is renamed to path when it is complete. Existing files are not downloaded again.
+
+    Keyword arguments:
+
+    url -- url of the file
+    path -- path of the downloaded file
+    timeout -- timeout of the connection in seconds (default 60)
+    """
+    if os.path.exists(path):
+        return path
+    part_path = f"{path}.part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:
+            # the part file already has the whole content
+            os.replace(part_path, path)
+            return path
+        response.raise_for_status()
+        # the server ignored the range, start over
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+    os.replace(part_path, path)
+    return path
+
+
+def source_dir(source: str, store_dir: str = STORE_DIR) -> str:
+    return os.path.join(store_dir, f'source={source}')
+
+
+def filter_chunk(chunk: pd.DataFrame, config: dict, res: int = 9) -> pd.DataFrame:
+    """Filter a chunk of a raw export and put it on the hexagon grid.
+    Returns a DataFrame with the uint64 hex_id and the year of every incident.
+
+    Keyword arguments:
+
+    chunk -- chunk of the raw export read as strings
+    config -- entry of SOURCES
+    res -- resolution of the hexagon grid (default 9)
+    """
+    keep = np.ones(len(chunk), dtype=bool)
+    for col, pattern in config['filters'].items():
+        keep &= chunk[col].fillna('').str.contains(pattern).to_numpy()
+    chunk = chunk[keep]
+    lats = pd.to_numeric(chunk[config['lat']], errors='coerce').to_numpy(dtype=np.float64)
+    lons = pd.to_numeric(chunk[config['lon']], errors='coerce').to_numpy(dtype=np.float64)
+    years = pd.to_numeric(chunk[config['time']].str.extract(r'(\d{4})', expand=False), errors='coerce')
+    cells = latlng_to_cells(lats, lons, res)
+    valid = (cells != H3_NULL) & years.notna().to_numpy()
+    return pd.DataFrame({'hex_id': cells[valid], 'year': years.to_numpy()[valid].astype(np.int16)})
+
+
+def ingest_csv(source: str, csv_path: str | None = None, store_dir: str = STORE_DIR, res: int = 9,
+               chunk_size: int = CHUNK_SIZE) -> str:
+    """Read a raw export in chunks and write the filtered incidents to the store.
+    The partition of the source is written to a temporary directory and moved into place when complete,
+    sources already in the store are skipped.
+
+    Keyword arguments:
+
+    source -- name of the source in SOURCES
+    csv_path -- path of the raw export (default the path in SOURCES)
+    store_dir -- directory of the incident store (default STORE_DIR)
+    res -- resolution of the hexagon grid (default 9)
+    chunk_size -- number of rows parsed at once (default CHUNK_SIZE)
+    """
+    config = SOURCES[source]
+    out_dir = source_dir(source, store_dir)
+    if os.path.exists(out_dir):
+        return out_dir
+    csv_path = csv_path or config['path']
+    # directories starting with _ are ignored by the dataset readers
+    tmp_dir = os.path.join(store_dir, f'_tmp_{source}')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    columns = [config['lat'], config['lon'], config['time']] + list(config['filters'])
+    reader = pd.read_csv(csv_path, usecols=columns, dtype=str, chunksize=chunk_size)
+    for i, chunk in enumerate(reader):
+        incidents = filter_chunk(chunk, config, res)
+        for year, group in incidents.groupby('year'):
+            year_dir = os.path.join(tmp_dir, f'year={year}')
+            os.makedirs(year_dir, exist_ok=True)
+            table = pa.table({'hex_id': pa.array(group['hex_id'].to_numpy(), type=pa.uint64())})
+            pq.write_table(table, os.path.join(year_dir, f'part-{i:05d}.parquet'))
+    os.makedirs(tmp_dir, exist_ok=True)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+def read_incidents(source: str, years: list[int] | None = None, store_dir: str = STORE_DIR) -> np.ndarray:
+    """Read the hex ids of the incidents of a source from the store as a uint64 array.
+
+    Keyword arguments:
+
+    source -- name of the source
+    years -- years to read, all if None (default None)
+    store_dir -- directory of the incident store (default STORE_DIR)
+    """
+    dataset = ds.dataset(source_dir(source, store_dir), format='parquet', partitioning='hive')
+    if dataset.count_rows() == 0:
+        return np.array([], dtype=np.uint64)
+    condition = None if years is None else ds.field('year').isin(years)
+    table = dataset.to_table(columns=['hex_id'], filter=condition)
+    return table.column('hex_id').to_numpy()
+
+
+def incident_counts(source: str, years: list[int] | None = None, store_dir: str = STORE_DIR) -> pd.DataFrame:
+    """Count the incidents of a source in every hexagon.
+    Returns a DataFrame with the OHCA column indexed by the uint64 hex_id.
+
+    Keyword arguments:
+
+    source -- name of the source
+    years -- years to count, all if None (default None)
+    store_dir -- directory of the incident store (default STORE_DIR)
+    """
+    cells, counts = count_cells(read_incidents(source, years, store_dir))
+    return pd.DataFrame({'OHCA': counts.astype(np.float32)}, index=pd.Index(cells, name='hex_id'))
@@ -0,0 +1,278 @@
+"""
+This script refreshes the target features and predictions incrementally: fresh OSM elements are compared
+with the previous snapshot by element id and version, and only the hexagons touched by changed elements
+and their neighbour ring are recomputed and scored again. Every registered city (see cities.py) has its own snapshot.
+
+The first run only records the snapshot, run the full pipeline before it.
+"""
+
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from h3.api import basic_int as h3_int
+from aquire_data import download_area_data, process_area_data, clip_lines, clip_areas, AREA_SELECTORS
+from artifacts import read_table, write_table
+from hexgrid import latlng_to_cells, cells_to_str, cells_to_parent, H3_NULL
+from neighbours import add_neighbour_features
+from feature_selection import load_manifest, CONTEXT_SUFFIX
+from pyramid import add_context_features, save_city_pyramid, CONTEXT_RES
+from tree_scorer import TreeScorer, trees_path
+from sparse_features import concat_rows, nonzero_rows, to_dense, to_csr, is_sparse, reindex_columns
+from cities import City, load_cities, features_path, target_path, predictions_path, results_path, save_results
+
+SNAPSHOT_DIR = './data/incremental'
+FEATURE_SCHEMA_PATH = './data/feature_schema.json'
+
+
+def element_versions(raw: dict) -> pd.Series:
+    """Get the version of every element in data returned by fetch, indexed by element id.
+
+    Keyword arguments:
+
+    raw -- dictionary returned by fetch
+    """
+    ids = [item['id'] for item in raw['points']] + [item['id'] for item in raw['lines']]
+    versions = [item['version'] for item in raw['points']] + [item['version'] for item in raw['lines']]
+    for selector in AREA_SELECTORS:
+        ids.extend(raw[selector]['id'])
+        versions.extend(raw[selector]['version'])
+    retv = pd.Series(np.array(versions, dtype=np.int64), index=pd.Index(ids, dtype=object, name='id'), name='version')
+    # an element is in one bucket per tag it has
+    return retv[~retv.index.duplicated()]
+
+
+def element_cells(raw: dict, hexagon_res: int = 9) -> pd.DataFrame:
+    """Get the cells every element adds to, as a DataFrame with the id and hex_id columns.
+
+    Keyword arguments:
+
+    raw -- dictionary returned by fetch
+    hexagon_res -- resolution of the hexagon grid (default 9)
+    """
+    points = raw['points']
+    lats = np.array([point['geometry'][0] for point in points], dtype=np.float64)
+    lons = np.array([point['geometry'][1] for point in points], dtype=np.float64)
+    ids = [np.array([point['id'] for point in points], dtype=object)]
+    cells = [latlng_to_cells(lats, lons, hexagon_res)]
+    line_idx, line_cells, _ = clip_lines(raw['lines'], hexagon_res)
+    ids.append(np.array([line['id'] for line in raw['lines']], dtype=object)[line_idx])
+    cells.append(line_cells)
+    for selector in AREA_SELECTORS:
+        geom_idx, area_cells, _ = clip_areas(raw[selector]['geometry'], hexagon_res)
+        ids.append(raw[selector]['id'].to_numpy(dtype=object)[geom_idx])
+        cells.append(area_cells)
+    retv = pd.DataFrame({'id': np.concatenate(ids), 'hex_id': np.concatenate(cells)})
+    return retv[retv['hex_id'] != H3_NULL].drop_duplicates(ignore_index=True)
+
+
+def subset(raw: dict, ids: set[str]) -> dict:
+    """Keep only the elements with the given ids in data returned by fetch.
+
+    Keyword arguments:
+
+    raw -- dictionary returned by fetch
+    ids -- ids of the elements to keep
+    """
+    retv = {'points': [point for point in raw['points'] if point['id'] in ids],
+            'lines': [line for line in raw['lines'] if line['id'] in ids]}
+    for selector in AREA_SELECTORS:
+        retv[selector] = raw[selector][raw[selector]['id'].isin(ids)].reset_index(drop=True)
+    return retv
+
+
+def grid_disk(cells: np.ndarray, k: int = 1) -> np.ndarray:
+    """Get the sorted unique cells within k steps of any of the cells.
+
+    Keyword arguments:
+
+    cells -- uint64 array of cells
+    k -- distance (default 1)
+    """
+    disk = [cell for center in np.unique(cells).tolist() for cell in h3_int.grid_disk(center, k)]
+    return np.unique(np.array(disk, dtype=np.uint64))
+
+
+def changed_cells(old_versions: pd.Series, new_versions: pd.Series, old_cells: pd.DataFrame,
+                  new_cells: pd.DataFrame) -> np.ndarray:
+    """Get the cells whose features change: the cells of added and deleted elements and the old and new cells
+    of elements with a new version.
+
+    Keyword arguments:
+
+    old_versions, new_versions -- versions of the elements indexed by element id, from element_versions
+    old_cells, new_cells -- cells of the elements, from element_cells
+    """
+    versions = pd.concat([old_versions.rename('old'), new_versions.rename('new')], axis=1)
+    changed = versions.index[versions['old'] != versions['new']]
+    cells = np.concatenate([old_cells.loc[old_cells['id'].isin(changed), 'hex_id'].to_numpy(dtype=np.uint64),
+                            new_cells.loc[new_cells['id'].isin(changed), 'hex_id'].to_numpy(dtype=np.uint64)])
+    return np.unique(cells)
+
+
+def replace_rows(df: pd.DataFrame, rows: np.ndarray, new_rows: pd.DataFrame) -> pd.DataFrame:
+    """Replace the rows of a DataFrame indexed by hex_id, rows missing from new_rows are removed.
+
+    Keyword arguments:
+
+    df -- DataFrame indexed by hex_id
+    rows -- uint64 array of the replaced hex ids
+    new_rows -- the new rows
+    """
+    kept = df[~np.isin(df.index.to_numpy(dtype=np.uint64), rows)]
+    if is_sparse(df):
+        retv = concat_rows([kept, new_rows])
+    else:
+        retv = pd.concat([kept, new_rows.reindex(columns=df.columns, fill_value=np.float32(0))])
+    return retv.iloc[np.argsort(retv.index.to_numpy(dtype=np.uint64), kind='stable')]
+
+
+def score(df: pd.DataFrame) -> np.ndarray:
+    """Predict the OHCA counts of the rows of a dense target DataFrame with the model in model_path.txt.
+
+    Keyword arguments:
+
+    df -- dense DataFrame with the columns of the feature schema
+    """
+    with open('model_path.txt', 'r') as f:
+        model_path = f.read().strip()
+    if os.path.exists(trees_path(model_path)):
+        return np.maximum(TreeScorer(trees_path(model_path)).predict(df), 0).astype(np.float32)
+    import h2o
+    h2o.init()
+    model = h2o.load_model(model_path)
+    predictions = model.predict(h2o.H2OFrame(df)).as_data_frame()['predict'].to_numpy()
+    h2o.cluster().shutdown()
+    return np.maximum(predictions, 0).astype(np.float32)
+
+
+def fetch(city: City, manifest: dict | None) -> dict:
+    """Download the elements of a city with their ids and versions, from the same source as the full run:
+    the .osm.pbf extract of the city if it has one, Overpass otherwise.
+
+    Keyword arguments:
+
+    city -- the registered city
+    manifest -- feature manifest, only the elements it needs are downloaded
+    """
+    if city.pbf_path is not None:
+        # the extract has to be replaced by a newer one for the refresh to see any changes
+        return download_area_data(city.area_name, pbf_path=city.pbf_path, manifest=manifest, meta=True)
+    # the current data are cached for the day they are downloaded, see aquire_data.overpass_query
+    return download_area_data(city.area_name, batched=True, manifest=manifest, meta=True)
+
+
+def check_features(city: City, raw: dict, manifest: dict | None) -> bool:
+    """Compare the features table of a city with the features computed from all of its elements at once,
+    like the full run does. True if both have the same rows, columns and values.
+
+    Keyword arguments:
+
+    city -- the registered city
+    raw -- the elements of the city, from fetch
+    manifest -- feature manifest
+    """
+    table = read_table(features_path(city)).sort_index()
+    full = process_area_data(raw, city.res, manifest)
+    full = full[nonzero_rows(full)].sort_index()
+    if set(map(str, table.columns)) != set(map(str, full.columns)) or not table.index.equals(full.index):
+        return False
+    return (to_csr(reindex_columns(table, list(full.columns))) != to_csr(full)).nnz == 0
+
+
+def refresh(city: City, snapshot_dir: str = SNAPSHOT_DIR) -> np.ndarray:
+    """Refresh the features, target rows and predictions of the hexagons of a city changed since its last snapshot.
+    Returns the uint64 array of the re-scored hexagons.
+
+    Keyword arguments:
+
+    city -- the registered city
+    snapshot_dir -- directory of the element snapshots of all cities (default SNAPSHOT_DIR)
+    """
+    hexagon_res = city.res
+    versions_path = os.path.join(snapshot_dir, city.slug, 'versions.parquet')
+    cells_path = os.path.join(snapshot_dir, city.slug, 'element_cells.parquet')
+    manifest = load_manifest()
+    raw = fetch(city, manifest)
+    new_versions = element_versions(raw)
+    if not os.path.exists(versions_path):
+        print("No snapshot yet, recording it")
+        save_snapshot(new_versions, element_cells(raw, hexagon_res), versions_path, cells_path)
+        return np.array([], dtype=np.uint64)
+
+    old_versions = pd.read_parquet(versions_path)['version']
+    old_cells = pd.read_parquet(cells_path)
+    # only the elements that are new or have a new version are clipped again
+    fresh_ids = set(new_versions.index[old_versions.reindex(new_versions.index).ne(new_versions)])
+    fresh_cells = element_cells(subset(raw, fresh_ids), hexagon_res)
+    dirty = changed_cells(old_versions, new_versions, old_cells, fresh_cells)
+    new_cells = pd.concat([old_cells[old_cells['id'].isin(new_versions.index) & ~old_cells['id'].isin(fresh_ids)],
+                           fresh_cells], ignore_index=True)
+    print(f"{len(fresh_ids)} changed elements, {len(dirty)} changed hexagons")
+    if len(dirty) == 0:
+        save_snapshot(new_versions, new_cells, versions_path, cells_path)
+        return dirty
+
+    # recompute the features of the dirty cells from all elements that add to them
+    touching = set(new_cells.loc[new_cells['hex_id'].isin(dirty), 'id'])
+    # the columns are named from all elements of the city, like in the full run
+    recomputed = process_area_data(subset(raw, touching), hexagon_res, manifest, full_raw=raw)
+    recomputed = recomputed[np.isin(recomputed.index.to_numpy(dtype=np.uint64), dirty)]
+    features = replace_rows(read_table(features_path(city)), dirty, recomputed[nonzero_rows(recomputed)])
+    write_table(features, features_path(city))
+
+    # the neighbour sums change within one ring of the dirty cells, the context sums in all children of their parents
+    rescored = grid_disk(dirty, 1)
+    cells = features.index.to_numpy(dtype=np.uint64)
+    for res in CONTEXT_RES:
+        siblings = cells[np.isin(cells_to_parent(cells, res), cells_to_parent(dirty, res))]
+        rescored = np.union1d(rescored, siblings)
+    # the neighbour sums of the re-scored cells need the ring after them
+    neighbourhood = features[np.isin(cells, grid_disk(rescored, 1))]
+    target_rows = add_neighbour_features(neighbourhood, columns=None if manifest is None else manifest['neighbours'])
+    target_rows = target_rows[np.isin(target_rows.index.to_numpy(dtype=np.uint64), rescored)]
+    # the context sums need all rows of the parents
+    context_columns = list(features.columns) if manifest is None else manifest.get('context', [])
+    context = add_context_features(features[[col for col in context_columns if col in features.columns]], CONTEXT_RES)
+    context = context[[col for col in context.columns if CONTEXT_SUFFIX.search(col)]]
+    context = context.iloc[np.searchsorted(cells, target_rows.index.to_numpy(dtype=np.uint64))]
+    with open(FEATURE_SCHEMA_PATH, 'r') as f:
+        schema = json.load(f)
+    # columns unknown to the model are dropped, missing ones are 0
+    target_rows = pd.concat([to_dense(target_rows), to_dense(context)], axis=1)
+    # rows are kept even if all their model columns are 0, like the target tables of the full run
+    target_rows = target_rows.reindex(columns=schema['features'], fill_value=np.float32(0))
+    write_table(replace_rows(read_table(target_path(city)), rescored, target_rows), target_path(city))
+
+    # score only the new rows and merge them into the predictions
+    predicted = target_rows.assign(OHCA=score(target_rows) if len(target_rows) else np.float32(0))
+    predictions = replace_rows(read_table(predictions_path(city)), rescored, predicted)
+    write_table(predictions, predictions_path(city))
+    results = dict(zip(cells_to_str(predictions.index.to_numpy()), to_dense(predictions[['OHCA']])['OHCA'].tolist()))
+    save_results(results, results_path(city))
+    # the coarser levels are served too, so they are rolled up again from the new predictions
+    save_city_pyramid(city, predictions)
+
+    save_snapshot(new_versions, new_cells, versions_path, cells_path)
+    return rescored
+
+
+def save_snapshot(versions: pd.Series, cells: pd.DataFrame, versions_path: str, cells_path: str) -> None:
+    os.makedirs(os.path.dirname(versions_path), exist_ok=True)
+    versions.to_frame().to_parquet(versions_path)
+    cells.to_parquet(cells_path, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the hexagons changed since the last snapshot of every city")
+    parser.add_argument('--check', action='store_true', help="compare the refreshed features with a full recompute")
+    args = parser.parse_args()
+    for city in load_cities():
+        rescored = refresh(city)
+        print(f"Re-scored {len(rescored)} hexagons in {city.area_name}")
+        if args.check:
+            # the elements are cached for the day, so this does not download them again
+            manifest = load_manifest()
+            if not check_features(city, fetch(city, manifest), manifest):
+                raise SystemExit(f"The refreshed features of {city.area_name} differ from a full recompute")
@@ -1,56 +1,56 @@
-# load h2o model and make predictions
-import h2o
+# load the model and make predictions for all registered cities at once
 import os
-import json
-import pandas as pd
-
-# initialize h2o
-h2o.init()
+import numpy as np
+from artifacts import read_table, write_table
+from hexgrid import cells_to_str
+from sparse_features import to_dense, concat_rows
+from tree_scorer import TreeScorer, trees_path, export_trees
+from cities import load_cities, target_path, predictions_path, results_path, save_results
 
 with open('model_path.txt', 'r') as f:
     model_path = f.read().strip()
 
-# load jar model
-saved_model = h2o.load_model(model_path)
-
-my_local_model = h2o.download_model(saved_model)
-
-my_uploaded_model = h2o.upload_model(my_local_model)
-
-
 target = 'OHCA'
+cities = load_cities()
 # Read the data
-main_df = pd.read_csv('./data/main_hexagon_df.csv')
-# read target csv
-target_df = pd.read_csv('./data/target.csv')
-# set index tame to hex_id
-input_data = target_df.copy()
-# make predictions
-# drop unnamed column
-input_data.drop('Unnamed: 0', axis=1, inplace=True)
-data = h2o.H2OFrame(input_data)
-predictions = my_uploaded_model.predict(data)
-# convert to pandas
-predictions = predictions.as_data_frame()
+# read the target tables of all cities, indexed by hex_id, and stack them so the model scores them in one pass
+city_dfs = [read_table(target_path(city)) for city in cities]
+target_df = to_dense(concat_rows(city_dfs))
+# rows of city i are offsets[i]:offsets[i + 1], neighbouring cities can share hexagons
+offsets = np.cumsum([0] + [len(city_df) for city_df in city_dfs])
+
+if os.path.exists(trees_path(model_path)):
+    # score the exported trees with numpy, without starting h2o
+    predictions = TreeScorer(trees_path(model_path)).predict(target_df)
+else:
+    import h2o
+    # initialize h2o once for all cities
+    h2o.init()
+    # load binary model
+    saved_model = h2o.load_model(model_path)
+    input_data = target_df.copy()
+    # make predictions
+    data = h2o.H2OFrame(input_data)
+    predictions = saved_model.predict(data)
+    # convert to pandas
+    predictions = predictions.as_data_frame()['predict'].to_numpy()
+    if saved_model.algo in ('gbm', 'drf'):
+        # the next runs score without h2o
+        export_trees(saved_model, trees_path(model_path), input_data)
+    # shutdown h2o
+    h2o.cluster().shutdown()
 
 # add predictions['predict'] to target_df
-target_df['OHCA'] = predictions['predict']
+target_df['OHCA'] = predictions
 # appyl np.maximum(0, x) to OHCA
-target_df['OHCA'] = target_df['OHCA'].apply(lambda x: max(0, x))
-# set unnamed to hex_id and set it as the index
-target_df.rename(columns={'Unnamed: 0': 'hex_id'}, inplace=True)
-target_df.set_index('hex_id', inplace=True)
-# save as csv
-target_df.to_csv('./data/predictions.csv')
-
-# create a {"hex_id": "OHCA"} dictionary
-predictions = target_df.to_dict()['OHCA']
-# check if the results folder exists
-if not os.path.exists('./results'):
-    os.makedirs('./results')
-# save predictions as json
-with open('./results/results.json', 'w') as f:
-    json.dump(predictions, f)
-# shutdown h2o
-h2o.cluster().shutdown()
-
+target_df['OHCA'] = np.maximum(target_df['OHCA'].to_numpy(dtype=np.float32), 0)
+
+for i, city in enumerate(cities):
+    city_df = target_df.iloc[offsets[i]:offsets[i + 1]]
+    # save as parquet
+    write_table(city_df, predictions_path(city))
+    # create a {"hex_id": "OHCA"} dictionary, hex ids are written as strings
+    city_predictions = dict(zip(cells_to_str(city_df.index.to_numpy()), city_df['OHCA'].tolist()))
+    # save predictions as json, published by rename while the results are served
+    save_results(city_predictions, results_path(city))
+    print(f"Predicted {len(city_df)} hexagons in {city.area_name}")
@@ -1,83 +1,186 @@
 #include <h3/h3api.h>
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
 #include <string>
 #include <unordered_map>
 #include <iostream>
 #include <vector>
 #include <omp.h>
 
-int main() {
+// Binary format used with --binary, all numbers little-endian:
+// char[4] magic "H3NB", uint64 rows, uint64 cols,
+// rows x uint64 hex ids, rows x cols float32 values (row-major)
+// The output has the same layout with 2 * cols columns: value, neighbour sum for every input column.
+static const char MAGIC[4] = {'H', '3', 'N', 'B'};
+
+struct Table {
+  std::vector<H3Index> ids;
+  std::vector<float> values;  // rows x cols, row-major
+  size_t cols = 0;
+};
+
+static bool read_csv(Table& table, std::vector<std::string>& headers) {
   // Read a csv file from stdin with structure:
   // hex_id,bar,school,restaurant,cafe...
   // 8a2a1072b59ffff,238,42389,12,538...
   // 8a2a1072b5bffff,432,0,23,482...
-  // add _neighbour_count that sum values of neighbours
-  
-  std::vector<std::string> headers;
-  std::unordered_map<H3Index, std::unordered_map<std::string, float>> hexes;
   std::string line;
-  std::getline(std::cin, line);
-  // split by comma
-  std::string delimiter = ",";
-  size_t pos = 0;
-  std::string token;
-  // skip the hex_id
-  token = line.substr(0, line.find(delimiter));
-  line.erase(0, line.find(delimiter) + delimiter.length());
-  // get the headers
-  while ((pos = line.find(delimiter)) != std::string::npos) {
-    token = line.substr(0, pos);
-    headers.push_back(token);
-    line.erase(0, pos + delimiter.length());
+  if (!std::getline(std::cin, line)) {
+    return false;
+  }
+  if (!line.empty() and line.back() == '\r') {
+    line.pop_back();
   }
-  headers.push_back(line);
+  // skip the hex_id, get the headers
+  size_t start = line.find(',');
+  while (start != std::string::npos) {
+    size_t end = line.find(',', start + 1);
+    headers.push_back(line.substr(start + 1, end == std::string::npos ? std::string::npos : end - start - 1));
+    start = end;
+  }
+  table.cols = headers.size();
 
-  // read the data
+  // read the data, every row must have a hex id and exactly one number per header
+  size_t line_number = 1;
   while (std::getline(std::cin, line)) {
-    // get the hex_id
-    token = line.substr(0, line.find(delimiter));
-    H3Index hex_id = std::stoull(token, nullptr, 16);
-    line.erase(0, line.find(delimiter) + delimiter.length());
-    // get the values
-    std::unordered_map<std::string, float> values;
-    while ((pos = line.find(delimiter)) != std::string::npos) {
-      token = line.substr(0, pos);
-      values[headers[values.size()]] = std::stof(token);
-      line.erase(0, pos + delimiter.length());
+    line_number++;
+    if (!line.empty() and line.back() == '\r') {
+      line.pop_back();
+    }
+    if (line.empty()) {
+      continue;
+    }
+    const char* pos = line.c_str();
+    char* end = nullptr;
+    const H3Index id = std::strtoull(pos, &end, 16);
+    bool valid = end != pos;
+    for (size_t c = 0; valid and c < table.cols; c++) {
+      // every value follows a comma and must not be empty
+      if (*end != ',') {
+        valid = false;
+        break;
+      }
+      pos = end + 1;
+      table.values.push_back(std::strtof(pos, &end));
+      valid = end != pos;
+    }
+    if (!valid or *end != '\0') {
+      std::cerr << "Malformed row on line " << line_number << ", expected a hex id and " << table.cols << " numbers\n";
+      return false;
+    }
+    table.ids.push_back(id);
+  }
+  return true;
+}
+
+static bool read_binary(Table& table) {
+  char magic[4];
+  uint64_t rows = 0, cols = 0;
+  if (std::fread(magic, 1, 4, stdin) != 4 || std::memcmp(magic, MAGIC, 4) != 0) {
+    return false;
+  }
+  if (std::fread(&rows, sizeof(rows), 1, stdin) != 1 || std::fread(&cols, sizeof(cols), 1, stdin) != 1) {
+    return false;
+  }
+  table.cols = cols;
+  table.ids.resize(rows);
+  table.values.resize(rows * cols);
+  return std::fread(table.ids.data(), sizeof(H3Index), rows, stdin) == rows &&
+         std::fread(table.values.data(), sizeof(float), rows * cols, stdin) == rows * cols;
+}
+
+// Sums the values of the 6 neighbours of every row, returns rows x (2 * cols) values: value, neighbour sum.
+static std::vector<float> neighbour_sums(const Table& table) {
+  const size_t rows = table.ids.size();
+  const size_t cols = table.cols;
+  std::unordered_map<H3Index, int64_t> row_of;
+  row_of.reserve(rows);
+  for (size_t i = 0; i < rows; i++) {
+    row_of[table.ids[i]] = static_cast<int64_t>(i);
+  }
+
+  // resolve the neighbours of every row to row indices once, -1 if missing
+  std::vector<int64_t> neighbour_rows(rows * 6, -1);
+  #pragma omp parallel for schedule(static)
+  for (size_t i = 0; i < rows; i++) {
+    H3Index neighbors[7] = {0};  // 6 neighbors + self
+    if (gridDisk(table.ids[i], 1, neighbors) != E_SUCCESS) {
+      continue;
+    }
+    size_t n = 0;
+    for (int j = 0; j < 7; j++) {
+      if (neighbors[j] == 0 or neighbors[j] == table.ids[i]) {
+        continue;
+      }
+      auto found = row_of.find(neighbors[j]);
+      if (found != row_of.end()) {
+        neighbour_rows[i * 6 + n++] = found->second;
+      }
     }
-    values[headers[values.size()]] = std::stof(line);
-    hexes[hex_id] = values;
   }
 
-  // add neighbour sums
-  #pragma omp parallel for
-  for (size_t i = 0; i < hexes.size(); i++) {
-    auto hex = hexes.begin();
-    std::advance(hex, i);
-    for (const auto& header : headers) {
-      H3Index neighbors[7]; // 6 neighbors + self
-      gridDisk(hex->first, 1, neighbors);
-      float sum = 0;
-      #pragma omp parallel for reduction(+:sum)
-      for (int j = 0; j < 7; j++) {
-        // check if neighbour is in the map
-        if (hexes.find(neighbors[j]) != hexes.end() and neighbors[j] != hex->first) {
-          sum += hexes[neighbors[j]][header];
-        }
+  // every thread writes only its own output rows
+  std::vector<float> out(rows * cols * 2, 0.0f);
+  #pragma omp parallel for schedule(static)
+  for (size_t i = 0; i < rows; i++) {
+    const float* row = &table.values[i * cols];
+    float* out_row = &out[i * cols * 2];
+    for (size_t c = 0; c < cols; c++) {
+      out_row[2 * c] = row[c];
+    }
+    for (size_t n = 0; n < 6; n++) {
+      const int64_t j = neighbour_rows[i * 6 + n];
+      if (j < 0) {
+        break;
+      }
+      const float* neighbour = &table.values[j * cols];
+      for (size_t c = 0; c < cols; c++) {
+        out_row[2 * c + 1] += neighbour[c];
       }
-      std::string neighbor_name = header + "_neighbour_count";
-      hexes[hex->first][neighbor_name] = sum;
     }
   }
+  return out;
+}
+
+int main(int argc, char** argv) {
+  // Without arguments reads a csv from stdin and writes a csv to stdout,
+  // with --binary uses the binary format described above on stdin and stdout.
+  // add _neighbour_count that sum values of neighbours
+  const bool binary = argc > 1 and std::string(argv[1]) == "--binary";
+  const uint16_t endianness = 1;
+  if (binary and *reinterpret_cast<const uint8_t*>(&endianness) != 1) {
+    std::cerr << "The binary format is only supported on little-endian machines\n";
+    return 1;
+  }
+
+  Table table;
+  std::vector<std::string> headers;
+  if (binary ? !read_binary(table) : !read_csv(table, headers)) {
+    std::cerr << "Could not read the input\n";
+    return 1;
+  }
+  const std::vector<float> out = neighbour_sums(table);
+  const size_t rows = table.ids.size();
+
+  if (binary) {
+    const uint64_t out_rows = rows, out_cols = table.cols * 2;
+    std::fwrite(MAGIC, 1, 4, stdout);
+    std::fwrite(&out_rows, sizeof(out_rows), 1, stdout);
+    std::fwrite(&out_cols, sizeof(out_cols), 1, stdout);
+    std::fwrite(table.ids.data(), sizeof(H3Index), rows, stdout);
+    std::fwrite(out.data(), sizeof(float), out.size(), stdout);
+    return std::fflush(stdout) == 0 ? 0 : 1;
+  }
 
   for (const auto& header : headers) {
     std::cout << "," << header << "," << header << "_neighbour_count";
   }
   std::cout << '\n';
-  for (const auto& hex : hexes) {
-    std::cout << std::hex << hex.first;
-    for (const auto& header : headers) {
-      std::cout << "," << hexes[hex.first][header];
-      std::cout << "," << hexes[hex.first][header + "_neighbour_count"];
+  for (size_t i = 0; i < rows; i++) {
+    std::cout << std::hex << table.ids[i] << std::dec;
+    for (size_t c = 0; c < table.cols * 2; c++) {
+      std::cout << "," << out[i * table.cols * 2 + c];
     }
     std::cout << '\n';
   }
@@ -0,0 +1,157 @@
+"""
+This module adds the summed values of neighbouring hexagons to hexagon features
+"""
+
+import subprocess
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from h3.api import basic_int as h3_int
+from hexgrid import index_to_cells
+from sparse_features import is_sparse, to_csr, from_csr
+
+# path of the compiled C++ neighbourer
+NEIGHBOURER_BIN = './neighbourer/bin/main'
+# header of the binary format of the neighbourer, see neighbourer/main.cpp
+NEIGHBOURER_MAGIC = b'H3NB'
+# columns densified and sent to the neighbourer at once, bounds the memory used for sparse DataFrames
+NEIGHBOURER_CHUNK_COLUMNS = 256
+
+
+def ring_adjacency(cells: np.ndarray, max_k: int = 1) -> list[scipy.sparse.csr_matrix]:
+    """Build sparse adjacency matrices of cells, the k-th matrix (counting from 1) has a 1 in row i, column j
+    when cell j lies exactly k steps from cell i. Cells missing from cells are skipped.
+
+    Keyword arguments:
+
+    cells -- uint64 array of cells
+    max_k -- largest ring distance (default 1)
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    n = len(cells)
+    order = np.argsort(cells)
+    sorted_cells = cells[order]
+    retv = []
+    for k in range(1, max_k + 1):
+        rings = [h3_int.grid_ring(cell, k) for cell in cells.tolist()]
+        ring_sizes = np.array([len(ring) for ring in rings], dtype=np.int64)
+        ring_cells = np.fromiter((cell for ring in rings for cell in ring), dtype=np.uint64, count=ring_sizes.sum())
+        rows = np.repeat(np.arange(n), ring_sizes)
+        # find the rows of the ring cells, once for all cells
+        pos = np.minimum(np.searchsorted(sorted_cells, ring_cells), max(n - 1, 0))
+        found = sorted_cells[pos] == ring_cells if n else np.zeros(0, dtype=bool)
+        cols = order[pos[found]]
+        data = np.ones(found.sum(), dtype=np.float32)
+        retv.append(scipy.sparse.csr_matrix((data, (rows[found], cols)), shape=(n, n)))
+    return retv
+
+
+def add_neighbour_features(df: pd.DataFrame, max_k: int = 1, decay: float | None = None,
+                           columns: list[str] | None = None) -> pd.DataFrame:
+    """Add the sums of the values of neighbouring hexagons to a DataFrame indexed by hexagon id.
+    Sparse DataFrames stay sparse.
+
+    For every column col the returned DataFrame has:
+
+    col -- the original value
+    col_neighbour_count -- sum over the 6 direct neighbours, like the neighbourer
+    col_ring{k}_count -- sum over the cells exactly k steps away, for k = 2..max_k
+    col_neighbour_weighted -- sum over rings 1..max_k weighted by decay ** k, only if decay is given
+
+    Keyword arguments:
+
+    df -- DataFrame with numeric features indexed by hexagon id
+    max_k -- largest ring distance (default 1)
+    decay -- weight multiplier per ring step for the weighted sum (default None)
+    columns -- columns that get the neighbour sums, the others are only copied (default all columns)
+    """
+    cells = index_to_cells(df.index)
+    rings = ring_adjacency(cells, max_k)
+    sparse = is_sparse(df)
+    values = to_csr(df) if sparse else df.to_numpy(dtype=np.float32)
+    summed = _column_positions(df, columns)
+    summed_values = values[:, summed]
+    # all columns at once: sparse adjacency times the feature matrix
+    ring_sums = [ring @ summed_values for ring in rings]
+    blocks = {'_neighbour_count': ring_sums[0]}
+    for k in range(2, max_k + 1):
+        blocks[f'_ring{k}_count'] = ring_sums[k - 1]
+    if decay is not None:
+        weighted = sum(decay ** k * ring for k, ring in enumerate(rings, start=1))
+        blocks['_neighbour_weighted'] = weighted @ summed_values
+    return _interleave(df, values, summed, blocks, sparse)
+
+
+def _column_positions(df: pd.DataFrame, columns: list[str] | None) -> np.ndarray:
+    if columns is None:
+        return np.arange(len(df.columns))
+    return np.flatnonzero(df.columns.isin(columns))
+
+
+def _interleave(df: pd.DataFrame, values, summed: np.ndarray, blocks: dict, sparse: bool) -> pd.DataFrame:
+    # interleave the columns like the neighbourer: col, col_neighbour_count, ...
+    summed_names = df.columns[summed]
+    names = [str(col) for col in df.columns]
+    for suffix in blocks:
+        names.extend(f'{col}{suffix}' for col in summed_names)
+    is_summed = np.zeros(len(df.columns), dtype=bool)
+    is_summed[summed] = True
+    columns = []
+    for col, has_sums in zip(df.columns, is_summed):
+        columns.append(str(col))
+        if has_sums:
+            columns.extend(f'{col}{suffix}' for suffix in blocks)
+    position = {name: i for i, name in enumerate(names)}
+    order = np.array([position[name] for name in columns], dtype=np.int64)
+    if sparse:
+        stacked = scipy.sparse.hstack([values] + list(blocks.values()), format='csr')
+        return from_csr(stacked[:, order], df.index, columns)
+    data = np.hstack([values] + [np.asarray(block) for block in blocks.values()])[:, order]
+    return pd.DataFrame(data, index=df.index, columns=columns)
+
+
+def add_neighbour_features_binary(df: pd.DataFrame, binary: str = NEIGHBOURER_BIN,
+                                  columns: list[str] | None = None,
+                                  chunk_columns: int = NEIGHBOURER_CHUNK_COLUMNS) -> pd.DataFrame:
+    """Add col_neighbour_count columns like add_neighbour_features with max_k=1, computed by the compiled
+    neighbourer in its binary mode: a little-endian uint64 hex id vector and a float32 matrix instead of csv.
+    The neighbourer only reads dense matrices, so the summed columns of sparse DataFrames are densified
+    chunk_columns at a time and the sums are made sparse again, sparse DataFrames stay sparse.
+
+    Keyword arguments:
+
+    df -- DataFrame with numeric features indexed by hexagon id
+    binary -- path of the compiled neighbourer (default NEIGHBOURER_BIN)
+    columns -- columns that get the neighbour sums, only these are sent to the neighbourer (default all columns)
+    chunk_columns -- number of columns sent to the neighbourer at once (default NEIGHBOURER_CHUNK_COLUMNS)
+    """
+    sparse = is_sparse(df)
+    values = to_csr(df) if sparse else df.to_numpy(dtype=np.float32)
+    summed = _column_positions(df, columns)
+    if len(summed) == 0:
+        return _interleave(df, values, summed, {}, sparse)
+    cells = index_to_cells(df.index)
+    sums = []
+    for start in range(0, len(summed), chunk_columns):
+        chunk = values[:, summed[start:start + chunk_columns]]
+        chunk_sums = _run_neighbourer(binary, cells, chunk.toarray() if sparse else chunk)
+        sums.append(scipy.sparse.csr_matrix(chunk_sums) if sparse else chunk_sums)
+    block = scipy.sparse.hstack(sums, format='csr') if sparse else np.hstack(sums)
+    return _interleave(df, values, summed, {'_neighbour_count': block}, sparse)
+
+
+def _run_neighbourer(binary: str, cells: np.ndarray, values: np.ndarray) -> np.ndarray:
+    # returns the neighbour sums of the columns of values
+    rows, cols = values.shape
+    header = NEIGHBOURER_MAGIC + np.array([rows, cols], dtype='<u8').tobytes()
+    payload = b''.join([header, cells.astype('<u8').tobytes(), np.ascontiguousarray(values, dtype='<f4').tobytes()])
+    result = subprocess.run([binary, '--binary'], input=payload, stdout=subprocess.PIPE, check=True)
+    out = result.stdout
+    if out[:4] != NEIGHBOURER_MAGIC:
+        raise ValueError(f"Unexpected output of {binary}")
+    out_rows, out_cols = np.frombuffer(out, dtype='<u8', count=2, offset=4)
+    if out_rows != rows or out_cols != 2 * cols:
+        raise ValueError(f"{binary} returned a {out_rows}x{out_cols} matrix for a {rows}x{cols} input")
+    # rows come back in the input order, every value is followed by its neighbour sum
+    out_values = np.frombuffer(out, dtype='<f4', offset=20 + 8 * rows).reshape(rows, 2 * cols)
+    return out_values[:, 1::2].astype(np.float32)
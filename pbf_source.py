@@ -0,0 +1,153 @@
+"""
+This module reads point, line and area data from a local OpenStreetMap .osm.pbf extract
+(for example a Geofabrik city or region file) instead of the Overpass API.
+
+It returns the same dictionary as aquire_data.get_batched_data. Only elements inside the area boundary are kept,
+they are tested while the extract streams by, so only the elements of the area are held in memory. When the boundary
+is looked up by name, the extract is read twice: once to find the boundary and once for the features.
+A historical snapshot file gives the features of its date.
+Needs the optional osmium package (pip install osmium).
+"""
+
+import numpy as np
+import pandas as pd
+import shapely
+
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+
+def _require_osmium() -> None:
+    if osmium is None:
+        raise ImportError("Reading .osm.pbf files needs the osmium package, install it with: pip install osmium")
+
+
+def area_boundary(pbf_path: str, area_name: str) -> shapely.Geometry:
+    """Find the boundary of an area in an extract as a shapely (multi)polygon in lon, lat.
+    The area is the administrative boundary named like the part of area_name before the first comma.
+
+    Keyword arguments:
+
+    pbf_path -- path of the .osm.pbf file
+    area_name -- name of the area, for example "Cincinnati, Ohio"
+    """
+    _require_osmium()
+    name = area_name.split(',')[0].strip()
+    factory = osmium.geom.WKBFactory()
+    boundaries = []
+
+    class BoundaryHandler(osmium.SimpleHandler):
+        def area(self, a):
+            if a.tags.get('boundary') == 'administrative' and a.tags.get('name') == name:
+                boundaries.append((int(a.tags.get('admin_level', '99')), shapely.from_wkb(factory.create_multipolygon(a))))
+
+    BoundaryHandler().apply_file(pbf_path, locations=True)
+    if not boundaries:
+        raise ValueError(f"No administrative boundary named {name} in {pbf_path}")
+    # the highest level boundary of that name, a city rather than a district named like it
+    return min(boundaries, key=lambda boundary: boundary[0])[1]
+
+
+def read_pbf(pbf_path: str, area_name: str | None = None, boundary: shapely.Geometry | None = None,
+             node_names: list[str] | None = None, line_name: str | None = None,
+             area_selectors: dict[str, list[str]] | None = None, meta: bool = False) -> dict:
+    """Read the point, line and area data of an area from an extract, returns a dictionary like
+    aquire_data.get_batched_data:
+
+    points: list of {'geometry': (lat, lon), 'type': value}, lines: list of {'geometry': [{'lat', 'lon'}, ...], 'type': value},
+    building, landuse, leisure: DataFrames with the name and geometry columns
+
+    Points inside the boundary and ways intersecting it are kept, like elements of an Overpass area.
+    Like in the Overpass responses, relations have no geometry and are skipped.
+    With meta every point, line and area also has the id ("n123", "w456", ...) and the version of its element.
+
+    Keyword arguments:
+
+    pbf_path -- path of the .osm.pbf file
+    area_name -- name of the area, its boundary is looked up in the extract if boundary is None (default None)
+    boundary -- boundary polygon in lon, lat, the whole extract if both it and area_name are None (default None)
+    node_names -- tags of the counted nodes (default aquire_data.NODE_NAMES)
+    line_name -- tag of the summed lines (default aquire_data.LINE_NAME)
+    area_selectors -- selectors of the areas and the tags their names are taken from (default aquire_data.AREA_SELECTORS)
+    meta -- add the element ids and versions (default False)
+    """
+    _require_osmium()
+    # imported here, aquire_data imports this module
+    from aquire_data import NODE_NAMES, LINE_NAME, AREA_SELECTORS, area_feature_name
+    node_names = NODE_NAMES if node_names is None else node_names
+    line_name = LINE_NAME if line_name is None else line_name
+    area_selectors = AREA_SELECTORS if area_selectors is None else area_selectors
+    if boundary is None and area_name is not None:
+        boundary = area_boundary(pbf_path, area_name)
+    keep_point, keep_way = _boundary_tests(boundary)
+
+    points = []
+    lines = []
+    areas = {selector: [] for selector in area_selectors}
+    way_keys = {line_name, *area_selectors}
+
+    class FeatureHandler(osmium.SimpleHandler):
+        def node(self, n):
+            if not n.tags or not n.location.valid():
+                return
+            if not any(node_name in n.tags for node_name in node_names) or not keep_point(n.location.lat, n.location.lon):
+                return
+            element_meta = {"id": f"n{n.id}", "version": n.version} if meta else {}
+            for node_name in node_names:
+                value = n.tags.get(node_name)
+                if value is not None:
+                    points.append({"geometry": (n.location.lat, n.location.lon), "type": value, **element_meta})
+
+        def way(self, w):
+            if not any(key in w.tags for key in way_keys):
+                return
+            geometry = [{'lat': node.location.lat, 'lon': node.location.lon} for node in w.nodes if node.location.valid()]
+            if len(geometry) < 2 or not keep_way(geometry):
+                return
+            tags = {tag.k: tag.v for tag in w.tags}
+            element_meta = {"id": f"w{w.id}", "version": w.version} if meta else {}
+            if line_name in tags:
+                lines.append({"geometry": geometry, "type": tags[line_name], **element_meta})
+            for selector, tags_to_look_for in area_selectors.items():
+                if selector in tags:
+                    areas[selector].append({"name": area_feature_name({'tags': tags}, tags_to_look_for), "geometry": geometry,
+                                            **element_meta})
+
+    FeatureHandler().apply_file(pbf_path, locations=True)
+
+    retv = {'points': points, 'lines': lines}
+    columns = ['name', 'geometry'] + (['id', 'version'] if meta else [])
+    for selector, area_list in areas.items():
+        retv[selector] = pd.DataFrame(area_list, columns=columns)
+    return retv
+
+
+def _boundary_tests(boundary: shapely.Geometry | None):
+    """Get the functions keep_point(lat, lon) and keep_way(geometry) that tell if a point lies inside the boundary
+    and if a way intersects it, everything is kept without a boundary.
+
+    Keyword arguments:
+
+    boundary -- boundary polygon in lon, lat or None
+    """
+    if boundary is None:
+        return (lambda lat, lon: True), (lambda geometry: True)
+    shapely.prepare(boundary)
+    min_lon, min_lat, max_lon, max_lat = boundary.bounds
+
+    def keep_point(lat: float, lon: float) -> bool:
+        # the bounds reject most elements of a large extract without a geometry test
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        return bool(shapely.intersects_xy(boundary, lon, lat))
+
+    def keep_way(geometry: list[dict]) -> bool:
+        coords = np.array([(point['lon'], point['lat']) for point in geometry], dtype=np.float64)
+        lons, lats = coords[:, 0], coords[:, 1]
+        if lons.max() < min_lon or lons.min() > max_lon or lats.max() < min_lat or lats.min() > max_lat:
+            return False
+        return bool(boundary.intersects(shapely.linestrings(coords)))
+
+    return keep_point, keep_way
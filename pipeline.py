@@ -0,0 +1,196 @@
+"""
+This script runs the pipeline stages as a small DAG: every stage declares the files it reads and writes,
+the stages run as soon as the stages producing their inputs are done, independent stages run concurrently.
+
+A stage is skipped when the content hashes of its inputs and outputs match the last run, so for example
+the model is not trained again when main_hexagon_df.parquet did not change. The timings of every run are
+appended to data/pipeline_timings.jsonl.
+"""
+
+import argparse
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from cities import load_cities, features_path, target_path, predictions_path, results_path
+from pyramid import PYRAMID_RES, TRAINING_PYRAMID_DIR, pyramid_path, pyramid_results_path
+from coverage import sites_path
+
+STATE_PATH = './data/pipeline_state.json'
+TIMINGS_PATH = './data/pipeline_timings.jsonl'
+# modules imported by the stage scripts, a change in any of them reruns the stages
+COMMON_INPUTS = ['hexgrid.py', 'artifacts.py', 'sparse_features.py', 'neighbours.py', 'feature_selection.py',
+                 'cities.py', 'cities.json', 'pyramid.py']
+# the target stages read and write the files of every registered city, see cities.py
+CITIES = load_cities()
+
+
+@dataclasses.dataclass
+class Stage:
+    name: str
+    command: list[str]
+    inputs: list[str]
+    outputs: list[str]
+    # stages reading data from outside the repository (APIs, downloads) always run,
+    # their unchanged outputs still let the following stages skip
+    always: bool = False
+
+
+# data/feature_manifest.json is written by hand with feature_selection.py, not by a stage, see the README
+STAGES = [
+    Stage('acquire_train', [sys.executable, 'aquire_data.py', '--areas', 'train'],
+          ['aquire_data.py', 'response_cache.py', 'pbf_source.py'],
+          ['data/osm_data.parquet'], always=True),
+    Stage('acquire_target', [sys.executable, 'aquire_data.py', '--areas', 'target'],
+          ['aquire_data.py', 'response_cache.py', 'pbf_source.py'],
+          [os.path.relpath(features_path(city)) for city in CITIES], always=True),
+    Stage('create_main_df', [sys.executable, 'create_main_df.py'],
+          ['create_main_df.py', 'incidents.py', 'data/osm_data.parquet']
+          + [os.path.relpath(features_path(city)) for city in CITIES],
+          ['data/main_hexagon_df.parquet', 'data/feature_schema.json']
+          + [os.path.relpath(target_path(city)) for city in CITIES]),
+    Stage('train_model', [sys.executable, 'train_model.py'],
+          ['train_model.py', 'tree_scorer.py', 'drift.py', 'data/main_hexagon_df.parquet'], ['model_path.txt']),
+    Stage('make_predictions', [sys.executable, 'make_predictions.py'],
+          ['make_predictions.py', 'tree_scorer.py', 'model_path.txt'] + [os.path.relpath(target_path(city)) for city in CITIES],
+          [os.path.relpath(predictions_path(city)) for city in CITIES]
+          + [os.path.relpath(results_path(city)) for city in CITIES]),
+    # the AEDs are downloaded again every run
+    Stage('coverage', [sys.executable, 'coverage.py', '--refresh'],
+          ['coverage.py'] + [os.path.relpath(predictions_path(city)) for city in CITIES],
+          [os.path.relpath(sites_path(city.slug)) for city in CITIES], always=True),
+    Stage('pyramid', [sys.executable, 'pyramid.py'],
+          ['data/main_hexagon_df.parquet'] + [os.path.relpath(predictions_path(city)) for city in CITIES],
+          [os.path.relpath(path(city, res)) for path in (pyramid_path, pyramid_results_path)
+           for city in CITIES for res in PYRAMID_RES]
+          + [os.path.relpath(os.path.join(TRAINING_PYRAMID_DIR, f'main_res{res}.parquet')) for res in PYRAMID_RES]),
+]
+
+
+def file_hash(path: str) -> str | None:
+    """Get the sha256 hash of the content of a file, None if it does not exist.
+
+    Keyword arguments:
+
+    path -- path of the file
+    """
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint(stage: Stage) -> str:
+    """Get the hash of the command and the contents of all inputs of a stage.
+
+    Keyword arguments:
+
+    stage -- the stage
+    """
+    digest = hashlib.sha256(json.dumps(stage.command[1:]).encode('utf-8'))
+    for path in sorted(set(stage.inputs + COMMON_INPUTS)):
+        digest.update(f'{path}:{file_hash(path)}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def dependencies(stages: list[Stage]) -> dict[str, set[str]]:
+    """Get the names of the stages every stage depends on: the stages writing its inputs.
+
+    Keyword arguments:
+
+    stages -- all stages
+    """
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    return {stage.name: {producers[path] for path in stage.inputs if path in producers} for stage in stages}
+
+
+def is_up_to_date(stage: Stage, state: dict) -> bool:
+    previous = state.get(stage.name)
+    if stage.always or previous is None or previous['fingerprint'] != fingerprint(stage):
+        return False
+    return all(file_hash(path) == previous['outputs'].get(path) for path in stage.outputs)
+
+
+def run_stage(stage: Stage) -> float:
+    start = time.time()
+    subprocess.run(stage.command, check=True)
+    return time.time() - start
+
+
+def run(stages: list[Stage] = STAGES, state_path: str = STATE_PATH, timings_path: str = TIMINGS_PATH,
+        max_workers: int = 2, force: bool = False) -> dict[str, dict]:
+    """Run the stages in dependency order, skipping the stages that are up to date.
+    Returns a dictionary stage name -> {'status': 'ran' or 'skipped', 'seconds': duration}.
+
+    Keyword arguments:
+
+    stages -- stages to run (default STAGES)
+    state_path -- file with the fingerprints of the last run (default STATE_PATH)
+    timings_path -- file the timings of the run are appended to (default TIMINGS_PATH)
+    max_workers -- number of stages running at once (default 2)
+    force -- run all stages (default False)
+    """
+    state = {}
+    if os.path.exists(state_path) and not force:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    by_name = {stage.name: stage for stage in stages}
+    waiting = dependencies(stages)
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+        while waiting or running:
+            # start every stage whose dependencies are done
+            ready = [name for name, deps in waiting.items() if deps <= results.keys()]
+            for name in ready:
+                del waiting[name]
+                stage = by_name[name]
+                # inputs are hashed only now, after the stages producing them finished
+                if is_up_to_date(stage, state):
+                    print(f"Skipping {name}, inputs unchanged")
+                    results[name] = {'status': 'skipped', 'seconds': 0.0}
+                    continue
+                print(f"Running {name}")
+                running[pool.submit(run_stage, stage)] = name
+            if not running:
+                if waiting and not ready:
+                    # nothing runs and nothing can start, the dependencies of the waiting stages form a cycle
+                    raise ValueError(f"Stages {', '.join(sorted(waiting))} can never run, their dependencies form a cycle")
+                continue
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                stage = by_name[name]
+                # a failed stage raises here, the state of the finished stages was already saved
+                seconds = future.result()
+                results[name] = {'status': 'ran', 'seconds': seconds}
+                state[name] = {'fingerprint': fingerprint(stage),
+                               'outputs': {path: file_hash(path) for path in stage.outputs}}
+                print(f"Finished {name} in {seconds:.1f} s")
+                save_state(state, state_path)
+    with open(timings_path, 'a') as f:
+        f.write(json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'stages': results}) + '\n')
+    return results
+
+
+def save_state(state: dict, state_path: str) -> None:
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline stages that are out of date")
+    parser.add_argument('--force', action='store_true', help="run all stages")
+    parser.add_argument('--workers', type=int, default=2, help="number of stages running at once")
+    args = parser.parse_args()
+    os.makedirs('data', exist_ok=True)
+    run(max_workers=args.workers, force=args.force)
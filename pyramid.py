@@ -0,0 +1,119 @@
+"""
+This script rolls the tables of the pipeline up to coarser H3 resolutions: the values of all children of a parent
+cell are summed, with the parents found by bit operations on the cell ids (see hexgrid.cells_to_parent).
+
+The predictions of every city are saved as a pyramid of tables and results files for serving and maps,
+the training table with its labels as a pyramid for analysis. create_main_df.py also joins sums over the
+coarse parents back onto the resolution 9 rows as context features, without any new acquisition.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from artifacts import read_table, write_table
+from cities import City, load_cities, predictions_path, save_results, CITIES_DIR, RESULTS_DIR
+from hexgrid import cells_to_parent, cells_to_str, index_to_cells
+from sparse_features import is_sparse, to_csr, from_csr, to_dense
+
+# resolutions of the saved pyramid
+PYRAMID_RES = [8, 7, 6, 5]
+# resolutions of the context features, a resolution 7 parent has 49 resolution 9 children
+CONTEXT_RES = [7]
+TRAINING_PYRAMID_DIR = './data/pyramid'
+
+
+def roll_up(df: pd.DataFrame, res: int) -> pd.DataFrame:
+    """Sum the rows of a DataFrame indexed by hex_id by their parent cells.
+    Returns a DataFrame indexed by the sorted parents, sparse if df is sparse.
+
+    Keyword arguments:
+
+    df -- DataFrame with numeric columns indexed by hex_id
+    res -- resolution of the parents
+    """
+    cells = index_to_cells(df.index)
+    parents, inverse = np.unique(cells_to_parent(cells, res), return_inverse=True)
+    # one row per parent with a 1 for every child, so the sums are a single sparse product
+    children = scipy.sparse.csr_matrix((np.ones(len(cells), dtype=np.float32), (inverse.ravel(), np.arange(len(cells)))),
+                                       shape=(len(parents), len(cells)))
+    matrix = children @ to_csr(df)
+    index = pd.Index(parents, name='hex_id')
+    if is_sparse(df):
+        return from_csr(matrix, index, list(df.columns))
+    return pd.DataFrame(matrix.toarray(), index=index, columns=df.columns)
+
+
+def context_name(col: str, res: int) -> str:
+    return f'{col}_res{res}'
+
+
+def add_context_features(df: pd.DataFrame, resolutions: list[int] = CONTEXT_RES,
+                         columns: list[str] | None = None) -> pd.DataFrame:
+    """Add the sums of the values of all rows with the same parent cell to a DataFrame indexed by hex_id.
+    For every column col and resolution res the returned sparse DataFrame has a col_res{res} column.
+
+    Keyword arguments:
+
+    df -- DataFrame with numeric features indexed by hex_id
+    resolutions -- resolutions of the parents (default CONTEXT_RES)
+    columns -- columns that get the context sums, the others are only copied (default all columns)
+    """
+    base = df if columns is None else df[[col for col in columns if col in df.columns]]
+    cells = index_to_cells(df.index)
+    blocks = [to_csr(df)]
+    names = [str(col) for col in df.columns]
+    for res in resolutions:
+        coarse = roll_up(base, res)
+        rows = np.searchsorted(coarse.index.to_numpy(dtype=np.uint64), cells_to_parent(cells, res))
+        blocks.append(to_csr(coarse)[rows])
+        names.extend(context_name(str(col), res) for col in base.columns)
+    return from_csr(scipy.sparse.hstack(blocks, format='csr', dtype=np.float32), df.index, names)
+
+
+def pyramid_path(city: City, res: int) -> str:
+    return os.path.join(CITIES_DIR, city.slug, 'pyramid', f'res{res}.parquet')
+
+
+def pyramid_results_path(city: City, res: int) -> str:
+    return os.path.join(RESULTS_DIR, city.slug, f'results_res{res}.json')
+
+
+def save_pyramid(df: pd.DataFrame, paths: dict[int, str]) -> None:
+    """Roll a table up to every resolution and save the levels.
+
+    Keyword arguments:
+
+    df -- DataFrame indexed by hex_id
+    paths -- dictionary resolution -> path of the level
+    """
+    for res, path in paths.items():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_table(roll_up(df, res), path)
+
+
+def save_city_pyramid(city: City, predictions: pd.DataFrame | None = None) -> None:
+    """Save the pyramid of the predictions of a city and the results files of its levels.
+
+    Keyword arguments:
+
+    city -- the registered city
+    predictions -- the predictions of the city (default read from predictions_path)
+    """
+    if predictions is None:
+        predictions = read_table(predictions_path(city))
+    save_pyramid(predictions, {res: pyramid_path(city, res) for res in PYRAMID_RES})
+    for res in PYRAMID_RES:
+        level = read_table(pyramid_path(city, res), ['OHCA'])
+        # the predicted OHCA count of a parent is the sum of the counts of its children
+        save_results(dict(zip(cells_to_str(level.index.to_numpy()), to_dense(level)['OHCA'].tolist())),
+                     pyramid_results_path(city, res))
+
+
+if __name__ == "__main__":
+    for city in load_cities():
+        save_city_pyramid(city)
+        print(f"Saved the pyramid of {city.area_name}")
+    # features and labels of the training areas
+    save_pyramid(read_table('./data/main_hexagon_df.parquet'),
+                 {res: os.path.join(TRAINING_PYRAMID_DIR, f'main_res{res}.parquet') for res in PYRAMID_RES})
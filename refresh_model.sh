@@ -4,11 +4,24 @@ MINUTES_IN_HOUR=60
 HOURS_IN_DAY=24
 DAYS_IN_WEEK=7
 SECONDS_IN_DAY=$((SECONDS_IN_MINUTE * MINUTES_IN_HOUR * HOURS_IN_DAY))
+# with --incremental only the changed hexagons are refreshed daily, the full pipeline runs once a week
+INCREMENTAL=false
+if [ "$1" == "--incremental" ]; then
+    INCREMENTAL=true
+fi
+DAY=0
 while true; do
-    python3 aquire_data.py
-    python3 create_main_df.py
-    python3 train_model.py
-    python3 make_predictions.py
+    if [ "$INCREMENTAL" == true ] && [ $((DAY % DAYS_IN_WEEK)) -ne 0 ]; then
+        python3 incremental.py
+    else
+        # runs only the stages whose inputs changed, see pipeline.py
+        python3 pipeline.py
+        if [ "$INCREMENTAL" == true ]; then
+            # record the snapshot the next incremental runs compare against
+            rm -rf ./data/incremental
+            python3 incremental.py
+        fi
+    fi
+    DAY=$((DAY + 1))
     sleep $((SECONDS_IN_DAY))
 done
-
@@ -0,0 +1,156 @@
+"""
+This module implements an on-disk, content-addressed cache for raw API responses (Overpass, Nominatim)
+"""
+
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+CACHE_DIR = './data/cache'
+# responses older than this are downloaded again
+CACHE_TTL = 7 * 24 * 60 * 60
+# least recently used responses are removed once the cache grows above this size
+CACHE_MAX_BYTES = 4 * 1024 ** 3
+# the directory is scanned again after this many writes to see the entries written by other processes
+CACHE_EVICT_EVERY = 100
+# eviction frees this fraction of max_bytes, so a full cache is not scanned again on the next write
+CACHE_EVICT_SLACK = 0.1
+
+
+class ResponseCache:
+    """Gzip-compressed response store keyed by the sha256 of the request contents.
+
+    The modification time of an entry is the time it was downloaded and is used for the TTL,
+    the access time is bumped on every hit and is used for size-based eviction.
+    The size of the cache is scanned on the first write and kept as a running total afterwards,
+    the directory is only scanned again when the total is above max_bytes or every evict_every writes.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, ttl: float = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES,
+                 evict_every: int = CACHE_EVICT_EVERY):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        # None until the directory has been scanned
+        self.size = None
+        self.writes = 0
+        self.lock = threading.Lock()
+        # held by the thread that scans the directory, the others keep writing meanwhile
+        self.scan_lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        """Create a cache key from the parts of a request.
+
+        Keyword arguments:
+
+        parts -- strings that identify the request (endpoint, query text, area, date...)
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(str(part).encode('utf-8'))
+            # separator, so that ('ab', 'c') and ('a', 'bc') differ
+            digest.update(b'\x1f')
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + '.json.gz')
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        # the directory is shared by threads and processes, another one may have removed the entry already
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> bytes | None:
+        """Return the raw response stored under key or None if it is missing or expired.
+
+        Keyword arguments:
+
+        key -- cache key created with ResponseCache.key
+        """
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        if now - stat.st_mtime > self.ttl:
+            self._remove(path)
+            return None
+        try:
+            with gzip.open(path, 'rb') as f:
+                data = f.read()
+            # mark as recently used, keep the download time
+            os.utime(path, (now, stat.st_mtime))
+        except FileNotFoundError: # evicted in the meantime
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """Store a raw response under key and evict old entries if the cache is too big.
+
+        Keyword arguments:
+
+        key -- cache key created with ResponseCache.key
+        data -- raw response body
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see a partial entry
+        # one temporary file per writer, threads of one process share the pid
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wb') as f:
+            f.write(data)
+        size = os.stat(tmp_path).st_size
+        try:
+            size -= os.stat(path).st_size
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.writes += 1
+            if self.size is not None:
+                self.size += size
+            scan = self.size is None or self.size > self.max_bytes or self.writes % self.evict_every == 0
+        if scan and self.scan_lock.acquire(blocking=False):
+            try:
+                self.evict()
+            finally:
+                self.scan_lock.release()
+
+    def evict(self) -> None:
+        """Remove expired entries and then the least recently used ones until the cache fits in max_bytes
+        with CACHE_EVICT_SLACK of it to spare."""
+        now = time.time()
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.json.gz'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if now - stat.st_mtime > self.ttl:
+                    self._remove(path)
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+                total += stat.st_size
+        # oldest access first
+        entries.sort()
+        limit = self.max_bytes * (1 - CACHE_EVICT_SLACK) if total > self.max_bytes else self.max_bytes
+        for _, size, path in entries:
+            if total <= limit:
+                break
+            self._remove(path)
+            total -= size
+        with self.lock:
+            self.size = total
@@ -1,16 +1,280 @@
+"""
+This script serves the results/<city>/results.json files of the registered cities from memory. Every file is
+read once and compressed with gzip and, when the optional brotli package is installed (pip install brotli),
+with brotli. The files are served with a strong ETag, so clients revalidate with 304 responses.
+
+The roll-ups of the predictions to coarser resolutions (see pyramid.py) are served the same way at
+/<city>/res/<res>, for zoomed-out maps. The predictions of every city are also indexed (see spatial_index.py), so clients can ask for one hexagon,
+a bounding box, the surroundings of a point or the riskiest hexagons without an AED instead of the whole city.
+
+A background thread checks the files every RELOAD_SECONDS and swaps in a new snapshot when a new file
+was published. make_predictions.py publishes by rename, so a snapshot is never read from a half-written file.
+"""
+
+import contextlib
+import dataclasses
+import gzip
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+import h3
 import fastapi
 import uvicorn
-from os import path
+from cities import City, load_cities, results_path, predictions_path
+from spatial_index import SpatialIndex, build_index
+from pyramid import PYRAMID_RES, pyramid_results_path
 
-# serve the /results/results.json file
-app = fastapi.FastAPI()
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-@app.get("/")
-async def read_results():
-    # check if the file exists
-    if not path.exists("results/results.json"):
+RELOAD_SECONDS = 5.0
+GZIP_LEVEL = 9
+# every snapshot is encoded once, so the slowest and smallest setting is used
+BROTLI_QUALITY = 11
+# content codings in order of preference, the first one the client accepts is sent
+ENCODINGS = ['br', 'gzip', 'identity']
+# limits of the query parameters
+MAX_RING_K = 50
+MAX_RADIUS_M = 20000.0
+MAX_TOP_K = 1000
+
+
+@dataclasses.dataclass(frozen=True)
+class Snapshot:
+    # (inode, modification time, size) of the file the snapshot was read from
+    stamp: tuple[int, int, int]
+    bodies: dict[str, bytes]
+    etags: dict[str, str]
+    # only the predictions at the resolution of the city are indexed
+    index: SpatialIndex | None
+
+
+def file_stamp(stat: os.stat_result) -> tuple[int, int, int]:
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def snapshot_path(city: City, res: int | None) -> str:
+    return results_path(city) if res is None else pyramid_results_path(city, res)
+
+
+def load_snapshot(city: City, res: int | None = None) -> Snapshot | None:
+    """Read a results file of a city and encode it with every available content coding,
+    None if there is no file. The results at the resolution of the city are also indexed.
+
+    Keyword arguments:
+
+    city -- the registered city
+    res -- resolution of the pyramid level, None for the results at the resolution of the city (default None)
+    """
+    try:
+        f = open(snapshot_path(city, res), 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        # the stamp of the open file matches its content even if a new file is renamed over it meanwhile
+        stamp = file_stamp(os.fstat(f.fileno()))
+        body = f.read()
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    bodies = {'identity': body, 'gzip': gzip.compress(body, GZIP_LEVEL, mtime=0)}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body, quality=BROTLI_QUALITY)
+    # the encoded representations differ, so each of them has its own strong etag
+    etags = {encoding: f'"{digest}"' if encoding == 'identity' else f'"{digest}-{encoding}"' for encoding in bodies}
+    # the predictions table is written before the results file, so it is at least as new
+    index = build_index(json.loads(body), predictions_path(city), city.res) if res is None else None
+    return Snapshot(stamp, bodies, etags, index)
+
+
+class ResultsCache:
+    """Snapshots of the results files, keyed by city slug and pyramid resolution, reloaded when a file changes.
+
+    Keyword arguments:
+
+    cities -- dictionary city slug -> registered city
+    resolutions -- resolutions of the pyramid levels (default PYRAMID_RES)
+    """
+
+    def __init__(self, cities: dict[str, City], resolutions: list[int] = PYRAMID_RES):
+        self.cities = cities
+        self.keys = [(slug, res) for slug in cities for res in [None] + list(resolutions)]
+        self.snapshots: dict[tuple[str, int | None], Snapshot] = {}
+        # stamps of the files that could not be loaded, they are not read again until they change
+        self.failed: dict[tuple[str, int | None], tuple[int, int, int]] = {}
+
+    def reload(self) -> None:
+        """Load the results files that are new or changed since their snapshot was taken."""
+        for slug, res in self.keys:
+            city = self.cities[slug]
+            path = snapshot_path(city, res)
+            try:
+                stamp = file_stamp(os.stat(path))
+            except OSError:
+                # the last snapshot is served until a new file appears
+                continue
+            if self.failed.get((slug, res)) == stamp:
+                continue
+            current = self.snapshots.get((slug, res))
+            if current is not None and current.stamp == stamp:
+                continue
+            try:
+                snapshot = load_snapshot(city, res)
+            except Exception as error:
+                # a broken file must not stop the watcher or the server, the last snapshot is served
+                # and the file is read again when it changes
+                print(f"Could not load {path}: {error!r}")
+                self.failed[(slug, res)] = stamp
+                continue
+            if snapshot is not None:
+                # replacing the entry is atomic, a request gets either the old or the new snapshot
+                self.snapshots[(slug, res)] = snapshot
+                print(f"Loaded {path}")
+
+    def watch(self, stop: threading.Event, interval: float = RELOAD_SECONDS) -> None:
+        while not stop.wait(interval):
+            self.reload()
+
+
+def choose_encoding(accept_encoding: str, available: dict[str, bytes]) -> str:
+    """Choose the content coding of a response from the Accept-Encoding header of the request.
+
+    Keyword arguments:
+
+    accept_encoding -- value of the Accept-Encoding header, '' if there is none
+    available -- the encoded bodies by content coding
+    """
+    weights = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name] = weight
+    for encoding in ENCODINGS:
+        # identity is acceptable unless it is refused explicitly
+        default = weights.get('*', 1.0 if encoding == 'identity' else 0.0)
+        if encoding in available and weights.get(encoding, default) > 0:
+            return encoding
+    return 'identity'
+
+
+def not_modified(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    # If-None-Match compares the etags weakly
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+cities = {city.slug: city for city in load_cities()}
+# the first city of the registry is served at /
+default_city = next(iter(cities))
+cache = ResultsCache(cities)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    cache.reload()
+    stop = threading.Event()
+    watcher = threading.Thread(target=cache.watch, args=(stop,), daemon=True)
+    watcher.start()
+    yield
+    stop.set()
+
+
+# serve the results/<city>/results.json files of the registered cities
+app = fastapi.FastAPI(lifespan=lifespan)
+
+
+def city_results(request: fastapi.Request, slug: str, res: int | None = None) -> fastapi.Response:
+    snapshot = cache.snapshots.get((slug, res))
+    if snapshot is None:
         return fastapi.responses.JSONResponse(status_code=503, content={"error": "Results are not ready yet or there was an error."})
-    return fastapi.responses.FileResponse("results/results.json")
+    encoding = choose_encoding(request.headers.get('accept-encoding', ''), snapshot.bodies)
+    headers = {'ETag': snapshot.etags[encoding], 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+    if not_modified(request.headers.get('if-none-match'), snapshot.etags[encoding]):
+        return fastapi.Response(status_code=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return fastapi.Response(content=snapshot.bodies[encoding], media_type='application/json', headers=headers)
+
+
+def city_index(slug: str) -> SpatialIndex:
+    if slug not in cities:
+        raise fastapi.HTTPException(status_code=404, detail=f"Unknown city {slug}.")
+    snapshot = cache.snapshots.get((slug, None))
+    if snapshot is None:
+        raise fastapi.HTTPException(status_code=503, detail="Results are not ready yet or there was an error.")
+    return snapshot.index
+
+
+@app.get("/")
+async def read_results(request: fastapi.Request):
+    return city_results(request, default_city)
+
+@app.get("/{city}")
+async def read_city_results(request: fastapi.Request, city: str):
+    if city not in cities:
+        return fastapi.responses.JSONResponse(status_code=404, content={"error": f"Unknown city {city}."})
+    return city_results(request, city)
+
+@app.get("/{city}/res/{res}")
+async def read_city_level(request: fastapi.Request, city: str, res: int):
+    if city not in cities:
+        return fastapi.responses.JSONResponse(status_code=404, content={"error": f"Unknown city {city}."})
+    if res == cities[city].res:
+        return city_results(request, city)
+    if res not in PYRAMID_RES:
+        return fastapi.responses.JSONResponse(status_code=404, content={"error": f"No results at resolution {res}."})
+    return city_results(request, city, res)
+
+@app.get("/{city}/hex/{hex_id}")
+async def read_hex(city: str, hex_id: str):
+    index = city_index(city)
+    if not h3.is_valid_cell(hex_id):
+        raise fastapi.HTTPException(status_code=400, detail=f"Invalid hex id {hex_id}.")
+    positions = index.lookup(np.array([h3.str_to_int(hex_id)], dtype=np.uint64))
+    if len(positions) == 0:
+        raise fastapi.HTTPException(status_code=404, detail=f"No prediction for {hex_id}.")
+    return index.to_dict(positions)
+
+@app.get("/{city}/bbox")
+async def read_bbox(city: str, lat_min: float = fastapi.Query(ge=-90, le=90), lat_max: float = fastapi.Query(ge=-90, le=90),
+                    lon_min: float = fastapi.Query(ge=-180, le=180), lon_max: float = fastapi.Query(ge=-180, le=180)):
+    if lat_min > lat_max or lon_min > lon_max:
+        raise fastapi.HTTPException(status_code=400, detail="The minimum of the bounding box is above its maximum.")
+    index = city_index(city)
+    # the box is clipped to the extent of the city, so a large box costs no more than the whole city
+    return index.to_dict(index.bbox(lat_min, lat_max, lon_min, lon_max))
+
+@app.get("/{city}/ring")
+async def read_ring(city: str, lat: float = fastapi.Query(ge=-90, le=90), lon: float = fastapi.Query(ge=-180, le=180),
+                    k: int = fastapi.Query(1, ge=0, le=MAX_RING_K)):
+    index = city_index(city)
+    return index.to_dict(index.ring(lat, lon, k))
+
+@app.get("/{city}/radius")
+async def read_radius(city: str, lat: float = fastapi.Query(ge=-90, le=90), lon: float = fastapi.Query(ge=-180, le=180),
+                      meters: float = fastapi.Query(gt=0, le=MAX_RADIUS_M)):
+    index = city_index(city)
+    return index.to_dict(index.radius(lat, lon, meters))
+
+@app.get("/{city}/top")
+async def read_top(city: str, k: int = fastapi.Query(10, ge=1, le=MAX_TOP_K)):
+    index = city_index(city)
+    # a list, so the order from the highest risk is kept
+    return [{'hex_id': hex_id, 'OHCA': risk} for hex_id, risk in index.to_dict(index.top(k)).items()]
 
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8080)
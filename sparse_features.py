@@ -0,0 +1,188 @@
+"""
+This module keeps the wide OSM feature tables sparse - pandas DataFrames with Sparse[float32, 0] columns
+built from scipy matrices - from the tag pivot to the model, where they are densified
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+
+def is_sparse(df: pd.DataFrame) -> bool:
+    """Check if all columns of a DataFrame are sparse.
+
+    Keyword arguments:
+
+    df -- DataFrame
+    """
+    return len(df.columns) > 0 and all(isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes)
+
+
+def from_csr(matrix: scipy.sparse.spmatrix, index: pd.Index, columns: list) -> pd.DataFrame:
+    """Create a DataFrame with Sparse[float32, 0] columns from a scipy matrix.
+
+    Keyword arguments:
+
+    matrix -- scipy sparse matrix
+    index -- index of the rows
+    columns -- names of the columns
+    """
+    return pd.DataFrame.sparse.from_spmatrix(scipy.sparse.csr_matrix(matrix, dtype=np.float32),
+                                             index=index, columns=columns)
+
+
+def to_csr(df: pd.DataFrame) -> scipy.sparse.csr_matrix:
+    """Convert all columns of a DataFrame, sparse or dense, to a float32 CSR matrix.
+
+    Keyword arguments:
+
+    df -- DataFrame with numeric columns
+    """
+    sparse_columns = np.array([isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes], dtype=bool)
+    if len(df.columns) == 0:
+        return scipy.sparse.csr_matrix((len(df), 0), dtype=np.float32)
+    if sparse_columns.all():
+        return df.sparse.to_coo().tocsr().astype(np.float32)
+    parts = []
+    if sparse_columns.any():
+        parts.append(df.loc[:, sparse_columns].sparse.to_coo())
+    parts.append(scipy.sparse.csr_matrix(df.loc[:, ~sparse_columns].to_numpy(dtype=np.float32)))
+    matrix = scipy.sparse.hstack(parts, format='csr', dtype=np.float32)
+    # back to the column order of df
+    order = np.argsort(np.concatenate([np.flatnonzero(sparse_columns), np.flatnonzero(~sparse_columns)]))
+    return matrix[:, order]
+
+
+def to_dense(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert a DataFrame to dense float32 columns, used only right before the model.
+
+    Keyword arguments:
+
+    df -- DataFrame with numeric columns
+    """
+    return pd.DataFrame(to_csr(df).toarray(), index=df.index, columns=df.columns)
+
+
+def pivot_sparse(hex_ids: np.ndarray, names: np.ndarray, values: np.ndarray | None = None) -> pd.DataFrame:
+    """Pivot (hex_id, name, value) records into a sparse DataFrame with one column per name, values of
+    the same hex_id and name are summed. The index are the sorted unique hex ids, the columns the sorted names.
+
+    Keyword arguments:
+
+    hex_ids -- uint64 array of cells
+    names -- array of feature names
+    values -- array of values, every record counts as 1 if None (default None)
+    """
+    hex_ids = np.asarray(hex_ids, dtype=np.uint64)
+    names = np.asarray(names, dtype=object)
+    if values is None:
+        values = np.ones(len(hex_ids), dtype=np.float32)
+    cells, rows = np.unique(hex_ids, return_inverse=True)
+    columns, cols = np.unique(names.astype(str), return_inverse=True)
+    # duplicate entries are summed by scipy
+    matrix = scipy.sparse.coo_matrix((np.asarray(values, dtype=np.float32), (rows.ravel(), cols.ravel())),
+                                     shape=(len(cells), len(columns)))
+    return from_csr(matrix, pd.Index(cells, name='hex_id'), list(columns))
+
+
+def join_names(columns: list[list[str]]) -> list[list[str]]:
+    """Get the names the columns of frames get in outer_join, returns one list of names per frame.
+    Like chained pd.merge, columns present on both sides get the _x and _y suffixes.
+
+    Keyword arguments:
+
+    columns -- column names of every frame
+    """
+    names = []
+    sizes = []
+    for frame_columns in columns:
+        new_names = [str(col) for col in frame_columns]
+        overlap = set(names) & set(new_names)
+        names = [f'{name}_x' if name in overlap else name for name in names]
+        new_names = [f'{name}_y' if name in overlap else name for name in new_names]
+        names.extend(new_names)
+        sizes.append(len(new_names))
+    ends = np.cumsum(sizes)
+    return [names[end - size:end] for size, end in zip(sizes, ends.tolist())]
+
+
+def outer_join(frames: list[pd.DataFrame], columns: list[list[str]] | None = None) -> pd.DataFrame:
+    """Outer join DataFrames indexed by hex_id into one sparse DataFrame, missing values are 0.
+    Like chained pd.merge, columns present on both sides get the _x and _y suffixes.
+
+    The suffixes depend on which columns the frames have. When the frames hold only some rows of larger tables,
+    pass the columns of the larger tables, so the joined columns are named like in the join of the larger tables.
+
+    Keyword arguments:
+
+    frames -- DataFrames indexed by hex_id
+    columns -- column names the suffixes are decided on, one list per frame (default the columns of the frames)
+    """
+    frame_columns = [[str(col) for col in frame.columns] for frame in frames]
+    if columns is not None:
+        # columns a frame has beyond the given ones are named as if they were given too
+        frame_columns = [list(given) + [col for col in own if col not in set(given)]
+                         for given, own in zip(columns, frame_columns)]
+    renames = [dict(zip(names, joined)) for names, joined in zip(frame_columns, join_names(frame_columns))]
+    index = np.unique(np.concatenate([np.asarray(frame.index, dtype=np.uint64) for frame in frames]))
+    names = []
+    blocks = []
+    for frame, rename in zip(frames, renames):
+        new_names = [rename[str(col)] for col in frame.columns]
+        rows = np.searchsorted(index, np.asarray(frame.index, dtype=np.uint64))
+        coo = to_csr(frame).tocoo()
+        blocks.append(scipy.sparse.coo_matrix((coo.data, (rows[coo.row], coo.col)), shape=(len(index), len(new_names))))
+        names.extend(new_names)
+    matrix = scipy.sparse.hstack(blocks, format='csr', dtype=np.float32)
+    return from_csr(matrix, pd.Index(index, name='hex_id'), names)
+
+
+def concat_rows(frames: list[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate the rows of DataFrames into one sparse DataFrame with the union of their columns,
+    missing values are 0.
+
+    Keyword arguments:
+
+    frames -- DataFrames indexed by hex_id
+    """
+    positions = {}
+    for frame in frames:
+        for col in frame.columns:
+            positions.setdefault(str(col), len(positions))
+    blocks = []
+    for frame in frames:
+        coo = to_csr(frame).tocoo()
+        cols = np.array([positions[str(col)] for col in frame.columns], dtype=np.int64)
+        blocks.append(scipy.sparse.coo_matrix((coo.data, (coo.row, cols[coo.col])), shape=(len(frame), len(positions))))
+    matrix = scipy.sparse.vstack(blocks, format='csr', dtype=np.float32)
+    index = pd.Index(np.concatenate([np.asarray(frame.index, dtype=np.uint64) for frame in frames]), name='hex_id')
+    return from_csr(matrix, index, list(positions))
+
+
+def reindex_columns(df: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    """Select columns of a DataFrame into a sparse DataFrame, columns it does not have are 0.
+
+    Keyword arguments:
+
+    df -- DataFrame indexed by hex_id
+    columns -- names of the columns, in order
+    """
+    positions = {col: i for i, col in enumerate(columns)}
+    coo = to_csr(df).tocoo()
+    cols = np.array([positions.get(str(col), -1) for col in df.columns], dtype=np.int64)
+    keep = cols[coo.col] >= 0
+    matrix = scipy.sparse.coo_matrix((coo.data[keep], (coo.row[keep], cols[coo.col[keep]])),
+                                     shape=(len(df), len(columns)))
+    return from_csr(matrix, df.index, list(columns))
+
+
+def nonzero_rows(df: pd.DataFrame) -> np.ndarray:
+    """Get a boolean mask of the rows that have at least one non-zero value.
+
+    Keyword arguments:
+
+    df -- DataFrame with numeric columns
+    """
+    matrix = to_csr(df)
+    matrix.eliminate_zeros()
+    return np.diff(matrix.indptr) > 0
@@ -0,0 +1,184 @@
+"""
+This module indexes the predictions of a city for the spatial queries of serve_results.py. The hexagons are kept
+as sorted uint64 H3 keys, in which the children of a coarse parent cell form one contiguous slice - a bucket.
+Every query is answered with binary searches over the keys or the buckets, without scanning the whole city.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from h3.api import basic_int as h3_int
+from artifacts import read_schema, read_table
+from hexgrid import latlng_to_cells, cells_to_parent, cells_covering, cells_to_str, index_to_cells
+from sparse_features import to_dense
+from coverage import AED_PATH, COVERAGE_K, aed_reach, load_aeds
+
+# resolution of the buckets, a resolution 6 cell has 343 resolution 9 children
+PARENT_RES = 6
+EARTH_RADIUS_M = 6371008.8
+# the rings of the radius queries are sized with this fraction of the shortest edge of the cell of the point,
+# the cells shrink away from it
+RADIUS_EDGE_MARGIN = 0.9
+
+
+def _search(sorted_keys: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """Get the positions of keys in a sorted array, keys that are not in it are skipped."""
+    if len(sorted_keys) == 0:
+        return np.array([], dtype=np.int64)
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return positions[sorted_keys[positions] == keys]
+
+
+class SpatialIndex:
+    """Index of the predicted hexagons of a city.
+
+    Keyword arguments:
+
+    cells -- uint64 array of the hexagons
+    risk -- predicted OHCA count of every hexagon
+    covered -- boolean array, True for hexagons covered by an AED or with a hospital (see coverage.py)
+    res -- resolution of the hexagons
+    parent_res -- resolution of the buckets (default PARENT_RES)
+    """
+
+    def __init__(self, cells: np.ndarray, risk: np.ndarray, covered: np.ndarray, res: int, parent_res: int = PARENT_RES):
+        cells = np.asarray(cells, dtype=np.uint64)
+        order = np.argsort(cells, kind='stable')
+        self.cells = cells[order]
+        self.risk = np.asarray(risk, dtype=np.float32)[order]
+        self.covered = np.asarray(covered, dtype=bool)[order]
+        self.res = res
+        self.parent_res = min(parent_res, res)
+        self.hex_ids = cells_to_str(self.cells)
+        centres = np.array([h3_int.cell_to_latlng(cell) for cell in self.cells.tolist()], dtype=np.float64).reshape(-1, 2)
+        self.lats = centres[:, 0]
+        self.lons = centres[:, 1]
+        # extent of the centres, empty for an empty index
+        self.lat_range = (self.lats.min(), self.lats.max()) if len(self.cells) else (np.inf, -np.inf)
+        self.lon_range = (self.lons.min(), self.lons.max()) if len(self.cells) else (np.inf, -np.inf)
+        # the parents of sorted cells are sorted too, so every parent owns the slice between its first and the next one
+        parents = cells_to_parent(self.cells, self.parent_res)
+        self.bucket_parents, starts = np.unique(parents, return_index=True)
+        self.bucket_starts = starts.astype(np.int64)
+        self.bucket_ends = np.append(self.bucket_starts[1:], len(self.cells))
+        # positions of the hexagons without an AED, from the highest predicted risk
+        uncovered = np.flatnonzero(~self.covered)
+        self.risk_order = uncovered[np.argsort(-self.risk[uncovered], kind='stable')]
+
+    def lookup(self, cells: np.ndarray) -> np.ndarray:
+        """Get the sorted positions of the indexed hexagons among cells, cells that are not indexed are skipped.
+
+        Keyword arguments:
+
+        cells -- uint64 array of cells
+        """
+        return _search(self.cells, np.unique(np.asarray(cells, dtype=np.uint64)))
+
+    def bbox(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float) -> np.ndarray:
+        """Get the positions of the hexagons with the centre inside a bounding box.
+
+        Keyword arguments:
+
+        lat_min, lat_max, lon_min, lon_max -- bounding box
+        """
+        # every centre lies inside the extent of the index, so only that part of the box is covered
+        lat_min, lat_max = max(lat_min, self.lat_range[0]), min(lat_max, self.lat_range[1])
+        lon_min, lon_max = max(lon_min, self.lon_range[0]), min(lon_max, self.lon_range[1])
+        if lat_min > lat_max or lon_min > lon_max:
+            return np.array([], dtype=np.int64)
+        buckets = _search(self.bucket_parents, cells_covering(lat_min, lat_max, lon_min, lon_max, self.parent_res))
+        if len(buckets) == 0:
+            return np.array([], dtype=np.int64)
+        positions = np.concatenate([np.arange(self.bucket_starts[b], self.bucket_ends[b]) for b in buckets.tolist()])
+        inside = ((self.lats[positions] >= lat_min) & (self.lats[positions] <= lat_max) &
+                  (self.lons[positions] >= lon_min) & (self.lons[positions] <= lon_max))
+        return np.sort(positions[inside])
+
+    def ring(self, lat: float, lon: float, k: int) -> np.ndarray:
+        """Get the positions of the hexagons within k steps of the hexagon of a point.
+
+        Keyword arguments:
+
+        lat, lon -- the point
+        k -- distance in hexagons
+        """
+        origin = int(latlng_to_cells(np.array([lat]), np.array([lon]), self.res)[0])
+        if origin == 0:
+            return np.array([], dtype=np.int64)
+        return self.lookup(np.array(list(h3_int.grid_disk(origin, k)), dtype=np.uint64))
+
+    def radius(self, lat: float, lon: float, meters: float) -> np.ndarray:
+        """Get the positions of the hexagons with the centre within a distance of a point.
+
+        Keyword arguments:
+
+        lat, lon -- the point
+        meters -- the distance in meters
+        """
+        origin = int(latlng_to_cells(np.array([lat]), np.array([lon]), self.res)[0])
+        if origin == 0:
+            return np.array([], dtype=np.int64)
+        # the closest centres of ring k + 1 are (k + 1) * 1.5 edge lengths from the centre of ring 0,
+        # one more ring covers the point lying up to one edge length from that centre
+        edge = RADIUS_EDGE_MARGIN * min(h3_int.edge_length(edge, unit='m') for edge in h3_int.origin_to_directed_edges(origin))
+        positions = self.ring(lat, lon, int(np.ceil(meters / (1.5 * edge))) + 1)
+        lat1, lon1 = np.radians(lat), np.radians(lon)
+        lat2, lon2 = np.radians(self.lats[positions]), np.radians(self.lons[positions])
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        distances = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+        return positions[distances <= meters]
+
+    def top(self, k: int) -> np.ndarray:
+        """Get the positions of the k hexagons without an AED with the highest predicted risk, in that order.
+
+        Keyword arguments:
+
+        k -- number of hexagons
+        """
+        return self.risk_order[:k]
+
+    def to_dict(self, positions: np.ndarray) -> dict[str, float]:
+        """Get the {"hex_id": OHCA} dictionary of hexagons, like results.json.
+
+        Keyword arguments:
+
+        positions -- positions of the hexagons, in the order of the dictionary
+        """
+        return dict(zip(self.hex_ids[positions].tolist(), self.risk[positions].tolist()))
+
+
+def covered_cells(predictions_path: str, cells: np.ndarray, res: int, aed_path: str = AED_PATH) -> np.ndarray:
+    """Get a boolean array, True for the cells within COVERAGE_K steps of an AED or with a hospital,
+    like the covered hexagons of coverage.py. The AEDs are read from the file downloaded by coverage.py,
+    without it only the hospitals count.
+
+    Keyword arguments:
+
+    predictions_path -- path of the predictions table of the city
+    cells -- uint64 array of cells
+    res -- resolution of the cells
+    aed_path -- path of the geojson file of the AEDs (default AED_PATH)
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    retv = np.zeros(len(cells), dtype=bool)
+    if os.path.exists(aed_path):
+        lats, lons = load_aeds(aed_path)
+        retv |= aed_reach(cells, lats, lons, res, COVERAGE_K)
+    if os.path.exists(predictions_path) and 'hospital' in read_schema(predictions_path):
+        hospital = to_dense(read_table(predictions_path, ['hospital']))['hospital']
+        retv |= np.isin(cells, hospital.index.to_numpy(dtype=np.uint64)[hospital.to_numpy() > 0])
+    return retv
+
+
+def build_index(results: dict[str, float], predictions_path: str, res: int) -> SpatialIndex:
+    """Index the results of a city.
+
+    Keyword arguments:
+
+    results -- the {"hex_id": OHCA} dictionary of results.json
+    predictions_path -- path of the predictions table of the city, for the hospital feature
+    res -- resolution of the hexagons
+    """
+    cells = index_to_cells(pd.Index(list(results), dtype=object))
+    risk = np.fromiter(results.values(), dtype=np.float32, count=len(results))
+    return SpatialIndex(cells, risk, covered_cells(predictions_path, cells, res), res)
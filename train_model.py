@@ -1,48 +1,117 @@
-import pandas as pd
 import h2o
 from h2o.automl import H2OAutoML
+from h2o.estimators import H2OGradientBoostingEstimator, H2ORandomForestEstimator
+from h2o.exceptions import H2OResponseError
 import os
+import argparse
+import datetime
+from artifacts import read_table
+from sparse_features import to_dense
+from tree_scorer import export_trees, trees_path
+from drift import column_stats, table_drift, save_stats, load_stats, DRIFT_THRESHOLD, REUSE_THRESHOLD, FULL_RETRAIN_DAYS
+
+# trees added to the current leader when it is warm-started
+WARM_START_TREES = 50
+# parameters copied from the current leader when it is warm-started, H2O takes the others from the checkpoint
+# and rejects changes to most of them
+WARM_START_PARAMS = ('seed', 'score_tree_interval', 'stopping_rounds', 'stopping_metric', 'stopping_tolerance')
+
+parser = argparse.ArgumentParser(description="Train the model, or keep the current one if the data did not drift")
+parser.add_argument('--full', action='store_true', help="run a full AutoML search whatever the drift")
+args = parser.parse_args()
 
 target = 'OHCA'
-# Read the defata
-main_df = pd.read_csv('./data/main_hexagon_df.csv')
+# Read the defata, the features are stored sparse and densified only for the model
+main_df = to_dense(read_table('./data/main_hexagon_df.parquet'))
 
 print(main_df.head())
+today = datetime.date.today().isoformat()
+new_stats = column_stats(main_df)
+
+# compare the new table with the table the current model was trained on
+mode = 'automl'
+model_path = None
+old_stats = None
+if os.path.exists('model_path.txt'):
+    with open('model_path.txt', 'r') as f:
+        model_path = f.read().strip()
+    old_stats = load_stats(model_path)
+if not args.full and old_stats is not None and os.path.exists(model_path):
+    drift = table_drift(old_stats['columns'], new_stats)
+    worst = max(drift, key=drift.get)
+    days = (datetime.date.fromisoformat(today) - datetime.date.fromisoformat(old_stats['automl_at'])).days
+    print(f"Largest drift {drift[worst]:.4f} in {worst}, last AutoML search {days} days ago")
+    if days < FULL_RETRAIN_DAYS and drift[worst] < REUSE_THRESHOLD:
+        mode = 'reuse'
+    elif days < FULL_RETRAIN_DAYS and drift[worst] < DRIFT_THRESHOLD:
+        mode = 'warm_start'
+
+if mode == 'reuse':
+    print(f"Training data did not drift, keeping {model_path}")
+else:
+    # shuffle rows
+    main_df = main_df.sample(frac=1)
+
+    h2o.init(max_mem_size='60G')
+    h2o_df = h2o.H2OFrame(main_df)
+    x = list(main_df.columns)
+    y = target
+    automl_at = today
+
+    leader_model = None
+    if mode == 'warm_start':
+        current_model = h2o.load_model(model_path)
+        estimators = {'gbm': H2OGradientBoostingEstimator, 'drf': H2ORandomForestEstimator}
+        if current_model.algo in estimators:
+            print(f"Small drift, adding {WARM_START_TREES} trees to {model_path}")
+            params = {name: current_model.actual_params[name] for name in WARM_START_PARAMS
+                      if current_model.actual_params.get(name) is not None}
+            leader_model = estimators[current_model.algo](checkpoint=current_model.model_id,
+                                                         ntrees=current_model.actual_params['ntrees'] + WARM_START_TREES,
+                                                         **params)
+            try:
+                leader_model.train(x=x, y=y, training_frame=h2o_df)
+                automl_at = old_stats['automl_at']
+            except (H2OResponseError, EnvironmentError) as e:
+                print(f"Could not warm-start {model_path}, running AutoML: {e}")
+                leader_model = None
+                mode = 'automl'
+        else:
+            print(f"Small drift, {current_model.algo} models cannot be warm-started, keeping {model_path}")
+
+    if mode == 'automl':
+        # Exclude this
+        excluded_algos = ["StackedEnsemble"]
+
+        aml = H2OAutoML(seed=1, max_runtime_secs=36000, exclude_algos=excluded_algos)
+        aml.train(x=x, y=y, training_frame=h2o_df)
+
+        lb = aml.leaderboard
+        # save leaderboard to csv
+        # check if a leader was found
+        if lb is not None:
+            # save leaderboard to csv
+            lb_df = lb.as_data_frame()
+            lb_df.to_csv('leaderboard.csv')
+
+        # Get the best model
+        leader_model = aml.leader
+
+    if leader_model is not None:
+        # check if the /models directory exists
+        if not os.path.exists('./models'):
+            os.mkdir('./models')
+        # save as binary for python
+        model_path = h2o.save_model(model=leader_model, path="./models", force=True)
+        model_path = './models/' + model_path.split('/')[-1]
 
-# shuffle rows
-main_df = main_df.sample(frac=1)
-
-h2o.init(max_mem_size='60G')
-# drop the unnamed column
-main_df = main_df.drop(['Unnamed: 0'], axis=1)
-h2o_df = h2o.H2OFrame(main_df)
-x = list(main_df.columns)
-y = target
-
-# Exclude this
-excluded_algos = ["StackedEnsemble"]
-
-aml = H2OAutoML(seed=1, max_runtime_secs=36000, exclude_algos=excluded_algos)
-aml.train(x=x, y=y, training_frame=h2o_df)
-
-lb = aml.leaderboard
-# save leaderboard to csv
-# check if a leader was found
-if lb is not None:
-    # save leaderboard to csv
-    lb_df = lb.as_data_frame()
-    lb_df.to_csv('leaderboard.csv')
-
-# Get the best model
-leader_model = aml.leader
-# check if the /models directory exists
-if not os.path.exists('./models'):
-    os.mkdir('./models')
-# save as binary for python
-model_path = h2o.save_model(model=leader_model, path="./models", force=True)
-
-with open('model_path.txt', 'w') as f:
-    # write stuff after the las /
-    f.write('./models/' + model_path.split('/')[-1])
-# Shutdown h2o
-h2o.cluster().shutdown()
+        with open('model_path.txt', 'w') as f:
+            # write stuff after the las /
+            f.write(model_path)
+        # keep the statistics of the training data next to the model for the next drift check
+        save_stats(model_path, new_stats, len(main_df), automl_at, today)
+        if leader_model.algo in ('gbm', 'drf'):
+            # trees for scoring without h2o, see tree_scorer.py
+            export_trees(leader_model, trees_path(model_path), main_df)
+    # Shutdown h2o
+    h2o.cluster().shutdown()
@@ -0,0 +1,176 @@
+"""
+This module exports H2O GBM and DRF regression models to flat NumPy arrays and scores them without H2O:
+all trees are traversed for all rows at once, one tree level per step.
+
+The exported trees are kept only if they reproduce the predictions of H2O on a sample of rows,
+otherwise no trees are written and the models are scored by H2O.
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# distributions whose predictions are exp of the sum of the trees
+LOG_LINK_DISTRIBUTIONS = {'poisson', 'gamma', 'tweedie'}
+# rows scored by both H2O and the exported trees before the trees are kept
+CHECK_ROWS = 1000
+# tolerances of the comparison, the thresholds are stored as float32
+CHECK_RTOL = 1e-4
+CHECK_ATOL = 1e-4
+
+
+def trees_path(model_path: str) -> str:
+    return f"{model_path.rstrip('/')}.trees.npz"
+
+
+def export_trees(model, path: str, sample: pd.DataFrame, check_rows: int = CHECK_ROWS) -> bool:
+    """Export the trees of a trained H2O GBM or DRF regression model to a .npz file.
+    Needs a running H2O cluster with the model loaded.
+
+    The trees are written only if they predict a sample of rows like model.predict, any older file
+    at path is removed otherwise, so the model is scored by H2O. Returns True if the trees were written.
+
+    Keyword arguments:
+
+    model -- H2O GBM or DRF regression model
+    path -- path of the .npz file
+    sample -- DataFrame with the columns of the model, some of its rows are scored by both
+    check_rows -- number of rows scored by both (default CHECK_ROWS)
+    """
+    from h2o.tree import H2OTree
+    if model.algo not in ('gbm', 'drf'):
+        raise ValueError(f"Only gbm and drf models can be exported, not {model.algo}")
+    response = model.actual_params['response_column']
+    columns = [col for col in model._model_json['output']['names'] if col != response]
+    column_index = {col: i for i, col in enumerate(columns)}
+    features, thresholds, lefts, rights, na_left, values, roots = [], [], [], [], [], [], []
+    offset = 0
+    # early stopping can build fewer trees than ntrees
+    n_trees = int(model._model_json['output']['model_summary']['number_of_trees'][0])
+    for tree_number in range(n_trees):
+        tree = H2OTree(model, tree_number, plain_language_rules='FALSE')
+        if any(levels is not None for levels in tree.levels):
+            print("Categorical splits are not supported, the model is scored by H2O")
+            _remove(path)
+            return False
+        n = len(tree.left_children)
+        left = np.array(tree.left_children, dtype=np.int64)
+        right = np.array(tree.right_children, dtype=np.int64)
+        is_leaf = left < 0
+        roots.append(offset)
+        features.append(np.array([-1 if leaf else column_index[feature] for leaf, feature in zip(is_leaf, tree.features)], dtype=np.int32))
+        thresholds.append(np.array([np.nan if threshold is None else threshold for threshold in tree.thresholds], dtype=np.float32))
+        # leaves point to themselves, so finished rows stay in place
+        lefts.append(np.where(is_leaf, np.arange(n), left) + offset)
+        rights.append(np.where(is_leaf, np.arange(n), right) + offset)
+        na_left.append(np.array([str(na).upper() == 'LEFT' for na in tree.nas], dtype=bool))
+        values.append(np.array([np.nan if value is None else value for value in tree.predictions], dtype=np.float64))
+        offset += n
+    distribution = model.actual_params.get('distribution', 'gaussian')
+    init_f = model._model_json['output'].get('init_f', 0.0) if model.algo == 'gbm' else 0.0
+    meta = {'algo': model.algo, 'columns': columns, 'init_f': float(init_f or 0.0), 'distribution': distribution}
+    # numpy adds .npz to names without it
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(tmp_path, feature=np.concatenate(features), threshold=np.concatenate(thresholds),
+                        left=np.concatenate(lefts).astype(np.int32), right=np.concatenate(rights).astype(np.int32),
+                        na_left=np.concatenate(na_left), value=np.concatenate(values), root=np.array(roots, dtype=np.int32),
+                        meta=np.array(json.dumps(meta)))
+    rows = sample.sample(n=min(check_rows, len(sample)), random_state=1)
+    difference = check_export(model, tmp_path, rows) if len(rows) else np.inf
+    if difference > 0:
+        print(f"The exported trees differ from H2O by up to {difference:.6g}, the model is scored by H2O")
+        os.remove(tmp_path)
+        _remove(path)
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+
+def check_export(model, path: str, sample: pd.DataFrame) -> float:
+    """Score rows with a model in H2O and with its exported trees.
+    Returns the largest difference of the rows outside the tolerances CHECK_RTOL and CHECK_ATOL, 0 if all agree.
+
+    Keyword arguments:
+
+    model -- H2O GBM or DRF regression model
+    path -- path of the .npz file of its trees
+    sample -- DataFrame with the columns of the model
+    """
+    import h2o
+    scorer = TreeScorer(path)
+    # columns the rows do not have are missing for both
+    sample = sample.reindex(columns=scorer.columns)
+    expected = model.predict(h2o.H2OFrame(sample)).as_data_frame()['predict'].to_numpy(dtype=np.float64)
+    actual = scorer.predict(sample)
+    close = np.isclose(actual, expected, rtol=CHECK_RTOL, atol=CHECK_ATOL, equal_nan=True)
+    # rows where only one of them is nan are infinitely far apart
+    return float(np.nan_to_num(np.abs(actual - expected), nan=np.inf)[~close].max(initial=0.0))
+
+
+def _remove(path: str) -> None:
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class TreeScorer:
+    """Score an exported GBM or DRF model on a DataFrame, without H2O.
+
+    Keyword arguments:
+
+    path -- path of the .npz file written by export_trees
+    """
+
+    def __init__(self, path: str):
+        with np.load(path) as arrays:
+            self.feature = arrays['feature']
+            self.threshold = arrays['threshold']
+            self.left = arrays['left']
+            self.right = arrays['right']
+            self.na_left = arrays['na_left']
+            self.value = arrays['value']
+            self.root = arrays['root']
+            meta = json.loads(str(arrays['meta']))
+        self.algo = meta['algo']
+        self.columns = meta['columns']
+        self.init_f = meta['init_f']
+        self.distribution = meta['distribution']
+
+    def leaf_values(self, X: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+        """Get the value of the leaf every row reaches in every tree, as a rows x trees array.
+
+        Keyword arguments:
+
+        X -- float matrix with the columns of the model in order
+        batch_size -- number of rows traversed at once (default 65536)
+        """
+        X = np.asarray(X, dtype=np.float32)
+        retv = np.empty((len(X), len(self.root)), dtype=np.float64)
+        for start in range(0, len(X), batch_size):
+            batch = X[start:start + batch_size]
+            rows = np.arange(len(batch))[:, None]
+            node = np.broadcast_to(self.root, (len(batch), len(self.root))).copy()
+            while True:
+                feature = self.feature[node]
+                inner = feature >= 0
+                if not inner.any():
+                    break
+                x = batch[rows, np.maximum(feature, 0)]
+                # H2O sends values below the threshold left, missing values go the learned way
+                go_left = np.where(np.isnan(x), self.na_left[node], x < self.threshold[node])
+                node = np.where(inner, np.where(go_left, self.left[node], self.right[node]), node)
+            retv[start:start + batch_size] = self.value[node]
+        return retv
+
+    def predict(self, df: pd.DataFrame) -> np.ndarray:
+        """Predict the rows of a DataFrame with the columns of the model, returns a float64 array.
+
+        Keyword arguments:
+
+        df -- DataFrame with the columns the model was trained on
+        """
+        leaves = self.leaf_values(df[self.columns].to_numpy(dtype=np.float32))
+        if self.algo == 'drf':
+            return leaves.mean(axis=1)
+        link = self.init_f + leaves.sum(axis=1)
+        return np.exp(link) if self.distribution in LOG_LINK_DISTRIBUTIONS else link
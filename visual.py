@@ -1,59 +1,200 @@
-# draw the map
+# draw the maps
+import os
+import json
+import string
+import argparse
 import numpy as np
-import requests
 import pandas as pd
-import h3
+from h3.api import basic_int as h3_int
+from artifacts import read_schema, read_table
+from cities import City, load_cities, predictions_path
+from coverage import load_aeds, covered_cells, greedy_sites, N_SITES
+from hexgrid import cells_to_str, index_to_cells
+from sparse_features import to_dense
 
 target = 'OHCA'
-poland_df = pd.read_csv('./data/predictions.csv')
-
-aed_url = 'https://aed.openstreetmap.org.pl/aed_poland.geojson'
-aed_file = requests.get(aed_url)
-aed_json = aed_file.json()
-# create a column with aed count
-
-poland_df['aed_count'] = 0
-
-# iterate through aeds find the hexagon and add 1 to the column
-for aed in aed_json['features']:
-    x, y = aed["geometry"]["coordinates"]
-    hexagon = h3.latlng_to_cell(y, x, 9)
-    poland_df.loc[poland_df['hex_id'] == hexagon, 'aed_count'] += 1
-# create a map, color hexagons by the predicted number of ohca
-import folium
-
-m = folium.Map(location=[52.2297, 21.0122], zoom_start=11)
-
-max_ohca = np.round(poland_df[target].max())
-
-# get top 10 hexagons with the most predicted ohca that have no defibrillators or hospitals
-top_10_hexagons = poland_df[(poland_df['aed_count'] == 0) & (poland_df['hospital'] == 0)].sort_values(by=target, ascending=False).head(10)
-top_10_hex_indexes = top_10_hexagons.index.values
-
-# add hexagons with opacity based on the number of ohca
-for idx, row in poland_df.iterrows():
-    i = row['hex_id']
-    try:
-        locations = h3.cell_to_boundary(i)
-    except: # this fails sometimes, but it's fine
-        continue
-    fill_value = row[target] / max_ohca
-
-    # Set default color values
-    color = 'red'
-
-    # Change color and weight based on conditions
-    if row['aed_count'] != 0 or row['hospital'] != 0:
-        color = 'green'
-    elif idx in top_10_hex_indexes:
-        color = 'blue'
-
-    # Create the Polygon once, with the determined color and weight
-    folium.Polygon(
-        locations=locations,
-        color=color,
-        fill_color=color,
-        fill_opacity=fill_value,
-        popup='Predicted OHCA: {}'.format(row[target])
-    ).add_to(m)
-m.save('index.html')
+# one map per registered city, the first city is also the preview page
+MAPS_DIR = './maps'
+# hexagon classes, the index is the class code
+COLORS = ['red', 'green', 'blue']
+RED, GREEN, BLUE = range(len(COLORS))
+# the predicted counts in the compact maps are rounded to this many decimals
+OHCA_DECIMALS = 3
+
+# the compact map: the hex ids, classes and values are embedded once, the hexagons are drawn by h3-js
+# on one canvas, only the ones in view and again after every move
+MAP_TEMPLATE = string.Template("""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Predicted OHCA - $title</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<script src="https://unpkg.com/h3-js@4.1.0/dist/h3-js.umd.js"></script>
+<style>html, body, #map { height: 100%; margin: 0; }</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+const DATA = $data;
+const map = L.map('map').setView(DATA.centre, DATA.zoom);
+L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
+  attribution: '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
+}).addTo(map);
+
+const rings = DATA.cells.map(cell => h3.cellToBoundary(cell));
+const boxes = rings.map(ring => L.latLngBounds(ring));
+const positions = new Map(DATA.cells.map((cell, i) => [cell, i]));
+
+const Hexagons = L.Layer.extend({
+  onAdd: function (map) {
+    this._canvas = L.DomUtil.create('canvas', 'leaflet-zoom-hide');
+    map.getPanes().overlayPane.appendChild(this._canvas);
+    map.on('moveend', this._draw, this);
+    this._draw();
+  },
+  onRemove: function (map) {
+    L.DomUtil.remove(this._canvas);
+    map.off('moveend', this._draw, this);
+  },
+  _draw: function () {
+    const size = this._map.getSize();
+    L.DomUtil.setPosition(this._canvas, this._map.containerPointToLayerPoint([0, 0]));
+    this._canvas.width = size.x;
+    this._canvas.height = size.y;
+    const ctx = this._canvas.getContext('2d');
+    const view = this._map.getBounds();
+    for (let i = 0; i < rings.length; i++) {
+      if (!view.intersects(boxes[i])) continue;
+      ctx.beginPath();
+      rings[i].forEach(([lat, lon], j) => {
+        const p = this._map.latLngToContainerPoint([lat, lon]);
+        if (j === 0) ctx.moveTo(p.x, p.y); else ctx.lineTo(p.x, p.y);
+      });
+      ctx.closePath();
+      ctx.fillStyle = ctx.strokeStyle = DATA.colors[DATA.classes.charCodeAt(i) - 48];
+      ctx.globalAlpha = DATA.opacity[i] / 255;
+      ctx.fill();
+      ctx.globalAlpha = 1;
+      ctx.stroke();
+    }
+  }
+});
+new Hexagons().addTo(map);
+
+map.on('click', e => {
+  const i = positions.get(h3.latLngToCell(e.latlng.lat, e.latlng.lng, DATA.res));
+  if (i !== undefined) {
+    L.popup().setLatLng(e.latlng).setContent('Predicted OHCA: ' + DATA.ohca[i]).openOn(map);
+  }
+});
+</script>
+</body>
+</html>
+""")
+
+def classify(aed_count: np.ndarray, hospital: np.ndarray, sites: np.ndarray) -> np.ndarray:
+    """Get the class code of every hexagon: GREEN with an AED or a hospital, BLUE for a proposed site, RED otherwise.
+
+    Keyword arguments:
+
+    aed_count -- number of AEDs in every hexagon
+    hospital -- hospital feature of every hexagon
+    sites -- positions of the proposed AED sites
+    """
+    proposed = np.zeros(len(aed_count), dtype=bool)
+    proposed[sites] = True
+    return np.select([(aed_count != 0) | (hospital != 0), proposed], [GREEN, BLUE], RED).astype(np.uint8)
+
+
+def city_layers(city: City, aed_lats: np.ndarray, aed_lons: np.ndarray) -> tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """Get the predictions of a city, the class code of every hexagon and its fill opacity between 0 and 1.
+
+    Keyword arguments:
+
+    city -- the registered city
+    aed_lats, aed_lons -- coordinates of the AEDs, from coverage.load_aeds
+    """
+    path = predictions_path(city)
+    columns = [target] + (['hospital'] if 'hospital' in read_schema(path) else [])
+    poland_df = to_dense(read_table(path, columns))
+    # count the aeds in every hexagon at once
+    matrix, counts, covered = covered_cells(poland_df, aed_lats, aed_lons, city.res)
+    ohca = poland_df[target].to_numpy(dtype=np.float64)
+    # propose the sites covering the most predicted ohca not covered yet
+    sites, _ = greedy_sites(matrix, ohca, covered, N_SITES)
+    hospital = poland_df['hospital'].to_numpy() if 'hospital' in poland_df.columns else np.zeros(len(ohca))
+    classes = classify(counts, hospital, sites)
+    # opacity based on the number of ohca
+    max_ohca = max(np.round(ohca.max()), 1.0) if len(ohca) else 1.0
+    return poland_df, classes, np.clip(ohca / max_ohca, 0, 1)
+
+
+def compact_map(city: City, aed_lats: np.ndarray, aed_lons: np.ndarray) -> str:
+    """Get the html page of the compact map of a city.
+
+    Keyword arguments:
+
+    city -- the registered city
+    aed_lats, aed_lons -- coordinates of the AEDs, from coverage.load_aeds
+    """
+    poland_df, classes, opacity = city_layers(city, aed_lats, aed_lons)
+    data = {
+        'centre': list(city.centre), 'zoom': city.zoom, 'res': city.res, 'colors': COLORS,
+        'cells': cells_to_str(index_to_cells(poland_df.index)).tolist(),
+        # one digit per hexagon
+        'classes': ''.join(map(str, classes.tolist())),
+        'opacity': np.round(opacity * 255).astype(np.uint8).tolist(),
+        'ohca': np.round(poland_df[target].to_numpy(dtype=np.float64), OHCA_DECIMALS).tolist(),
+    }
+    payload = json.dumps(data, separators=(',', ':')).replace('</', '<\\/')
+    return MAP_TEMPLATE.substitute(title=city.area_name, data=payload)
+
+
+def folium_map(city: City, aed_lats: np.ndarray, aed_lons: np.ndarray):
+    """Get the folium map of a city, with one polygon and popup per hexagon.
+
+    Keyword arguments:
+
+    city -- the registered city
+    aed_lats, aed_lons -- coordinates of the AEDs, from coverage.load_aeds
+    """
+    import folium
+    poland_df, classes, opacity = city_layers(city, aed_lats, aed_lons)
+    m = folium.Map(location=list(city.centre), zoom_start=city.zoom)
+    cells = index_to_cells(poland_df.index)
+    for i, cell in enumerate(cells.tolist()):
+        try:
+            locations = h3_int.cell_to_boundary(cell)
+        except: # this fails sometimes, but it's fine
+            continue
+        color = COLORS[classes[i]]
+        folium.Polygon(
+            locations=locations,
+            color=color,
+            fill_color=color,
+            fill_opacity=opacity[i],
+            popup='Predicted OHCA: {}'.format(poland_df[target].iat[i])
+        ).add_to(m)
+    return m
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Draw the maps of the predictions of all registered cities")
+    parser.add_argument('--folium', action='store_true', help="draw every hexagon as a folium polygon instead of the compact map")
+    args = parser.parse_args()
+    # coordinates of all AEDs, see coverage.py
+    aed_lats, aed_lons = load_aeds()
+    os.makedirs(MAPS_DIR, exist_ok=True)
+    for i, city in enumerate(load_cities()):
+        paths = [os.path.join(MAPS_DIR, f'{city.slug}.html')] + (['index.html'] if i == 0 else [])
+        if args.folium:
+            m = folium_map(city, aed_lats, aed_lons)
+            for path in paths:
+                m.save(path)
+        else:
+            page = compact_map(city, aed_lats, aed_lons)
+            for path in paths:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(page)
+        print(f"Saved the map of {city.area_name}")